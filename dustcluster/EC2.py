@@ -19,12 +19,62 @@ import boto, boto.ec2
 from dustcluster.util import setup_logger
 logger = setup_logger( __name__ )
 
+# dust filter keys and the DescribeInstances filters they map to
+api_filter_names = {
+                    'id'                  : 'instance-id',
+                    'state'               : 'instance-state-name',
+                    'type'                : 'instance-type',
+                    'instance_type'       : 'instance-type',
+                    'key'                 : 'key-name',
+                    'key_name'            : 'key-name',
+                    'vpc'                 : 'vpc-id',
+                    'vpc_id'              : 'vpc-id',
+                    'image'               : 'image-id',
+                    'image_id'            : 'image-id',
+                    'ip'                  : 'ip-address',
+                    'ip_address'          : 'ip-address',
+                    'private_ip_address'  : 'private-ip-address',
+                    'dns_name'            : 'dns-name',
+                    'public_dns_name'     : 'dns-name',
+                    'private_dns_name'    : 'private-dns-name',
+                    'subnet_id'           : 'subnet-id',
+                    'placement'           : 'availability-zone',
+                    'architecture'        : 'architecture',
+                    'root_device_type'    : 'root-device-type',
+                    'virtualization_type' : 'virtualization-type',
+                    'hypervisor'          : 'hypervisor'
+                   }
+
+# instance attributes kept on nodes, the ones dust shows and filters on. 
+# the rest are fetched on demand (show -vv)
+lean_fields = ['id', 'state', 'instance_type', 'image_id', 'key_name', 'ip_address', 'private_ip_address',
+               'public_dns_name', 'private_dns_name', 'vpc_id', 'subnet_id', 'placement', 'launch_time',
+               'architecture', 'root_device_type', 'virtualization_type', 'hypervisor', 'groups', 'tags']
+
+field_index = dict((field, i) for i, field in enumerate(lean_fields))
+
+# values that repeat across a fleet (state, type, ami, vpc, zone, ..) are interned and shared by all nodes
+interned_fields = set(['state', 'instance_type', 'image_id', 'key_name', 'vpc_id', 'subnet_id', 'placement',
+                       'architecture', 'root_device_type', 'virtualization_type', 'hypervisor', 'groups'])
+
+# instances per DescribeInstances page (EC2 allows 5 to 1000)
+default_page_size = 1000
+
+
+class OfflineError(Exception):
+    ''' an instance attribute that is not in the inventory cache was needed under dust --offline '''
+    pass
+
+
 class EC2Cloud(object):
     '''
     provides a connection to EC2 and generates a list of Node objects 
     '''
 
-    def __init__(self, name='', key='', region="", image="", username="", keyfile="", creds_map={}):
+    # the layout of node records, see node_records
+    record_fields = lean_fields
+
+    def __init__(self, name='', key='', region="", image="", username="", keyfile="", creds_map={}, offline=False):
 
         if not region:
             region = 'eu-west-1'
@@ -38,6 +88,7 @@ class EC2Cloud(object):
         self.username = username
         self.keyfile = keyfile
         self.creds_map = creds_map
+        self.offline = offline      # nodes come from the inventory cache, the boto instances are not fetched
 
 
     def connect(self):
@@ -64,28 +115,147 @@ class EC2Cloud(object):
         return self._connection
 
 
-    def refresh(self):
-        ''' get nodes/reservations from cloud '''
+    def refresh(self, filters=None):
+        '''
+        get nodes/reservations from cloud, optionally only those matching DescribeInstances filters.
+        Returns once every page has arrived, show groups nodes by cluster and needs them all
+        '''
 
-        logger.debug('hydrating from all cloud nodes')
+        if filters:
+            logger.debug('hydrating from cloud nodes matching %s' % filters)
+        else:
+            logger.debug('hydrating from all cloud nodes')
+
+        return list(self.iter_nodes(filters))
 
-        vms = self._get_instances()
+    def iter_nodes(self, filters=None, page_size=None):
+        '''
+        generator of nodes, fetched a page of DescribeInstances at a time. Each instance is reduced to
+        the lean_fields as its page arrives, so only one page of boto objects is alive at a time.
+        This bounds memory, not the time to the first row shown, refresh still collects every page
+        '''
 
-        all_nodes = []
-        for vm in vms:
+        for vm in self._iter_instances(filters, page_size):
             node = EC2Node(username=self.username, cloud=self)
             node.hydrate(vm)
-            all_nodes.append(node)
-        return all_nodes
+            yield node
+
+    def node_records(self, nodes):
+        ''' the lean tuples of nodes, to save and rebuild the nodes later without the API '''
+        return [node.record for node in nodes if node.hydrated]
+
+    def nodes_from_records(self, records):
+
+        nodes = []
+        for record in records:
+            node = EC2Node(username=self.username, cloud=self)
+            node.hydrate_record(record)
+            nodes.append(node)
+        return nodes
+
+    def _iter_instances(self, filters=None, page_size=None):
+
+        next_token = None
+        page = 0
+        while True:
+            reservations = self.conn().get_all_reservations(filters=filters, max_results=page_size or default_page_size,
+                                                            next_token=next_token)
+            page += 1
+            for r in reservations:
+                for i in r.instances:
+                    yield i
+
+            next_token = getattr(reservations, 'next_token', None)
+            logger.debug('fetched inventory page %d, more: %s' % (page, bool(next_token)))
+            if not next_token:
+                break
+
+    def get_vms(self, iids):
+        ''' returns { id : boto instance } for instance ids, a DescribeInstances call per page of ids '''
+
+        ret = {}
+        for start in range(0, len(iids), default_page_size):
+            ret.update((vm.id, vm) for vm in self._get_instances(iids=iids[start:start+default_page_size]))
+        return ret
 
-    def _get_instances(self, iids=None):
+    def fetch_vms(self, nodes):
+        ''' fetch the boto instances of nodes with one call, for the fields not kept on nodes (show -vv) '''
+
+        nodes = [node for node in nodes if node.hydrated and not node.fetched]
+        if not nodes:
+            return
+
+        if self.offline:
+            raise OfflineError('offline, not fetching the instances of %d nodes' % len(nodes))
+
+        vms = self.get_vms([node.get('id') for node in nodes])
+        for node in nodes:
+            node.vm = vms.get(node.get('id'))
+
+    def update_nodes(self, nodes):
+        ''' refresh the state of nodes from the cloud, with one DescribeInstances per page of ids '''
+
+        nodes = [node for node in nodes if node.hydrated]
+        vms = self.get_vms([node.get('id') for node in nodes])
+        for node in nodes:
+            vm = vms.get(node.get('id'))
+            if vm:
+                node.update(vm)
+
+    def load_field(self, nodes, field):
+        ''' make field available on all nodes at once, so a NodeTable column is not a DescribeInstances per node '''
+
+        field = EC2Node.friendly_names.get(field, field)
+        if field in field_index or field not in EC2Node.all_fields:
+            return
+
+        if self.offline:
+            raise OfflineError('%s is not in the inventory cache, run dust without --offline to use it' % field)
+
+        self.fetch_vms(nodes)
+
+    def _get_instances(self, iids=None, filters=None):
         ret = []
-        reservations = self.conn().get_all_reservations(instance_ids=iids)
+        reservations = self.conn().get_all_reservations(instance_ids=iids, filters=filters)
         for r in reservations:
             for i in r.instances:
                 ret.append(i)
         return ret
 
+    def api_filters(self, filterkey, filterval):
+        '''
+        translate a dust key=value filter into DescribeInstances filters that select the nodes it matches,
+        and possibly some more, so the dust filter is still applied to what comes back.
+        returns None if the filter can't be pushed down (e.g. [] patterns, which EC2 filters don't support)
+        '''
+
+        if not filterkey or not filterval or filterval == '*' or '[' in filterval:
+            return None
+
+        if filterkey == 'tags':
+            pos = filterval.rfind(':')
+            if pos < 1:
+                return None
+
+            tagkey, tagval = filterval[:pos], filterval[pos+1:]
+            if tagkey[0] == '"' and tagkey[-1] == '"':
+                tagkey = tagkey[1:-1]
+
+            if not tagkey or not tagval:
+                return None
+
+            if '*' in tagkey or '?' in tagkey:
+                # tag-key and tag-value match independently, a superset of key:value on the same tag
+                return { 'tag-key' : tagkey, 'tag-value' : tagval }
+
+            return { 'tag:%s' % tagkey : tagval }
+
+        filtername = api_filter_names.get(filterkey)
+        if not filtername:
+            return None
+
+        return { filtername : filterval }
+
     def create_absent_node(self, nodename, **kwargs):
         node = EC2Node(nodename=nodename, **kwargs)
         node.cloud = self
@@ -123,6 +293,30 @@ class EC2Node(object):
     describe and control EC2 nodes within an EC2 cloud
     '''
 
+    # one of these per instance in the region, so no per node __dict__, and the field tables are shared
+    __slots__ = ['_key', '_keyfile', '_name', '_instance_type', '_image', '_username', '_vm', '_data', 
+                 'cloud', '_hydrated', '_clustername']
+
+    friendly_names = { 
+                        'image'    : 'image_id', 
+                        'dns_name' : 'public_dns_name', 
+                        'type'     : 'instance_type',
+                        'key'      : 'key_name',
+                        'vpc'      : 'vpc_id',
+                        'ip'       : 'ip_address'
+                       }
+
+    extended_fields = [ 'dns_name', 'image', 'tags', 'key', 'launch_time', 'vpc', 'groups']
+
+    all_fields = ['ami_launch_index', 'architecture', 'block_device_mapping', 'client_token',  
+                'dns_name', 'ebs_optimized', 'group_name', 'groups', 'hypervisor', 'id', 'image_id', 'instance_profile', 
+                'instance_type', 'interfaces', 'ip_address', 'kernel', 'key_name', 'launch_time', 
+                'monitored', 'monitoring_state', 'persistent', 'placement', 'placement_group', 
+                 'placement_tenancy', 'platform', 'previous_state', 'previous_state_code', 'private_dns_name', 'private_ip_address', 
+                'product_codes', 'public_dns_name', 'ramdisk', 'reason', 'reboot', 'region', 'requester_id', 
+                'root_device_name', 'root_device_type', 'spot_instance_request_id', 'state', 'state_code', 'state_reason', 
+                'subnet_id', 'tags', 'virtualization_type', 'vpc_id']
+
     def __init__(self, key="", keyfile="", nodename="", instance_type="", image="",  username='', vm=None, cloud=None):
 
         self._key = key
@@ -132,6 +326,7 @@ class EC2Node(object):
         self._image     = image
         self._username = username
         self._vm        = None
+        self._data      = None  # tuple of the lean_fields of the instance, see lean_record
         self.cloud      = cloud
 
         self._hydrated = False
@@ -139,44 +334,55 @@ class EC2Node(object):
         # for starting new nodes
         self._clustername = None
 
-        self.friendly_names = { 
-                                'image'    : 'image_id', 
-                                'dns_name' : 'public_dns_name', 
-                                'type'     : 'instance_type',
-                                'key'      : 'key_name',
-                                'vpc'      : 'vpc_id',
-                                'ip'       : 'ip_address'
-                               }
-
-        self.extended_fields = [ 'dns_name', 'image', 'tags', 'key', 'launch_time', 'vpc', 'groups']
-
-        self.all_fields = ['ami_launch_index', 'architecture', 'block_device_mapping', 'client_token',  
-                    'dns_name', 'ebs_optimized', 'group_name', 'groups', 'hypervisor', 'id', 'image_id', 'instance_profile', 
-                    'instance_type', 'interfaces', 'ip_address', 'kernel', 'key_name', 'launch_time', 
-                    'monitored', 'monitoring_state', 'persistent', 'placement', 'placement_group', 
-                     'placement_tenancy', 'platform', 'previous_state', 'previous_state_code', 'private_dns_name', 'private_ip_address', 
-                    'product_codes', 'public_dns_name', 'ramdisk', 'reason', 'reboot', 'region', 'requester_id', 
-                    'root_device_name', 'root_device_type', 'spot_instance_request_id', 'state', 'state_code', 'state_reason', 
-                    'subnet_id', 'tags', 'virtualization_type', 'vpc_id']
-
     def __repr__(self):
         data = self.disp_data()
         return ",".join(str(datum) for datum in data)
 
     def hydrate(self, vm):
         ''' populate template node state from the cloud reservation ''' 
+        self.hydrate_record(lean_record(vm))
+
+    def hydrate_record(self, record):
+        ''' populate node state from a lean record, see lean_record '''
         self._name      = ""
-        self._image     = vm.image_id
-        self._instance_type     = vm.instance_type
-        self._vm = vm
+        self._data = record
+        self._image     = self._field('image_id')
+        self._instance_type     = self._field('instance_type')
         self._hydrated = True
 
+    def update(self, vm=None):
+        ''' refresh instance state from the cloud, or from vm if it was already fetched '''
+        if self._hydrated:
+            if vm is None:
+                vm = self.cloud.get_vms([self._field('id')]).get(self._field('id'))
+            if vm:
+                self._data = lean_record(vm)
+                if self._vm:
+                    self._vm = vm
+
+    def _field(self, name):
+        return self._data[field_index[name]]
+
     @property
     def hydrated(self):
         return self._hydrated
 
+    @property
+    def record(self):
+        return self._data
+
+    @property
+    def fetched(self):
+        ''' True once the boto instance has been fetched '''
+        return self._vm is not None
+
     @property
     def vm(self):
+        ''' the boto instance, fetched on first use '''
+        if not self._vm and self._hydrated:
+            if self.cloud.offline:
+                raise OfflineError('offline, not fetching the instance %s' % self._field('id'))
+            self._vm = self.cloud.get_vms([self._field('id')]).get(self._field('id'))
         return self._vm
 
     @vm.setter
@@ -217,8 +423,8 @@ class EC2Node(object):
 
     @property
     def key(self):
-        if self._vm:
-            return self._vm.key_name
+        if self._hydrated:
+            return self._field('key_name')
         else:
             return self._key
 
@@ -232,15 +438,15 @@ class EC2Node(object):
         #if not self.cluster.get_keyfile_for_key(self.key):
         #    raise Exception("No key specified, not starting nodes.")
 
-        vm = self._vm
-        if vm:
-            if vm.state == 'running' or vm.state == 'pending':
+        if self._hydrated:
+            state = self._field('state')
+            if state == 'running' or state == 'pending':
                 logger.info( "Nothing to do for node [%s]" % self._name )
                 return
 
-            if vm.state == 'stopped':
+            if state == 'stopped':
                 logger.info( 'restarting node %s : %s' % (self._name, self) )
-                self.cloud.conn().start_instances(instance_ids=[vm.id])
+                self.cloud.conn().start_instances(instance_ids=[self._field('id')])
                 return
 
         logger.info( 'launching new node name=[%s] image=[%s] instance=[%s]'
@@ -250,28 +456,27 @@ class EC2Node(object):
 
     def stop(self):
 
-        vm = self._vm
-        if vm:
-            if vm.state == 'stopped':
+        if self._hydrated:
+            if self._field('state') == 'stopped':
                 return 
             else:
                 logger.info('stopping %s' % self._name)
-                self.cloud.conn().stop_instances(instance_ids = [vm.id])
+                self.cloud.conn().stop_instances(instance_ids = [self._field('id')])
         else:
             logger.error('no vm that matches node defination for %s' %  self._name)
 
     def terminate(self):
 
-        if self._vm:
-            tags = self._vm.tags
+        if self._hydrated:
+            tags = self._field('tags')
             newname = ''
             if tags and tags.get('name'):
                 newname = tags['name'] + '_terminated'
-                self._vm.add_tag('name', newname)
+                self.cloud.conn().create_tags([self._field('id')], {'name' : newname})
 
-            instance_ids = [self._vm.id]
+            instance_ids = [self._field('id')]
 
-            logger.info('terminating %s id=[%s]' % (self._name, self._vm.id))
+            logger.info('terminating %s id=[%s]' % (self._name, self._field('id')))
 
             self.cloud.conn().stop_instances( instance_ids = instance_ids )
             self.cloud.conn().terminate_instances( instance_ids = instance_ids )
@@ -287,10 +492,9 @@ class EC2Node(object):
 
         vals = [self._name, self._instance_type]
 
-        if self._vm:
-            vm = self._vm
-            vmdata = [vm.state, vm.id, vm.ip_address, vm.private_ip_address]
-            vals += vmdata
+        if self._hydrated:
+            vals += [self._field('state'), self._field('id'), self._field('ip_address'),
+                     self._field('private_ip_address')]
         else:
             startColorRed = "\033[0;31;40m"
             endColor      = "\033[0m"
@@ -309,13 +513,16 @@ class EC2Node(object):
         if prop_name in self.friendly_names:
             prop_name = self.friendly_names[prop_name]
 
-        if not self._vm:
+        if not self._hydrated:
             return ""
 
-        if prop_name == 'groups':
-            return ",".join(str(grp.name) for grp in self._vm.groups)
-        else:
-            return getattr(self._vm, prop_name)
+        if prop_name in field_index:
+            return self._data[field_index[prop_name]]
+
+        if prop_name not in self.all_fields:
+            return ""
+
+        return getattr(self.vm, prop_name, "")
 
 
     def extended_data(self):
@@ -327,7 +534,7 @@ class EC2Node(object):
             val = self.get(field)
 
             if field == 'tags':
-                val =  ",".join( '%s=%s' % (k,v) for k,v in self._vm.tags.items())
+                val =  ",".join( '%s=%s' % (k,v) for k,v in (val or {}).items())
 
             if val:
                 ret[field] = val
@@ -343,10 +550,32 @@ class EC2Node(object):
             val = self.get(field)
 
             if field == 'tags':
-                val =  ",".join( '%s=%s' % (k,v) for k,v in self._vm.tags.items())
+                val =  ",".join( '%s=%s' % (k,v) for k,v in (val or {}).items())
 
             if val:
                 ret[field] = val
 
         return ret
 
+
+def lean_record(vm):
+    ''' tuple of the lean_fields of a boto instance, in lean_fields order '''
+
+    ret = []
+    for field in lean_fields:
+        val = getattr(vm, field, None)
+        if field == 'groups':
+            val = ",".join(str(grp.name) for grp in (val or []))
+        elif field == 'tags':
+            val = dict((_intern(k), v) for k, v in (val or {}).items())
+        if field in interned_fields and isinstance(val, basestring):
+            val = _intern(val)
+        ret.append(val)
+    return tuple(ret)
+
+
+def _intern(val):
+    try:
+        return intern(str(val))
+    except UnicodeEncodeError:
+        return val
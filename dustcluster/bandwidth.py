@@ -0,0 +1,180 @@
+# Copyright (c) Ran Dugal 2014
+#
+# This file is part of dust.
+#
+# Licensed under the GNU Affero General Public License v3, which is available at
+# http://www.gnu.org/licenses/agpl-3.0.html
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero GPL for more details.
+#
+
+''' a shared bandwidth budget for all file transfers '''
+
+import time
+from threading import Condition
+
+from dustcluster.util import setup_logger
+logger = setup_logger( __name__ )
+
+
+class TokenBucket(object):
+    '''
+    token bucket shared by all transfer streams.
+    Bulk transfers wait for tokens in first come first served order, and take at most one chunk at a time,
+    so concurrent streams to different nodes get turns and one fast node can't hog the budget.
+    Interactive traffic never waits, it takes its tokens even if that leaves the bucket in debt,
+    which makes the bulk transfers back off instead.
+    clock and wait(secs) default to time.time and a wait on the bucket's condition, which a refund cuts short.
+    '''
+
+    def __init__(self, rate, burst=None, clock=None, wait=None):
+        self.rate = float(rate)                     # bytes/sec
+        self.burst = float(burst or rate / 4)
+        self.cond = Condition()
+        self.clock = clock or time.time
+        self.wait = wait or self.cond.wait
+        self.tokens = self.burst
+        self.last = self.clock()
+        self.next_ticket = 0
+        self.serving = 0
+
+    def refill(self):
+        now = self.clock()
+        self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+        self.last = now
+
+    def consume(self, nbytes):
+        ''' block until nbytes of bulk transfer are allowed '''
+
+        with self.cond:
+            ticket = self.next_ticket
+            self.next_ticket += 1
+
+            while self.serving != ticket:
+                self.cond.wait()
+
+            try:
+                # a single request bigger than the bucket just has to wait for a full bucket
+                need = min(nbytes, self.burst)
+                self.refill()
+                while self.tokens < need:
+                    self.wait((need - self.tokens) / self.rate)
+                    self.refill()
+                self.tokens -= nbytes
+            finally:
+                self.serving += 1
+                self.cond.notify_all()
+
+    def consume_interactive(self, nbytes):
+        ''' account for interactive traffic, never blocks '''
+        with self.cond:
+            self.refill()
+            self.tokens -= nbytes
+
+    def refund(self, nbytes):
+        ''' return tokens taken for bytes that were not transferred '''
+        with self.cond:
+            self.refill()
+            self.tokens = min(self.burst, self.tokens + nbytes)
+            self.cond.notify_all()
+
+
+limiter = None
+
+
+def set_limit(mbytes_per_sec):
+    ''' set the budget in MB/s shared by all transfers, 0 or None for no limit '''
+
+    global limiter
+
+    if not mbytes_per_sec:
+        if limiter:
+            logger.info('bandwidth limit off')
+        limiter = None
+        return
+
+    rate = float(mbytes_per_sec) * 1024 * 1024
+    if limiter and limiter.rate == rate:
+        return
+
+    limiter = TokenBucket(rate)
+    logger.info('bandwidth limit for transfers set to %s MB/s' % mbytes_per_sec)
+
+
+def get_limit():
+    ''' returns the limit in MB/s, or None '''
+    if limiter:
+        return limiter.rate / (1024 * 1024)
+    return None
+
+
+def consume(nbytes):
+    ''' draw nbytes of bulk transfer from the budget, waiting if needed '''
+    bucket = limiter
+    if bucket and nbytes > 0:
+        bucket.consume(nbytes)
+
+
+def consume_interactive(nbytes):
+    bucket = limiter
+    if bucket and nbytes > 0:
+        bucket.consume_interactive(nbytes)
+
+
+def refund(nbytes):
+    bucket = limiter
+    if bucket and nbytes > 0:
+        bucket.refund(nbytes)
+
+
+def max_request(nbytes):
+    ''' nbytes, capped to what the budget allows at once, so a request sent ahead of its data 
+        never puts the bucket in debt '''
+    bucket = limiter
+    if bucket:
+        return max(1, min(nbytes, int(bucket.burst)))
+    return nbytes
+
+
+class ThrottledFile(object):
+    ''' 
+    wraps a file like object (e.g. a channel file) so reads and writes draw from the budget.
+    Tokens are taken before the data moves, and returned for a short read
+    '''
+
+    def __init__(self, fileobj, progress=None):
+        self.fileobj = fileobj
+        self.progress = progress
+        self.done = 0
+
+    def transferred(self, nbytes):
+        consume(nbytes)
+        self.done += nbytes
+        if self.progress:
+            self.progress(self.done, 0)
+
+    def write(self, data):
+        self.transferred(len(data))
+        return self.fileobj.write(data)
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            data = self.fileobj.read(size)
+            self.transferred(len(data))
+            return data
+
+        consume(size)
+        data = self.fileobj.read(size)
+        refund(size - len(data))
+        self.done += len(data)
+        if self.progress:
+            self.progress(self.done, 0)
+        return data
+
+    def flush(self):
+        return self.fileobj.flush()
+
+    def close(self):
+        return self.fileobj.close()
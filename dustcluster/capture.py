@@ -0,0 +1,230 @@
+# Copyright (c) Ran Dugal 2014
+#
+# This file is part of dust.
+#
+# Licensed under the GNU Affero General Public License v3, which is available at
+# http://www.gnu.org/licenses/agpl-3.0.html
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero GPL for more details.
+#
+
+''' append only, compressed store of the output of every node for every command run '''
+
+import os
+import time
+import gzip
+import zlib
+import fcntl
+import fnmatch
+import Queue
+from threading import Thread
+
+from dustcluster.util import setup_logger
+logger = setup_logger( __name__ )
+
+
+# Layout under capture_dir:
+#   index       - one line per run:  run_id <tab> start time <tab> node names <tab> command line
+#   <run_id>.gz - gzip members appended as output arrives, one line per output line:
+#                 epoch time <tab> node name <tab> line
+#
+# Records are queued by the receive demux and written by a single writer thread, so the demux
+# never waits on disk. If the queue is full, records are dropped and counted rather than blocking.
+
+class CaptureStore(object):
+    ''' persist node output per run, and search it later '''
+
+    def __init__(self, capture_dir, max_runs=500, max_mb=200, max_queued=10000):
+        self.capture_dir = capture_dir
+        self.index_file = os.path.join(capture_dir, 'index')
+        self.max_runs = max_runs
+        self.max_bytes = max_mb * 1024 * 1024
+
+        self.queue = Queue.Queue(maxsize=max_queued)
+        self.dropped = 0
+        self.open_files = {} # { run_id : gzip file }
+
+        self.thread = Thread(target=self.write_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def new_run(self, cmdline, nodenames):
+        ''' allocate a run id and add it to the index, returns the run id '''
+
+        if not os.path.exists(self.capture_dir):
+            os.makedirs(self.capture_dir)
+
+        with open(self.index_file, 'a+') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                fh.seek(0)
+                last_id = 0
+                for line in fh:
+                    if line.strip():
+                        last_id = int(line.split('\t', 1)[0])
+                run_id = last_id + 1
+                fh.seek(0, os.SEEK_END)
+                fh.write('%d\t%.3f\t%s\t%s\n' % (run_id, time.time(), ','.join(nodenames),
+                                                 cmdline.replace('\n', ' ')))
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+        return run_id
+
+    def record(self, run_id, nodename, text):
+        ''' queue output text from a node for writing, never blocks '''
+
+        if not run_id:
+            return
+
+        try:
+            self.queue.put_nowait( (run_id, time.time(), nodename, text) )
+        except Queue.Full:
+            self.dropped += 1
+
+    def shutdown(self):
+        self.queue.put(None)
+        self.thread.join(5)
+
+    def write_loop(self):
+        ''' writer thread '''
+
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+
+            try:
+                self.write(*item)
+
+                # flush whatever we have once the queue drains so it can be searched
+                if self.queue.empty():
+                    for fh in self.open_files.values():
+                        fh.flush()
+            except Exception, e:
+                logger.error('Error writing node output capture: %s' % e)
+
+        self.close_files()
+
+    def write(self, run_id, ts, nodename, text):
+
+        fh = self.open_files.get(run_id)
+        if not fh:
+            # a new run, close the older ones and apply retention limits
+            self.close_files()
+            self.prune()
+            fh = gzip.open(self.run_file(run_id), 'ab')
+            self.open_files[run_id] = fh
+
+        if isinstance(text, unicode):
+            text = text.encode('utf-8')
+
+        for line in text.splitlines():
+            if line.strip():
+                fh.write('%.3f\t%s\t%s\n' % (ts, nodename, line))
+
+    def close_files(self):
+        for fh in self.open_files.values():
+            fh.close()
+        self.open_files = {}
+
+    def run_file(self, run_id):
+        return os.path.join(self.capture_dir, '%d.gz' % int(run_id))
+
+    def prune(self):
+        ''' delete the oldest runs beyond max_runs or max_mb '''
+
+        runs = self.runs()
+        sizes = [os.path.getsize(self.run_file(run[0])) if os.path.exists(self.run_file(run[0])) else 0
+                    for run in runs]
+
+        total = sum(sizes)
+        drop = 0
+        while drop < len(runs) and (len(runs) - drop > self.max_runs or total > self.max_bytes):
+            total -= sizes[drop]
+            drop += 1
+
+        if not drop:
+            return
+
+        logger.debug('Pruning %d runs from node output captures' % drop)
+
+        for run in runs[:drop]:
+            if os.path.exists(self.run_file(run[0])):
+                os.remove(self.run_file(run[0]))
+
+        with open(self.index_file, 'r+') as fh:
+            fcntl.flock(fh, fcntl.LOCK_EX)
+            try:
+                dropped_ids = set(str(run[0]) for run in runs[:drop])
+                lines = [line for line in fh if line.split('\t', 1)[0] not in dropped_ids]
+                fh.seek(0)
+                fh.truncate()
+                fh.writelines(lines)
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def runs(self, nodename=None, since=None):
+        ''' returns [(run_id, start_time, [nodenames], cmdline)], oldest first.
+            answered from the index alone: nodename (wildcards ok) keeps the runs on a matching node,
+            since (epoch time) keeps the runs started at or after it '''
+
+        ret = []
+        if not os.path.exists(self.index_file):
+            return ret
+
+        with open(self.index_file, 'r') as fh:
+            for line in fh:
+                fields = line.rstrip('\n').split('\t', 3)
+                if len(fields) != 4:
+                    continue
+                run_id, start_time, nodenames, cmdline = fields
+                start_time = float(start_time)
+                if since and start_time < since:
+                    continue
+                nodenames = nodenames.split(',')
+                if nodename and not any(fnmatch.fnmatchcase(name, nodename) for name in nodenames):
+                    continue
+                ret.append( (int(run_id), start_time, nodenames, cmdline) )
+
+        return ret
+
+    def read(self, run_id, nodename=None):
+        ''' generator over (time, nodename, line) captured for a run, nodename can have wildcards '''
+
+        run_file = self.run_file(run_id)
+        if not os.path.exists(run_file):
+            return
+
+        for line in self._read_lines(run_file):
+            fields = line.split('\t', 2)
+            if len(fields) != 3:
+                continue
+            if nodename and not fnmatch.fnmatchcase(fields[1], nodename):
+                continue
+            yield float(fields[0]), fields[1], fields[2]
+
+    def _read_lines(self, run_file):
+        ''' decompress a run file member by member. unlike GzipFile, this reads up to the last
+            flush of a member that is still being written '''
+
+        decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        pending = ''
+        with open(run_file, 'rb') as fh:
+            while True:
+                chunk = fh.read(64 * 1024)
+                if not chunk:
+                    break
+                while chunk:
+                    pending += decomp.decompress(chunk)
+                    chunk = decomp.unused_data
+                    if chunk:
+                        # start of the next gzip member
+                        decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+
+                lines = pending.split('\n')
+                pending = lines.pop()
+                for line in lines:
+                    yield line
@@ -15,14 +15,17 @@ Cloud cluster class
 '''
 
 import time
-import re
-import fnmatch
 import os
 import yaml
 
 from copy import deepcopy
 
 from dustcluster.lineterm import LineTerm
+from dustcluster.capture import CaptureStore
+from dustcluster.invcache import InventoryCache
+from dustcluster.inventory import NodeTable
+from dustcluster import target
+from dustcluster import bandwidth
 from pkgutil import walk_packages
 from dustcluster import commands
 
@@ -31,7 +34,7 @@ logger = setup_logger( __name__ )
 
 import glob
 
-from dustcluster.EC2 import EC2Cloud
+from dustcluster.EC2 import EC2Cloud, OfflineError
 
 
 class CommandState(object):
@@ -56,11 +59,13 @@ class Cluster(object):
     This object is accessible from all commands. 
     '''
 
-    def __init__(self, config_data):
+    def __init__(self, config_data, offline=False):
 
         self.cloud = None
         self.nodecache = dict() # invalidated on load template/start/stop/terminate/etc
+        self.current_nodes = None   # (inventory, cluster, NodeTable) of the last cluster assigned nodes
         self.region = None
+        self.offline = offline      # no API calls for the inventory, use the disk cache at any age
 
         self.dust_config_data = config_data
         self.user_data = None
@@ -70,15 +75,22 @@ class Cluster(object):
         self.validate_config()
         self.init_default_provider(config_data)
 
-        self._commands = {}
-        self.command_state = CommandState()
-        self.lineterm = LineTerm()
-
         self.user_dir = os.path.expanduser('~')
         self.dust_dir = os.path.join(self.user_dir, '.dustcluster')
         self.clusters_dir = os.path.join(self.dust_dir, 'clusters')
         self.user_data_file = os.path.join(self.dust_dir, 'user_data')
         self.default_keys_dir = os.path.join(self.dust_dir, 'keys')
+        self.captures_dir = os.path.join(self.dust_dir, 'captures')
+        self.inventory_dir = os.path.join(self.dust_dir, 'cache')
+
+        self._commands = {}
+        self.command_state = CommandState()
+        self.capture = CaptureStore(self.captures_dir,
+                                    max_runs=int(config_data.get('capture_max_runs') or 500),
+                                    max_mb=int(config_data.get('capture_max_mb') or 200))
+        self.lineterm = LineTerm(self.capture)
+        self.inventory_cache = InventoryCache(self.inventory_dir, ttl=int(config_data.get('inventory_ttl') or 300))
+        self.apply_bandwidth_limit()
 
         self.clusters = {}
         self.read_all_clusters()
@@ -91,10 +103,21 @@ class Cluster(object):
                 logger.error("Config data [%s] is missing [%s] key" % (str(self.dust_config_data.keys()), s))
                 raise Exception("Bad config.")
 
-    def invalidate_cache(self):
+    def invalidate_cache(self, persisted=True):
+        '''
+        drop the cached nodes of the current region, and the disk cache too unless persisted is False 
+        (nothing changed in the cloud) or dust is offline (the disk cache is all there is)
+        '''
 
-        if self.nodecache.get(self.cloud.region):
-            del self.nodecache[self.cloud.region]
+        # the full region inventory is keyed by region, pushed down queries by (region, filters)
+        for key in self.nodecache.keys():
+            if key == self.cloud.region or (isinstance(key, tuple) and key[0] == self.cloud.region):
+                del self.nodecache[key]
+
+        if persisted and not self.offline:
+            self.inventory_cache.remove(self.cloud.region)
+
+        self.current_nodes = None
 
     def load_commands(self):
         '''
@@ -215,6 +238,7 @@ class Cluster(object):
             raise Exception("No 'cloud:' section in template")
 
         self.init_cloud_provider(cloud_data)
+        self.apply_bandwidth_limit()
 
         cluster_nodes = self.get_current_nodes()
 
@@ -236,6 +260,31 @@ class Cluster(object):
 
         logger.debug('Switched to cluster config %s with %s nodes' % (cluster_name, len(cluster_config_data.get('nodes', [])) ))
 
+        self.prewarm_sessions([node for node in cluster_nodes if node.get('state') == 'running'])
+
+    def prewarm_sessions(self, nodes):
+        '''
+        if prewarm_sessions is set in the dust config, log in to nodes in the background
+        only nodes with a known keyfile are logged in to, this never prompts
+        '''
+
+        if str(self.dust_config_data.get('prewarm_sessions', '')).lower() not in ('1', 'yes', 'true', 'on'):
+            return
+
+        keymap = self.get_user_data('ec2-key-mapping') or {}
+
+        node_keyfiles = []
+        for node in nodes:
+            if not node.hydrated:
+                continue
+            keyfile = node.keyfile or keymap.get("%s#%s" % (self.cloud.region, node.key))
+            if keyfile:
+                node_keyfiles.append( (node, keyfile) )
+
+        if node_keyfiles:
+            logger.debug('prewarming ssh sessions to %d nodes' % len(node_keyfiles))
+            self.lineterm.prewarm(node_keyfiles)
+
 
     def init_cloud_provider(self, cloud_data):
 
@@ -256,7 +305,7 @@ class Cluster(object):
             cloud_provider = self.provider_cache.get(key) 
 
             if not cloud_provider:
-                cloud_provider = EC2Cloud(creds_map=self.dust_config_data, region=cloudregion)
+                cloud_provider = EC2Cloud(creds_map=self.dust_config_data, region=cloudregion, offline=self.offline)
                 cloud_provider.connect()
                 self.provider_cache[key] = cloud_provider
         else:
@@ -276,7 +325,22 @@ class Cluster(object):
     def unload_cur_cluster(self):
         ''' unload a cluster template ''' 
         self.cur_cluster = ""
-        self.invalidate_cache()
+        self.invalidate_cache(persisted=False)
+        self.apply_bandwidth_limit()
+
+    def apply_bandwidth_limit(self):
+        ''' 
+        set the transfer bandwidth budget from bandwidth_limit (MB/s) in the current cluster's config, 
+        or else from bandwidth_limit in the dust config
+        '''
+
+        limit = self.dust_config_data.get('bandwidth_limit')
+
+        if self.cur_cluster:
+            cluster_props = self.clusters[self.cur_cluster].get('cluster') or {}
+            limit = cluster_props.get('bandwidth_limit', limit)
+
+        bandwidth.set_limit(float(limit) if limit else None)
 
 
     def get_default_key(self):
@@ -350,6 +414,13 @@ class Cluster(object):
         startColorCyan  = "\033[0;36;40m"
         endColor        = "\033[0m"
 
+        if extended == 2:
+            if self.offline:
+                logger.warning("Offline, showing the cached fields only.")
+                extended = 1
+            else:
+                self.cloud.fetch_vms(nodes)
+
         try:
             header_data, header_fmt = nodes[0].disp_headers()
 
@@ -395,73 +466,9 @@ class Cluster(object):
             print endColor
 
 
-    def _filter_tags(self, tags, fkey, fval):
-
-        keyregex = fnmatch.translate(fkey)
-        keymatch = re.compile(keyregex)
-
-        valregex = fnmatch.translate(fval)
-        valmatch = re.compile(valregex)
-
-        # match tag keys, then vals
-        for tagkey, tagval in tags.items():
-            if keymatch.match(tagkey) and valmatch.match(tagval):
-                return True
-
-        return False
-
-
-    def _filter(self, nodes, filterkey, filterval):
-        '''
-        filter a list of nodes by attribute values
-        e.g. filterkey=state,  filterval=running
-        '''
-
-        filtered = []
-
-        if not filterkey:
-            return nodes
-
-        if filterkey == "tags":
-
-            fkey = ""
-            fval = ""
-
-            pos = filterval.rfind(':')
-            if pos:
-                fval = filterval[pos+1:]
-                fkey = filterval[:pos]
-
-                if fkey[0] == '"' and fkey[-1] == '"':
-                    fkey = fkey[1:-1]
-
-            if not fkey and not fval:
-                logger.error("Bad filter. Use tags=key:value, wildcards allowed on key, value.")
-                return []
-
-            for node in nodes:
-                if self._filter_tags(node.get('tags'), fkey, fval):
-                    filtered.append(node)
-
-        else:
-
-            regex = fnmatch.translate(filterval)
-            valid = re.compile(regex)
-
-            for node in nodes:
-                val =  node.get(filterkey)
-                if not val:
-                    continue
-                logger.debug("trying filter %s on %s..." % (filterval, val))
-                if not valid.match(val):
-                    continue
-                filtered.append(node)
-
-        return filtered
-
-
-    def _find_matching_node(self, node_props, cluster_nodes):
-        ''' using node_props.selector, find the matching node in cluster_nodes ''' 
+    def _find_matching_node(self, node_props, inventory, cluster_rows):
+        ''' using node_props.selector, find the matching nodes among cluster_rows of the inventory NodeTable.
+            exact selectors like tags=name:worker12 or id=i-.. are a lookup in the inventory's indexes ''' 
 
         # filter by node filter
         filter_value = node_props.get('selector')
@@ -473,14 +480,29 @@ class Cluster(object):
             filterkey, filterval = "tags", "name:%s" % nodename
 
         logger.debug("matching template node filters [%s=%s]to cluster nodes" % (filterkey, filterval))
-        matching_nodes = self._filter(cluster_nodes, filterkey, filterval)
+        matching_nodes = inventory.select(inventory.match(filterkey, filterval) & cluster_rows)
 
         return matching_nodes
 
-    def get_current_nodes(self):
+    def get_current_nodes(self, target_filters=None):
         ''' same as get_current_nodes_by_cluster but flattens the map ''' 
+        return list(self.get_current_table(target_filters).nodes)
+
 
-        cur_nodes = self.get_current_nodes_by_cluster()
+    def get_current_table(self, target_filters=None):
+        ''' 
+        NodeTable of the flattened get_current_nodes_by_cluster. The last one is kept until the cache is invalidated,
+        the current cluster changes, or the inventory it was built from is no longer cached
+        '''
+
+        inventory = self.get_cloud_nodes(self.api_filters(target_filters))
+
+        if self.current_nodes:
+            cached_inventory, cached_cluster, table = self.current_nodes
+            if cached_inventory is inventory and cached_cluster == self.cur_cluster:
+                return table
+
+        cur_nodes = self.get_current_nodes_by_cluster(target_filters, inventory)
 
         # flatten
         ret_nodes = []
@@ -489,27 +511,23 @@ class Cluster(object):
 
         ret_nodes = sorted(ret_nodes, key =lambda x: x.cluster)
 
-        return ret_nodes
+        table = NodeTable(ret_nodes)
+        self.current_nodes = (inventory, self.cur_cluster, table)
+        return table
 
 
-    def get_current_nodes_by_cluster(self):
+    def get_current_nodes_by_cluster(self, target_filters=None, inventory=None):
         ''' 
             return nodes matched to all clusters in this region
             if nodes are in the cluster config but not in the cloud, it creates nodes in state "absent"
+            target_filters are DescribeInstances filters for the target, see api_filters
+            inventory is the NodeTable of cloud nodes, if already fetched
             returns { clustername : (nodes, absentnodes) }
         '''
 
-        startColorGreen = "\033[0;32;40m"
-        endColor        = "\033[0m"
-
-        nodecache_nodes = self.nodecache.get(self.cloud.region)    
-        if nodecache_nodes:
-            logger.info("Retrieved [%d] nodes %sfrom cache%s" % (len(nodecache_nodes), startColorGreen, endColor))
-            nodes = nodecache_nodes
-        else:
-            nodes = self.cloud.refresh()
-            logger.info("Retrieved [%d] nodes %sfrom cloud provider%s" % (len(nodes), startColorGreen, endColor))
-            self.nodecache[self.cloud.region] = nodes
+        if inventory is None:
+            inventory = self.get_cloud_nodes(self.api_filters(target_filters))
+        nodes = inventory.nodes
 
         clusters = []
         if self.cur_cluster:
@@ -525,7 +543,8 @@ class Cluster(object):
         # iterate through configured clusters
         for cluster_name in clusters:
 
-            cluster_nodes = self.get_cluster_nodes(nodes, cluster_name)
+            cluster_rows = self.get_cluster_rows(inventory, cluster_name)
+            cluster_nodes = inventory.select(cluster_rows)
 
             for node in cluster_nodes:
                 node.cluster = cluster_name
@@ -535,7 +554,7 @@ class Cluster(object):
             cluster_node_props = cluster.get('nodes')
 
             for node_props in cluster_node_props:
-                matched_nodes = self._find_matching_node(node_props, cluster_nodes)
+                matched_nodes = self._find_matching_node(node_props, inventory, cluster_rows)
 
                 logger.debug("Found %s matching nodes for %s:%s", len(matched_nodes), 
                                         cluster_name, node_props.get('selector'))
@@ -580,12 +599,92 @@ class Cluster(object):
         return ret_nodes
 
 
-    def get_cluster_nodes(self, nodes, cluster_name):
-        ''' filter nodes by cluster filter '''
+    def get_cloud_nodes(self, filters=None):
+        '''
+        NodeTable of the nodes in this region from the cache or the cloud provider. With DescribeInstances filters, 
+        only the matching nodes are fetched, unless the full region inventory is already cached
+        '''
+
+        startColorGreen = "\033[0;32;40m"
+        endColor        = "\033[0m"
+
+        cache_key = self.cloud.region
+        nodecache_nodes = self.nodecache.get(cache_key)
+        if nodecache_nodes is None and filters:
+            cache_key = (self.cloud.region, tuple(sorted(filters.items())))
+            nodecache_nodes = self.nodecache.get(cache_key)
+
+        if nodecache_nodes is not None:
+            logger.info("Retrieved [%d] nodes %sfrom cache%s" % (len(nodecache_nodes), startColorGreen, endColor))
+            return nodecache_nodes
+
+        # the full region inventory on disk answers any filters too
+        for cache_filters in ([None, filters] if filters else [None]):
+            nodes = self.load_cloud_nodes(cache_filters)
+            if nodes is not None:
+                self.nodecache[cache_key if cache_filters else self.cloud.region] = nodes
+                return nodes
+
+        if self.offline:
+            logger.error("Offline, and no cached nodes for region %s. Run dust once without --offline." %
+                         self.cloud.region)
+            return NodeTable([])
+
+        nodes = NodeTable(self.cloud.refresh(filters))
+        logger.info("Retrieved [%d] nodes %sfrom cloud provider%s" % (len(nodes), startColorGreen, endColor))
+        self.nodecache[cache_key] = nodes
+        self.inventory_cache.save(self.cloud.region, filters, self.cloud.record_fields, 
+                                  self.cloud.node_records(nodes.nodes))
+
+        return nodes
+
+    def load_cloud_nodes(self, filters=None):
+        ''' NodeTable of the nodes saved on disk for filters, any age will do when offline. None if not cached '''
+
+        startColorGreen = "\033[0;32;40m"
+        endColor        = "\033[0m"
+
+        cached = self.inventory_cache.load(self.cloud.region, filters, self.cloud.record_fields, any_age=self.offline)
+        if not cached:
+            return None
+
+        records, saved_time = cached
+        nodes = NodeTable(self.cloud.nodes_from_records(records))
+        logger.info("Retrieved [%d] nodes %sfrom disk cache%s (%ds old)" % (len(nodes), startColorGreen, 
+                                                                          endColor, time.time() - saved_time))
+        return nodes
+
+
+    def api_filters(self, target_filters=None):
+        '''
+        DescribeInstances filters for the current cluster's filter and target_filters combined,
+        or None to fetch every node in the region. Without a current cluster all nodes are needed 
+        to sort them into clusters and Unassigned, so only the target is pushed down.
+        '''
+
+        filters = {}
+
+        if self.cur_cluster:
+            filterkey, filterval = self.cluster_filter(self.cur_cluster)
+            cluster_filters = self.cloud.api_filters(filterkey, filterval)
+            if cluster_filters:
+                filters.update(cluster_filters)
+
+        for name, value in (target_filters or {}).items():
+            if filters.get(name, value) != value:
+                # the same filter with two values would be OR'd by the API
+                logger.debug("not pushing down %s=%s, already filtering on %s" % (name, value, filters[name]))
+                continue
+            filters[name] = value
+
+        return filters or None
+
+
+    def cluster_filter(self, cluster_name):
+        ''' the (key, val) filter that selects a cluster's nodes '''
 
         cur_cluster_config = self.clusters.get(cluster_name)
 
-        # filter by cluster filter
         filterkey, filterval = "", ""
 
         if cur_cluster_config.get('cluster'):
@@ -602,10 +701,20 @@ class Cluster(object):
             else:
                 raise Exception("Cluster template must have a name or a filter of the form key=val. Got [%s]" % cluster_filter)
 
+        return filterkey, filterval
+
+
+    def get_cluster_rows(self, inventory, cluster_name):
+        ''' the set of rows of the inventory NodeTable that the cluster filter matches '''
+
+        # filter by cluster filter
+        filterkey, filterval = self.cluster_filter(cluster_name)
+
         logger.debug("Filtering to cluster with %s=%s" % (filterkey, filterval)) 
-        cluster_nodes = self._filter(nodes, filterkey, filterval)
+        if not filterkey:
+            return set(range(len(inventory)))
 
-        return cluster_nodes
+        return inventory.match(filterkey, filterval)
 
 
     def resolve_target_nodes(self, op='operation', target_node_name=None):
@@ -616,34 +725,33 @@ class Cluster(object):
         if not self.cloud:
             raise Exception('Internal error: No cloud provider loaded.')
 
-        cluster_nodes = self.get_current_nodes()
-
         # filter by target string 
-        # target string can be a name wildcard or filter expression with wildcards
+        # target string can be a name wildcard, filter expression with wildcards, or a boolean 
+        # expression of those (see dustcluster.target)
 
-        if target_node_name == '*':
-            return cluster_nodes
+        if not target_node_name or target_node_name == '*':
+            return self.get_current_nodes()
 
-        filterkey, filterval = "", ""
-        if target_node_name:
-            if '=' in target_node_name:
-                filterkey, filterval = target_node_name.split("=")
-            else:
-                filterkey, filterval = 'name', target_node_name
+        try:
+            expr = target.parse(target_node_name)
+        except target.TargetError, e:
+            logger.error("Bad target [%s]: %s" % (target_node_name, e))
+            return []
 
-        if filterkey and filterval:
-            target_nodes  = self._filter(cluster_nodes, filterkey, filterval)
-        else:
-            target_nodes = cluster_nodes
+        # fetch only what the target can match, the expression below still applies to the result
+        cluster_table = self.get_current_table(expr.api_filters(self))
+
+        try:
+            target_nodes = cluster_table.select(expr.rows(cluster_table))
+        except OfflineError, e:
+            logger.error("Cannot resolve target [%s]: %s" % (target_node_name, e))
+            return []
 
         if op:
-            if filterkey:
-                logger.debug( "invoking %s on nodes where %s=%s" % (op, filterkey, filterval) )
-            else:
-                logger.debug( "invoking %s on all cluster nodes" % op )
+            logger.debug( "invoking %s on nodes where %r" % (op, expr) )
 
         if not target_nodes:
-            logger.info( 'no nodes found that match filter %s=%s' % (filterkey, filterval) )
+            logger.info( 'no nodes found that match %s' % target_node_name )
 
         return target_nodes
 
@@ -681,3 +789,4 @@ class Cluster(object):
 
     def logout(self):
         self.lineterm.shutdown()
+        self.capture.shutdown()
@@ -12,6 +12,9 @@
 
 import yaml
 
+from dustcluster import hostlist
+from dustcluster.target import split_target
+
 '''
 dust command for invoking ssh operations on a set of nodes, or entering a raw ssh shell to a single node 
 '''
@@ -46,20 +49,20 @@ def atssh(cmdline, cluster, logger):
     is_error = False
 
     try:
-        target = cmdline.split()[0]
+        target, sshcmd = split_target(cmdline)
 
         target_nodes = cluster.running_nodes_from_target(target)
         if not target_nodes:
             return
 
-        sshcmd = cmdline[len(target):].strip()
-
         if sshcmd:
-            logger.info( 'running [%s] over ssh on nodes: %s' % (sshcmd,  str([node.name for node in target_nodes])) )
+            node_names = hostlist.compress(node.name for node in target_nodes)
+            logger.info( 'running [%s] over ssh on nodes: %s' % (sshcmd, node_names) )
+            run_id = cluster.lineterm.new_run(sshcmd, target_nodes)
             for node in target_nodes:
                 keyfile = _get_key_file(node, cluster, logger)
                 if keyfile:
-                    cluster.lineterm.command(keyfile, node, sshcmd)
+                    cluster.lineterm.command(keyfile, node, sshcmd, run_id)
         else:
             if len(target_nodes) > 1: 
                 logger.info( 'Raw shell support is for single host targets only. See help atssh' )
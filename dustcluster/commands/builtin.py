@@ -58,6 +58,8 @@ def refresh(cmdline, cluster, logger):
     refresh [filter]  - refresh from cloud and call show with filter
 
     Note that some operations (start/stop/etc) cause a refresh to occur on the next show.
+    The node list is also cached on disk in ~/.dustcluster/cache for inventory_ttl seconds (default 300)
+    set in ~/.dustcluster/config. dust --offline uses it at any age and makes no API calls to list nodes.
     '''
 
 
@@ -72,6 +74,10 @@ def start(cmdline, cluster, logger):
     none    --- Start all nodes defined in the cluster, idempotently
     target  --- A node name or filter expression (see help filters) 
                 Node names and filter values can be regular expressions.
+                Combine them with & | ! and parens, e.g. "cluster:etl & !tags=role:master"
+
+    Set prewarm_sessions = yes in ~/.dustcluster/config to log in to the nodes 
+    in the background once they are up.
 
     Example:
     start worker1
@@ -101,6 +107,8 @@ def start(cmdline, cluster, logger):
 
             node.start()
 
+        cluster.prewarm_sessions(target_nodes)
+
     except Exception, e:
         logger.exception('Error: %s' % e)
         return
@@ -117,6 +125,7 @@ def stop(cmdline, cluster, logger):
     none    --- Stop all nodes defined in the cluster, idempotently
     target  --- A node name or filter expression (see help filters) 
                 Node names and filter values can be regular expressions.
+                Combine them with & | ! and parens, e.g. "cluster:etl & !tags=role:master"
 
     Example:
     stop failover1
@@ -135,6 +144,7 @@ def terminate(cmdline, cluster, logger):
     none    --- Terminate all nodes defined in the cluster, idempotently
     target  --- A node name or filter expression (see help filters) 
                 Node names and filter values can be regular expressions.
+                Combine them with & | ! and parens, e.g. "cluster:etl & !tags=role:master"
 
     Example:
     terminate failover1
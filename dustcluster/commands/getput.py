@@ -12,38 +12,66 @@
 
 ''' dust command for getting and putting files from/to a set of nodes '''
 
+import os
 import glob
 
+from dustcluster import transfer, bandwidth
+from dustcluster.target import split_target
+from dustcluster.commands.atssh import _get_key_file
+
 # export commands
 
-commands = ['put', 'get']
+commands = ['put', 'get', 'gather', 'bwlimit']
 
 def put(cmdline, cluster, logger):
     '''
-    put tgt src [dest] - upload src file to a set of target nodes
+    put tgt src [dest] [-r] [-z|-Z] [--tree] [-j workers] - upload src file to a set of target nodes
 
     Notes:
     src can have wildcards
+    Nodes are uploaded to concurrently, by up to [workers] threads (default: transfer_workers in 
+    ~/.dustcluster/config, or 10)
+    With -r, src is a directory that is sent to the dest directory as one tar stream. The stream is 
+    gzipped on slow links, -z to always compress, -Z to never compress.
+    With --tree, src is uploaded once to one node, and the nodes then copy it to each other over the 
+    private network (preferring the same zone), doubling the number of copies every round. The nodes need
+    python, and must be able to reach each other on tcp ports 20000-30000.
+    Files are sent in chunks and checked against an md5 computed on each node. If a node's connection drops,
+    the upload resumes from the last completed chunk, and an interrupted put resumes if run again.
 
     Examples:
     put worker* /opt/data/data.txt  # uploads data.txt to home dir
     put worker* /opt/data/data.txt /opt/data/data.txt
     put worker* /opt/data/*.txt     # wildcards work
+    put * /opt/data/big.dat -j 50
+    put worker* ./src /opt/app -r   # uploads the tree ./src to /opt/app/src
+    put * ./dataset.tar.gz --tree   # upload once, spread over the cluster network
     '''
+    usage = "usage: put target src [dest] [-r] [-z|-Z] [--tree] [-j workers]"
+
     if not cmdline or len(cmdline) < 2:
-        logger.error("usage: put target src [dest]")
+        logger.error(usage)
         return
 
-    target = cmdline.split()[0]
+    target, args = split_target(cmdline)
 
-    target_nodes = cluster.running_nodes_from_target(target)
-    if not target_nodes:
+    arrargs = args.split()
+    try:
+        workers = transfer.get_workers(arrargs, cluster)
+    except (IndexError, ValueError):
+        logger.error(usage)
         return
 
-    args = cmdline[len(target):].strip()
+    compress = transfer.get_compress(arrargs)
+
+    recursive = '-r' in arrargs
+    if recursive:
+        arrargs.remove('-r')
+
+    tree = '--tree' in arrargs
+    if tree:
+        arrargs.remove('--tree')
 
-    arrargs = args.split()
-    
     srcfile = None
     destfile = None
 
@@ -53,37 +81,108 @@ def put(cmdline, cluster, logger):
     if len(arrargs) > 1:
         destfile = arrargs[1]
 
-    for node in target_nodes:
-        for fname in glob.iglob(srcfile): 
-            cluster.lineterm.put(cluster.cloud.keyfile, node, fname, destfile)
+    if not srcfile:
+        logger.error(usage)
+        return
+
+    srcfiles = sorted(glob.glob(srcfile))
+    if not srcfiles:
+        logger.error('file does not exist locally : %s' % srcfile)
+        return
+
+    target_nodes = cluster.running_nodes_from_target(target)
+    if not target_nodes:
+        return
+
+    if recursive:
+        srcdirs = [fname for fname in srcfiles if os.path.isdir(fname)]
+        if not srcdirs:
+            logger.error('no directory matches %s' % srcfile)
+            return
+
+        summary = transfer.TransferSummary()
+
+        def put_dir(node, keyfile, srcdir):
+            transfer.put_tree(cluster.lineterm, node, keyfile, srcdir, destfile or '.', compress,
+                                progress=summary.progress(node.name, srcdir))
+
+        node_jobs = _node_jobs(target_nodes, srcdirs, cluster, logger)
+        transfer.for_each_node(node_jobs, put_dir, workers, summary)
+        summary.log('put', cluster.capture, cmdline)
+        return
+
+    node_jobs = _node_jobs(target_nodes, srcfiles, cluster, logger)
+    state_dir = os.path.join(cluster.dust_dir, 'transfers')
+
+    if tree and len(node_jobs) > 1:
+        summary = transfer.TransferSummary()
+        node_keyfiles = [(node, keyfile) for node, keyfile, _ in node_jobs]
+        for fname in srcfiles:
+            transfer.tree_put(cluster.lineterm, node_keyfiles, fname, destfile, summary)
+        summary.log('put', cluster.capture, cmdline)
+        return
+
+    if len(node_jobs) > 1:
+        # same files to many nodes: read each file once and fan it out
+        summary = transfer.TransferSummary()
+        node_keyfiles = [(node, keyfile) for node, keyfile, _ in node_jobs]
+        for fname in srcfiles:
+            transfer.broadcast_put(cluster.lineterm, node_keyfiles, fname, destfile, workers, summary, state_dir)
+        summary.log('put', cluster.capture, cmdline)
+        return
+
+    summary = transfer.TransferSummary()
+
+    def put_file(node, keyfile, fname):
+        transfer.resumable_put(cluster.lineterm, node, keyfile, fname, destfile, 
+                                progress=summary.progress(node.name, fname), state_dir=state_dir)
+
+    transfer.for_each_node(node_jobs, put_file, workers, summary)
+    summary.log('put', cluster.capture, cmdline)
 
 
 def get(cmdline, cluster, logger):
     '''
-    get tgt remotefile [localdir] - download remotefile from a set of nodes to [localdir] or cwd as remotefile.nodename
+    get tgt remotefile [localdir] [-r] [-z|-Z] [-j workers] - download remotefile from a set of nodes
 
     Notes:
+    Each node's copy is saved to [localdir] or cwd as remotefile.nodename
     remotefile can be a wildcard 
+    Nodes are downloaded from concurrently, by up to [workers] threads (default: transfer_workers in 
+    ~/.dustcluster/config, or 10)
+    With -r, remotefile is a directory that is fetched as one tar stream into [localdir]/nodename/. 
+    The stream is gzipped on slow links, -z to always compress, -Z to never compress.
     
     Example:
     get worker* /opt/output/*.txt        # download to cwd
     get worker* /opt/output/*.txt /tmp   # download to /tmp
+    get worker* /opt/output /tmp -r      # download to /tmp/worker1/output, /tmp/worker2/output, ..
     '''
 
+    usage = "usage: get target remotefile [localdir] [-r] [-z|-Z] [-j workers]"
+
     if not cmdline or len(cmdline) < 2:
-        logger.error("usage: get target remotefile [localdir]")
+        logger.error(usage)
         return
 
-    target = cmdline.split()[0]
+    target, args = split_target(cmdline)
 
-    target_nodes = cluster.running_nodes_from_target(target)
-    if not target_nodes:
-        logger.info('no running nodes match %s' % target)
+    arrargs = args.split()
+    try:
+        workers = transfer.get_workers(arrargs, cluster)
+    except (IndexError, ValueError):
+        logger.error(usage)
         return
 
-    args = cmdline[len(target):].strip()
+    compress = transfer.get_compress(arrargs)
 
-    arrargs = args.split()
+    recursive = '-r' in arrargs
+    if recursive:
+        arrargs.remove('-r')
+
+    if not arrargs:
+        logger.error(usage)
+        return
 
     remotefile = None
     localdir = None
@@ -93,8 +192,181 @@ def get(cmdline, cluster, logger):
     if len(arrargs) > 1:
         localdir = arrargs[1]
 
-    for node in target_nodes:
-        cluster.lineterm.get(cluster.cloud.keyfile, node, remotefile, localdir)
+    if localdir and not os.path.isdir(localdir):
+        logger.error('dir does not exist locally : %s' % localdir)
+        return
+
+    target_nodes = cluster.running_nodes_from_target(target)
+    if not target_nodes:
+        logger.info('no running nodes match %s' % target)
+        return
+
+    node_jobs = _node_jobs(target_nodes, [remotefile], cluster, logger)
+
+    summary = transfer.TransferSummary()
+
+    if recursive:
+        def get_dir(node, keyfile, remotedir):
+            transfer.get_tree(cluster.lineterm, node, keyfile, remotedir, localdir or '.', compress,
+                                progress=summary.progress(node.name, remotedir))
+
+        transfer.for_each_node(node_jobs, get_dir, workers, summary)
+        summary.log('get', cluster.capture, cmdline)
+        return
+
+    if not transfer.has_magic(remotefile):
+        def get_file(node, keyfile, remotefile):
+            cluster.lineterm.get(keyfile, node, remotefile, localdir, progress=summary.progress(node.name, remotefile))
 
+        transfer.for_each_node(node_jobs, get_file, workers, summary)
+        summary.log('get', cluster.capture, cmdline)
+        return
+
+    # expand the wildcard on every node, then download every match from every node concurrently
+    matches = {} # { nodename : [remote paths] }
+
+    def expand(node, keyfile, pattern):
+        matches[node.name] = transfer.expand_remote_glob(cluster.lineterm.sftp(keyfile, node), pattern)
+        if not matches[node.name]:
+            raise Exception('no files match %s' % pattern)
+
+    transfer.for_each_node(node_jobs, expand, workers, summary)
+
+    jobs = []
+    for node, keyfile, _ in node_jobs:
+        paths = matches.get(node.name, [])
+        basenames = [os.path.basename(path) for path in paths]
+        for path in paths:
+            localname = os.path.basename(path)
+            if basenames.count(localname) > 1:
+                # same file name in different remote dirs
+                localname = path.strip('/').replace('/', '_')
+            jobs.append( (node, keyfile, (path, localname)) )
+
+    logger.info('downloading %d files from %d nodes' % (len(jobs), len(matches)))
+
+    def get_match(node, keyfile, match):
+        path, localname = match
+        cluster.lineterm.get(keyfile, node, path, localdir, localname, progress=summary.progress(node.name, path))
+
+    transfer.for_each_file(jobs, get_match, workers, summary)
+    summary.log('get', cluster.capture, cmdline)
+
+
+def gather(cmdline, cluster, logger):
+    '''
+    gather tgt remotefile localfile [--sort col [-n]] [-t sep] [--no-prefix] - stream remotefiles into one localfile
+
+    Notes:
+    Lines are prefixed with the node name and a tab (or sep), unless --no-prefix.
+    Without --sort, the files are concatenated in node order.
+    With --sort col, each node's file must already be sorted on column col (1 based, split on whitespace 
+    or sep), and the files are merged in sorted order. -n compares the column as a number.
+    Nodes are read concurrently and nothing is written to disk except localfile.
+
+    Examples:
+    gather worker* /opt/output/counts.txt counts.txt
+    gather worker* /opt/output/part.csv all.csv --sort 1 -t , --no-prefix
+    gather * /var/log/app.log app.log --sort 1 
+    '''
+
+    usage = "usage: gather target remotefile localfile [--sort col [-n]] [-t sep] [--no-prefix]"
+
+    target, args = split_target(cmdline)
+    arrargs = args.split()
+
+    prefix = True
+    if '--no-prefix' in arrargs:
+        arrargs.remove('--no-prefix')
+        prefix = False
+
+    numeric = False
+    if '-n' in arrargs:
+        arrargs.remove('-n')
+        numeric = True
+
+    sort_col = None
+    sep = None
+    try:
+        if '--sort' in arrargs:
+            pos = arrargs.index('--sort')
+            sort_col = int(arrargs[pos+1])
+            del arrargs[pos:pos+2]
+            if sort_col < 1:
+                raise ValueError()
+
+        if '-t' in arrargs:
+            pos = arrargs.index('-t')
+            sep = arrargs[pos+1]
+            del arrargs[pos:pos+2]
+    except (IndexError, ValueError):
+        logger.error(usage)
+        return
+
+    if not target or len(arrargs) != 2:
+        logger.error(usage)
+        return
 
+    remotefile, localfile = arrargs
+
+    target_nodes = cluster.running_nodes_from_target(target)
+    if not target_nodes:
+        return
+
+    node_jobs = _node_jobs(target_nodes, [remotefile], cluster, logger)
+    node_keyfiles = [(node, keyfile) for node, keyfile, _ in node_jobs]
+
+    with open(localfile, 'wb') as outfh:
+        summary = transfer.gather(cluster.lineterm, node_keyfiles, remotefile, outfh, 
+                                    prefix=prefix, sort_col=sort_col, sep=sep, numeric=numeric)
+
+    summary.log('gather', cluster.capture, cmdline)
+    logger.info('wrote %s' % localfile)
+
+
+def bwlimit(cmdline, cluster, logger):
+    '''
+    bwlimit [MB/s | off] - show or set the bandwidth budget shared by all put/get/gather/sync transfers
+
+    Notes:
+    The budget is shared fairly by concurrent transfers to all nodes. Interactive ssh traffic is not held back,
+    transfers back off to make room for it.
+    The default comes from bandwidth_limit in ~/.dustcluster/config, and can be set per cluster with 
+    bandwidth_limit in the cluster: section of a cluster config. 
+
+    Examples:
+    bwlimit         # show the current limit
+    bwlimit 5       # limit transfers to 5 MB/s in total
+    bwlimit off
+    '''
+
+    arg = cmdline.strip().lower()
+
+    if not arg:
+        limit = bandwidth.get_limit()
+        if limit:
+            logger.info('bandwidth limit for transfers: %.2f MB/s' % limit)
+        else:
+            logger.info('no bandwidth limit for transfers')
+        return
+
+    if arg in ('off', '0', 'none'):
+        bandwidth.set_limit(None)
+        return
+
+    try:
+        bandwidth.set_limit(float(arg))
+    except ValueError:
+        logger.error("usage: bwlimit [MB/s | off]")
+
+
+def _node_jobs(target_nodes, items, cluster, logger):
+    ''' [(node, keyfile, items)] for nodes with a keyfile. keyfiles are looked up (and may be asked for) up front '''
+
+    node_jobs = []
+    for node in target_nodes:
+        keyfile = _get_key_file(node, cluster, logger)
+        if keyfile:
+            node_jobs.append( (node, keyfile, items) )
 
+    return node_jobs
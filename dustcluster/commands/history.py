@@ -0,0 +1,183 @@
+# Copyright (c) Ran Dugal 2014
+#
+# This file is part of dust.
+#
+# Licensed under the GNU Affero General Public License v3, which is available at
+# http://www.gnu.org/licenses/agpl-3.0.html
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero GPL for more details.
+#
+
+''' dust commands to browse and search the captured output of past ssh commands '''
+
+import re
+import time
+import shlex
+
+from dustcluster import hostlist
+
+# export commands
+commands = ['history', 'grep']
+
+
+def history(cmdline, cluster, logger):
+    '''
+    history [run_id [nodename]] - list past ssh command runs, or show the captured output of a run
+
+    Notes:
+    The output of every @ command on every node is saved (compressed) under ~/.dustcluster/captures
+    Set capture_max_runs and capture_max_mb in ~/.dustcluster/config to change retention (default 500 runs, 200 MB)
+    --node and --since list only the runs on matching nodes, or started in the last 30m, 2h, 1d etc.
+
+    Examples:
+    history                     # list the last 20 runs
+    history -n 100              # list the last 100 runs
+    history --node worker1      # list the last 20 runs on worker1
+    history --since 2h          # list the runs of the last 2 hours
+    history 42                  # show the output from all nodes for run 42
+    history 42 worker1          # show the output from worker1 for run 42
+    '''
+
+    usage = "usage: history [-n count] [--node nodename] [--since age] | [run_id [nodename]]"
+
+    args = cmdline.split()
+
+    count = 20
+    try:
+        if '-n' in args:
+            pos = args.index('-n')
+            count = int(args[pos+1])
+            del args[pos:pos+2]
+        nodename, since = _pop_filters(args)
+    except (IndexError, ValueError):
+        logger.error(usage)
+        return
+
+    if not args:
+        runs = cluster.capture.runs(nodename, since)
+        for run_id, start_time, nodenames, cmdline in runs[-count:]:
+            print "%6d  %s  %-40s %s" % (run_id, _fmt_time(start_time), cmdline, _fmt_nodes(nodenames))
+        return
+
+    try:
+        run_id = int(args[0])
+    except ValueError:
+        logger.error(usage)
+        return
+
+    runs = cluster.capture.runs()
+
+    nodename = args[1] if len(args) > 1 else None
+
+    if run_id not in [run[0] for run in runs]:
+        logger.error("No captured output for run %d" % run_id)
+        return
+
+    for ts, node, line in cluster.capture.read(run_id, nodename):
+        print "\033[1m[%s]\033[21m %s" % (node, line)
+
+
+def grep(cmdline, cluster, logger):
+    '''
+    grep [-i] pattern [run_id] - search the captured output of past ssh command runs
+
+    Notes:
+    pattern is a regular expression. Searches all retained runs, newest first, unless run_id is given.
+    --node and --since search only the runs on matching nodes, or started in the last 30m, 2h, 1d etc.
+    These are looked up in the run index, so the captures of other runs are not read.
+    Nothing is run on the cluster.
+
+    Examples:
+    grep error
+    grep -i "out of memory"
+    grep ^Filesystem 42
+    grep --node worker* --since 1d Traceback
+    '''
+
+    usage = "usage: grep [-i] [--node nodename] [--since age] pattern [run_id]"
+
+    args = shlex.split(cmdline)
+
+    try:
+        nodename, since = _pop_filters(args)
+    except (IndexError, ValueError):
+        logger.error(usage)
+        return
+
+    flags = 0
+    if args and args[0] == '-i':
+        flags = re.IGNORECASE
+        args = args[1:]
+
+    if not args:
+        logger.error(usage)
+        return
+
+    pattern = args[0]
+    run_ids = None
+    if len(args) > 1:
+        try:
+            run_ids = [int(args[1])]
+        except ValueError:
+            logger.error(usage)
+            return
+
+    try:
+        regex = re.compile(pattern, flags)
+    except re.error, e:
+        logger.error("Bad pattern %s: %s" % (pattern, e))
+        return
+
+    runs = cluster.capture.runs(nodename, since)
+    if run_ids:
+        runs = [run for run in runs if run[0] in run_ids]
+
+    matches = 0
+    for run_id, start_time, nodenames, run_cmdline in reversed(runs):
+        for ts, node, line in cluster.capture.read(run_id, nodename):
+            if regex.search(line):
+                print "%6d %s \033[1m[%s]\033[21m %s" % (run_id, _fmt_time(ts), node, line)
+                matches += 1
+
+    logger.info("%d matches in %d runs" % (matches, len(runs)))
+
+
+def _pop_filters(args):
+    ''' pop --node nodename and --since age from an argument list, returns (nodename, since epoch time) '''
+
+    nodename = since = None
+
+    if '--node' in args:
+        pos = args.index('--node')
+        nodename = args[pos+1]
+        del args[pos:pos+2]
+
+    if '--since' in args:
+        pos = args.index('--since')
+        since = time.time() - _parse_age(args[pos+1])
+        del args[pos:pos+2]
+
+    return nodename, since
+
+
+# seconds per unit of an age like 30m
+age_units = { 's' : 1, 'm' : 60, 'h' : 3600, 'd' : 86400 }
+
+def _parse_age(text):
+    ''' 90s, 30m, 2h, 1d or plain seconds -> seconds, raises ValueError '''
+
+    if text and text[-1] in age_units:
+        return float(text[:-1]) * age_units[text[-1]]
+    return float(text)
+
+
+def _fmt_time(ts):
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(ts))
+
+
+def _fmt_nodes(nodenames):
+    if len(nodenames) > 4:
+        return "%s (%d nodes)" % (hostlist.compress(nodenames), len(nodenames))
+    return hostlist.compress(nodenames)
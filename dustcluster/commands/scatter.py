@@ -0,0 +1,406 @@
+# Copyright (c) Ran Dugal 2014
+#
+# This file is part of dust.
+#
+# Licensed under the GNU Affero General Public License v3, which is available at
+# http://www.gnu.org/licenses/agpl-3.0.html
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero GPL for more details.
+#
+
+''' dust command to partition a local file or directory across a set of nodes '''
+
+import os
+import time
+import zlib
+import Queue
+import shlex
+import posixpath
+from threading import Thread
+
+import yaml
+
+from dustcluster import transfer, bandwidth
+from dustcluster.commands.atssh import _get_key_file
+from dustcluster.target import split_target
+
+# export commands
+commands = ['scatter']
+
+
+def scatter(cmdline, cluster, logger):
+    '''
+    scatter tgt source destdir [--by lines|size|hash:col] [-t sep] [--reuse] [-j workers] - split a dataset over nodes
+
+    Notes:
+    source is read once, and each partition is streamed straight to its node, no split files are written locally.
+    If source is a file, each node gets destdir/basename(source) holding its part:
+        --by lines     lines are dealt round robin to the nodes (default)
+        --by size      the file is cut into one contiguous, equal sized run of lines per node
+        --by hash:col  lines go to a node by a hash of column col (1 based, split on -t sep or whitespace),
+                       so all lines with the same key land on the same node
+    If source is a directory of shards:
+        --by lines     whole files are dealt round robin to the nodes (default)
+        --by size      whole files are assigned to balance the total bytes per node
+        --by hash:col  every file is split by key as above, each node gets destdir/relpath with its lines
+    The assignment (node order, and the file to node map for directories) is saved in ~/.dustcluster/scatter.
+    With --reuse, the saved assignment for the same source name is used again, so keys and shards
+    go to the same nodes as last time, and only new shards are assigned.
+
+    Examples:
+    scatter worker* ./events.log /data/in
+    scatter worker* ./events.csv /data/in --by hash:2 -t ,
+    scatter worker* ./shards /data/in --by size
+    scatter worker* ./events-day2.csv /data/in --by hash:2 -t , --reuse
+    '''
+
+    usage = "usage: scatter target source destdir [--by lines|size|hash:col] [-t sep] [--reuse] [-j workers]"
+
+    target, args = split_target(cmdline)
+
+    try:
+        arrargs = shlex.split(args)
+        workers = transfer.get_workers(arrargs, cluster)
+        by = _pop_option(arrargs, '--by')
+        sep = _pop_option(arrargs, '-t')
+    except (IndexError, ValueError):
+        logger.error(usage)
+        return
+
+    reuse = '--reuse' in arrargs
+    if reuse:
+        arrargs.remove('--reuse')
+
+    if not target or len(arrargs) != 2:
+        logger.error(usage)
+        return
+
+    source, destdir = arrargs
+    source = source.rstrip(os.sep) or source
+
+    if not os.path.exists(source):
+        logger.error('file does not exist locally : %s' % source)
+        return
+
+    target_nodes = cluster.running_nodes_from_target(target)
+    if not target_nodes:
+        return
+
+    assign_file = os.path.join(cluster.dust_dir, 'scatter', cluster.cur_cluster or 'default',
+                                '%s.yaml' % os.path.basename(source))
+
+    saved = None
+    if reuse:
+        if not os.path.exists(assign_file):
+            logger.error('no saved assignment for %s in %s' % (os.path.basename(source), assign_file))
+            return
+        with open(assign_file, 'r') as fh:
+            saved = yaml.safe_load(fh)
+        if by and by != saved['by']:
+            logger.error('saved assignment is --by %s, not %s' % (saved['by'], by))
+            return
+        by = saved['by']
+
+    by = by or 'lines'
+    if by not in ('lines', 'size') and not by.startswith('hash:'):
+        logger.error(usage)
+        return
+
+    col = None
+    if by.startswith('hash:'):
+        try:
+            col = int(by[len('hash:'):])
+        except ValueError:
+            col = 0
+        if col < 1:
+            logger.error('hash column must be a number from 1 : %s' % by)
+            return
+
+    node_keyfiles = []
+    for node in target_nodes:
+        keyfile = _get_key_file(node, cluster, logger)
+        if keyfile:
+            node_keyfiles.append( (node, keyfile) )
+
+    if not node_keyfiles:
+        return
+
+    if saved:
+        by_id = dict((node.get('id'), (node, keyfile)) for node, keyfile in node_keyfiles)
+        missing = [name for nodeid, name in saved['nodes'] if nodeid not in by_id]
+        if missing:
+            logger.error('nodes in the saved assignment are not in the target: %s' % ','.join(missing))
+            return
+        node_keyfiles = [by_id[nodeid] for nodeid, name in saved['nodes']]
+    else:
+        node_keyfiles.sort(key=lambda (node, keyfile): node.name)
+
+    assignment = { 'source' : os.path.abspath(source),
+                   'by' : by,
+                   'destdir' : destdir,
+                   'time' : int(time.time()),
+                   'nodes' : [[node.get('id'), node.name] for node, keyfile in node_keyfiles] }
+
+    summary = transfer.TransferSummary()
+
+    if os.path.isdir(source):
+        relpaths = _list_files(source)
+        if not relpaths:
+            logger.error('no files under %s' % source)
+            return
+
+        _make_remote_dirs(cluster.lineterm, node_keyfiles, destdir, relpaths, workers, summary)
+
+        if col:
+            for relpath in relpaths:
+                scatter_lines(cluster.lineterm, node_keyfiles, os.path.join(source, relpath),
+                                posixpath.join(destdir, relpath), _hash_router(len(node_keyfiles), col, sep), summary)
+        else:
+            old_files = saved.get('files', {}) if saved else {}
+            files = assign_files(source, relpaths, [node.name for node, keyfile in node_keyfiles], by, old_files)
+            assignment['files'] = files
+
+            node_files = dict((node.name, []) for node, keyfile in node_keyfiles)
+            for relpath in relpaths:
+                node_files[files[relpath]].append(relpath)
+
+            def put_shard(node, keyfile, relpath):
+                cluster.lineterm.put(keyfile, node, os.path.join(source, relpath), posixpath.join(destdir, relpath),
+                                        progress=summary.progress(node.name, relpath))
+
+            node_jobs = [(node, keyfile, node_files[node.name]) for node, keyfile in node_keyfiles]
+            transfer.for_each_node(node_jobs, put_shard, workers, summary)
+
+    else:
+        _make_remote_dirs(cluster.lineterm, node_keyfiles, destdir, [], workers, summary)
+
+        if col:
+            router = _hash_router(len(node_keyfiles), col, sep)
+        elif by == 'size':
+            router = _size_router(len(node_keyfiles), os.path.getsize(source))
+        else:
+            router = _round_robin_router(len(node_keyfiles))
+
+        scatter_lines(cluster.lineterm, node_keyfiles, source,
+                        posixpath.join(destdir, os.path.basename(source)), router, summary)
+
+    _save_assignment(assign_file, assignment, logger)
+    summary.log('scatter', cluster.capture, cmdline)
+
+
+def _pop_option(args, opt):
+    ''' pop "opt value" from an argument list, returns value or None '''
+
+    if opt not in args:
+        return None
+
+    pos = args.index(opt)
+    value = args[pos+1]
+    del args[pos:pos+2]
+    return value
+
+
+def _list_files(localdir):
+    ret = []
+    for dirpath, dirnames, filenames in os.walk(localdir):
+        for fname in filenames:
+            path = os.path.join(dirpath, fname)
+            if os.path.isfile(path):
+                ret.append(os.path.relpath(path, localdir).replace(os.sep, '/'))
+    return sorted(ret)
+
+
+def _make_remote_dirs(lineterm, node_keyfiles, destdir, relpaths, workers, summary):
+    ''' mkdir -p destdir and the parents of relpaths on every node, with one exec per node '''
+
+    dirs = set([destdir])
+    dirs.update(posixpath.dirname(posixpath.join(destdir, relpath)) for relpath in relpaths)
+    cmd = 'mkdir -p %s' % ' '.join(transfer.shell_path(d) for d in sorted(dirs))
+
+    def mkdirs(node, keyfile, item):
+        chan = lineterm.exec_command(keyfile, node, cmd)
+        try:
+            status = chan.recv_exit_status()
+        finally:
+            chan.close()
+        if status:
+            raise IOError('could not create %s' % destdir)
+
+    # failures are reported by the uploads that follow
+    transfer.for_each_node([(node, keyfile, [destdir]) for node, keyfile in node_keyfiles], mkdirs, workers)
+
+
+def assign_files(source, relpaths, nodenames, by, old_files=None):
+    '''
+    returns { relpath : nodename } for the files in a directory.
+    files already in old_files keep their node, new files are dealt round robin (by lines) or
+    given to the node with the fewest bytes so far, biggest files first (by size)
+    '''
+
+    files = {}
+    load = dict((nodename, 0) for nodename in nodenames)
+
+    new_files = []
+    for relpath in relpaths:
+        nodename = (old_files or {}).get(relpath)
+        if nodename in load:
+            files[relpath] = nodename
+            load[nodename] += os.path.getsize(os.path.join(source, relpath))
+        else:
+            new_files.append(relpath)
+
+    if by == 'size':
+        sizes = dict((relpath, os.path.getsize(os.path.join(source, relpath))) for relpath in new_files)
+        for relpath in sorted(new_files, key=lambda relpath: -sizes[relpath]):
+            nodename = min(nodenames, key=lambda nodename: (load[nodename], nodenames.index(nodename)))
+            files[relpath] = nodename
+            load[nodename] += sizes[relpath]
+    else:
+        # carry on dealing from where the old assignment left off
+        start = len(files)
+        for i, relpath in enumerate(new_files):
+            files[relpath] = nodenames[(start + i) % len(nodenames)]
+
+    return files
+
+
+def _round_robin_router(num_nodes):
+    state = { 'next' : 0 }
+
+    def route(line, offset):
+        i = state['next']
+        state['next'] = (i + 1) % num_nodes
+        return i
+
+    return route
+
+
+def _size_router(num_nodes, size):
+    ''' contiguous runs of lines, cut at the first line boundary past each node's share of the bytes '''
+
+    bounds = [size * (i + 1) / num_nodes for i in range(num_nodes)]
+    state = { 'node' : 0 }
+
+    def route(line, offset):
+        while offset >= bounds[state['node']] and state['node'] < num_nodes - 1:
+            state['node'] += 1
+        return state['node']
+
+    return route
+
+
+def _hash_router(num_nodes, col, sep=None):
+    ''' lines go to crc32(column col) % num_nodes, crc32 so the same key maps the same way on every run '''
+
+    def route(line, offset):
+        fields = line.rstrip('\r\n').split(sep)
+        key = fields[col-1] if len(fields) >= col else ''
+        return (zlib.crc32(key) & 0xffffffff) % num_nodes
+
+    return route
+
+
+class RemoteWriter(object):
+    '''
+    writes a stream of buffers to a remote file from its own thread, through a bounded queue,
+    so the reader feeding many nodes only waits when a node falls far behind
+    '''
+
+    done = object()
+
+    def __init__(self, sftp, remotefile, progress=None, max_queued=16):
+        self.queue = Queue.Queue(maxsize=max_queued)
+        self.error = None
+        self.progress = progress
+        self.nbytes = 0
+        self.remote = sftp.open(transfer.sftp_path(remotefile), 'wb')
+        self.remote.set_pipelined(True)
+        self.thread = Thread(target=self.write_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def write_loop(self):
+        while True:
+            data = self.queue.get()
+            if data is self.done:
+                break
+            if self.error:
+                # drain, so the reader never blocks on a dead node
+                continue
+            try:
+                bandwidth.consume(len(data))
+                self.remote.write(data)
+                self.nbytes += len(data)
+                if self.progress:
+                    self.progress(self.nbytes, 0)
+            except Exception, e:
+                self.error = e
+
+    def write(self, data):
+        self.queue.put(data)
+
+    def close(self):
+        self.queue.put(self.done)
+        self.thread.join()
+        try:
+            self.remote.close()
+        except Exception, e:
+            self.error = self.error or e
+        if self.error:
+            raise self.error
+
+
+def scatter_lines(lineterm, node_keyfiles, srcfile, remotefile, route, summary):
+    '''
+    read srcfile once and send each line to remotefile on the node picked by route(line, offset),
+    which returns an index into node_keyfiles. Lines are buffered per node and written in chunk_size pieces.
+    '''
+
+    writers = {}
+    for i, (node, keyfile) in enumerate(node_keyfiles):
+        try:
+            writers[i] = RemoteWriter(lineterm.sftp(keyfile, node), remotefile,
+                                        progress=summary.progress(node.name, remotefile))
+        except Exception, e:
+            summary.failure(node.name, remotefile, e)
+
+    buffers = dict((i, []) for i in writers)
+    buffered = dict((i, 0) for i in writers)
+
+    offset = 0
+    with open(srcfile, 'rb') as fh:
+        for line in fh:
+            i = route(line, offset)
+            offset += len(line)
+            if i not in writers:
+                continue
+            buffers[i].append(line)
+            buffered[i] += len(line)
+            if buffered[i] >= transfer.chunk_size:
+                writers[i].write(''.join(buffers[i]))
+                buffers[i] = []
+                buffered[i] = 0
+
+    for i, writer in writers.items():
+        node = node_keyfiles[i][0]
+        try:
+            if buffers[i]:
+                writer.write(''.join(buffers[i]))
+            writer.close()
+            summary.success(node.name, remotefile)
+        except Exception, e:
+            summary.failure(node.name, remotefile, e)
+
+
+def _save_assignment(assign_file, assignment, logger):
+
+    try:
+        if not os.path.exists(os.path.dirname(assign_file)):
+            os.makedirs(os.path.dirname(assign_file))
+        with open(assign_file, 'w') as fh:
+            yaml.safe_dump(assignment, fh, default_flow_style=False)
+        logger.info('saved assignment to %s' % assign_file)
+    except Exception, e:
+        logger.error('could not save assignment to %s: %s' % (assign_file, e))
@@ -0,0 +1,141 @@
+# Copyright (c) Ran Dugal 2014
+#
+# This file is part of dust.
+#
+# Licensed under the GNU Affero General Public License v3, which is available at
+# http://www.gnu.org/licenses/agpl-3.0.html
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero GPL for more details.
+#
+
+''' dust command to run a local script on a set of nodes, through a content addressed cache on the nodes '''
+
+import os
+import stat
+import hashlib
+import posixpath
+
+from dustcluster import transfer, hostlist
+from dustcluster.target import split_target
+from dustcluster.commands.atssh import _get_key_file
+
+# export commands
+commands = ['script']
+
+# on every node, unless script_cache_dir is set in ~/.dustcluster/config (a relative one is from the home dir)
+default_cache_dir = '~/.dust/scripts'
+
+
+def script(cmdline, cluster, logger):
+    '''
+    script tgt file [args] - run a local script on a set of nodes, uploading it only if it is not cached there
+
+    Notes:
+    The script is stored on each node under its sha1 in ~/.dust/scripts (or script_cache_dir in ~/.dustcluster/config),
+    so running the same script again sends only a stat and a short command line.
+    It runs in the same interactive shell as @ commands, and its output is captured (see history).
+    Scripts without a #! line are run with sh.
+
+    Examples:
+    script worker* ./setup.sh
+    script * ./install_agent.sh --version 1.2
+    '''
+
+    usage = "usage: script target file [args]"
+
+    target, rest = split_target(cmdline)
+    tokens = rest.split(None, 1)
+    if not target or not tokens:
+        logger.error(usage)
+        return
+
+    scriptfile = tokens[0]
+    args = tokens[1].strip() if len(tokens) > 1 else ''
+
+    if not os.path.isfile(scriptfile):
+        logger.error('file does not exist locally : %s' % scriptfile)
+        return
+
+    with open(scriptfile, 'rb') as fh:
+        content = fh.read()
+
+    digest = hashlib.sha1(content).hexdigest()
+    cache_dir = cluster.dust_config_data.get('script_cache_dir') or default_cache_dir
+    if not posixpath.isabs(cache_dir) and not cache_dir.startswith('~'):
+        cache_dir = posixpath.join('~', cache_dir)
+    remote_path = posixpath.join(cache_dir, digest)
+
+    # sftp starts in the home dir and does not expand ~, the shell does
+    sftp_dir = transfer.sftp_path(cache_dir)
+    sftp_file = transfer.sftp_path(remote_path)
+
+    target_nodes = cluster.running_nodes_from_target(target)
+    if not target_nodes:
+        return
+
+    node_jobs = []
+    for node in target_nodes:
+        keyfile = _get_key_file(node, cluster, logger)
+        if keyfile:
+            node_jobs.append( (node, keyfile, [remote_path]) )
+
+    uploads = []
+
+    def ensure_cached(node, keyfile, remote_path):
+        sftp = cluster.lineterm.sftp(keyfile, node)
+        try:
+            sftp.stat(sftp_file)
+            return
+        except IOError:
+            pass
+
+        _makedirs(sftp, sftp_dir)
+        # upload under a temp name and rename, so a concurrent run never sees half a script
+        tmp_path = '%s.%s.tmp' % (sftp_file, os.getpid())
+        transfer.sftp_put(sftp, scriptfile, tmp_path)
+        sftp.chmod(tmp_path, stat.S_IRWXU)
+        sftp.posix_rename(tmp_path, sftp_file)
+        uploads.append(node.name)
+
+    workers = transfer.get_workers([], cluster)
+    summary = transfer.for_each_node(node_jobs, ensure_cached, workers)
+    if uploads:
+        logger.info('uploaded %s (%s) to %d of %d nodes' % (scriptfile, digest[:12], len(uploads), len(node_jobs)))
+    summary.log('script', cluster.capture, cmdline)
+
+    ready = [(node, keyfile) for node, keyfile, _ in node_jobs if node.name not in summary.failed]
+    if not ready:
+        return
+
+    run_path = transfer.shell_path(remote_path)
+    if content.startswith('#!'):
+        sshcmd = run_path
+    else:
+        sshcmd = 'sh %s' % run_path
+
+    if args:
+        sshcmd = '%s %s' % (sshcmd, args)
+
+    logger.info('running %s on nodes: %s' % (scriptfile, hostlist.compress(node.name for node, _ in ready)))
+    run_id = cluster.lineterm.new_run('script %s %s' % (scriptfile, args), [node for node, _ in ready])
+    for node, keyfile in ready:
+        cluster.lineterm.command(keyfile, node, sshcmd, run_id)
+
+
+def _makedirs(sftp, path):
+    ''' mkdir -p over sftp '''
+
+    parts = [part for part in path.split('/') if part]
+    current = '/' if path.startswith('/') else ''
+    for part in parts:
+        current = posixpath.join(current, part)
+        try:
+            sftp.stat(current)
+        except IOError:
+            try:
+                sftp.mkdir(current)
+            except IOError:
+                # another run made it
+                pass
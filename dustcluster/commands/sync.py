@@ -0,0 +1,230 @@
+# Copyright (c) Ran Dugal 2014
+#
+# This file is part of dust.
+#
+# Licensed under the GNU Affero General Public License v3, which is available at
+# http://www.gnu.org/licenses/agpl-3.0.html
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero GPL for more details.
+#
+
+''' dust command to incrementally push a local directory to a set of nodes '''
+
+import os
+import hashlib
+import posixpath
+import threading
+
+import yaml
+
+from dustcluster import transfer
+from dustcluster.target import split_target
+from dustcluster.commands.atssh import _get_key_file
+
+# export commands
+commands = ['sync']
+
+# yaml is slow on big manifests, use libyaml if it is there
+yaml_loader = getattr(yaml, 'CSafeLoader', yaml.SafeLoader)
+yaml_dumper = getattr(yaml, 'CSafeDumper', yaml.SafeDumper)
+
+
+def sync(cmdline, cluster, logger):
+    '''
+    sync tgt localdir remotedir [-j workers] - upload the files in localdir that changed since the last sync
+
+    Notes:
+    A manifest of what was pushed to each node (size, mtime, md5) is kept in ~/.dustcluster/sync.
+    Remote files are listed with a single find per node, and a file is uploaded only if it is new,
+    its content changed locally, or it was changed on the node since the last sync.
+    Files removed locally are not removed from the nodes.
+
+    Examples:
+    sync worker* ./myapp /opt/myapp
+    sync * ./conf /etc/myapp -j 50
+    '''
+
+    usage = "usage: sync target localdir remotedir [-j workers]"
+
+    target, args = split_target(cmdline)
+    arrargs = args.split()
+    try:
+        workers = transfer.get_workers(arrargs, cluster)
+    except (IndexError, ValueError):
+        logger.error(usage)
+        return
+
+    if not target or len(arrargs) != 2:
+        logger.error(usage)
+        return
+
+    localdir, remotedir = arrargs
+
+    if not os.path.isdir(localdir):
+        logger.error('dir does not exist locally : %s' % localdir)
+        return
+
+    target_nodes = cluster.running_nodes_from_target(target)
+    if not target_nodes:
+        return
+
+    node_jobs = []
+    for node in target_nodes:
+        keyfile = _get_key_file(node, cluster, logger)
+        if keyfile:
+            node_jobs.append( (node, keyfile, [remotedir]) )
+
+    local_files = LocalTree(localdir)
+    manifest_dir = os.path.join(cluster.dust_dir, 'sync')
+
+    summary = transfer.TransferSummary()
+
+    def sync_node(node, keyfile, remotedir):
+        sync_to_node(cluster.lineterm, node, keyfile, local_files, remotedir, manifest_dir, logger, summary)
+
+    transfer.for_each_node(node_jobs, sync_node, workers, summary)
+    summary.log('sync', cluster.capture, cmdline)
+
+
+class LocalTree(object):
+    ''' the files under a local dir, with md5s computed on demand and shared by all nodes '''
+
+    def __init__(self, localdir):
+        self.localdir = localdir
+        self.files = {} # { relpath : (size, mtime) }
+        self.md5s = {}
+        self.lock = threading.Lock()
+
+        for dirpath, dirnames, filenames in os.walk(localdir):
+            for fname in filenames:
+                path = os.path.join(dirpath, fname)
+                if not os.path.isfile(path):
+                    continue
+                st = os.stat(path)
+                relpath = os.path.relpath(path, localdir).replace(os.sep, '/')
+                self.files[relpath] = (st.st_size, int(st.st_mtime))
+
+    def path(self, relpath):
+        return os.path.join(self.localdir, relpath)
+
+    def md5(self, relpath):
+
+        with self.lock:
+            if relpath in self.md5s:
+                return self.md5s[relpath]
+
+        digest = hashlib.md5()
+        with open(self.path(relpath), 'rb') as fh:
+            for block in iter(lambda: fh.read(1024 * 1024), ''):
+                digest.update(block)
+
+        with self.lock:
+            self.md5s[relpath] = digest.hexdigest()
+
+        return self.md5s[relpath]
+
+
+# size, mtime and path of each file under the current dir, one per line. GNU find has -printf,
+# elsewhere (BSD/macOS, busybox) each file is stat'ed, with GNU style stat -c or BSD style stat -f
+list_files_cmd = ("if find . -maxdepth 0 -printf '' >/dev/null 2>&1; then find . -type f -printf '%s %T@ %P\\n'; "
+                  "elif stat -c %s . >/dev/null 2>&1; then find . -type f -exec stat -c '%s %Y %n' {} +; "
+                  "else find . -type f -exec stat -f '%z %m %N' {} +; fi")
+
+
+def remote_stat(lineterm, node, keyfile, remotedir):
+    ''' { relpath : (size, mtime) } for the files under remotedir, listed with one find '''
+
+    cmd = "cd %s 2>/dev/null && { %s; }" % (transfer.shell_path(remotedir), list_files_cmd)
+    chan = lineterm.exec_command(keyfile, node, cmd)
+    try:
+        out = chan.makefile('rb').read()
+    finally:
+        chan.close()
+
+    ret = {}
+    for line in out.splitlines():
+        fields = line.split(' ', 2)
+        if len(fields) != 3:
+            continue
+        size, mtime, relpath = fields
+        if relpath.startswith('./'):
+            relpath = relpath[2:]
+        ret[relpath] = (int(size), int(float(mtime)))
+
+    return ret
+
+
+def sync_to_node(lineterm, node, keyfile, local_files, remotedir, manifest_dir, logger, summary):
+
+    manifest_file = os.path.join(manifest_dir, '%s.yaml' % node.get('id'))
+    manifests = {}
+    if os.path.exists(manifest_file):
+        with open(manifest_file, 'r') as fh:
+            manifests = yaml.load(fh, Loader=yaml_loader) or {}
+
+    manifest = manifests.get(remotedir, {}) # { relpath : [size, mtime, md5] }
+    remote_files = remote_stat(lineterm, node, keyfile, remotedir)
+    sftp_dir = transfer.sftp_path(remotedir)
+
+    uploads = []
+    for relpath, (size, mtime) in sorted(local_files.files.items()):
+        pushed = manifest.get(relpath)
+        remote = remote_files.get(relpath)
+
+        if not remote:
+            uploads.append(relpath)
+            continue
+
+        if pushed and tuple(pushed[:2]) != remote:
+            # changed on the node since we pushed it
+            uploads.append(relpath)
+            continue
+
+        if (size, mtime) == remote:
+            if not pushed:
+                manifest[relpath] = [size, mtime, local_files.md5(relpath)]
+            continue
+
+        if pushed and pushed[0] == size and pushed[2] == local_files.md5(relpath):
+            # touched but not changed locally, just bring the remote mtime in line
+            sftp = lineterm.sftp(keyfile, node)
+            sftp.utime(posixpath.join(sftp_dir, relpath), (mtime, mtime))
+            manifest[relpath] = [size, mtime, pushed[2]]
+            continue
+
+        uploads.append(relpath)
+
+    if uploads:
+        dirs = set(posixpath.dirname(posixpath.join(remotedir, relpath)) for relpath in uploads)
+        mkdir = 'mkdir -p %s' % ' '.join(transfer.shell_path(d) for d in sorted(dirs))
+        chan = lineterm.exec_command(keyfile, node, mkdir)
+        chan.recv_exit_status()
+        chan.close()
+
+        sftp = lineterm.sftp(keyfile, node)
+        for relpath in uploads:
+            size, mtime = local_files.files[relpath]
+            remotepath = posixpath.join(sftp_dir, relpath)
+            progress = summary.progress(node.name, relpath)
+            # no stat per file, the next sync compares remote sizes anyway
+            transfer.sftp_put(sftp, local_files.path(relpath), remotepath, progress, confirm=False)
+            summary.meter.finish(node.name, relpath)
+            sftp.utime(remotepath, (mtime, mtime))
+            manifest[relpath] = [size, mtime, local_files.md5(relpath)]
+            logger.debug('%s: synced %s' % (node.name, remotepath))
+
+    manifests[remotedir] = manifest
+
+    try:
+        os.makedirs(manifest_dir)
+    except OSError:
+        # exists, or another node's thread just made it
+        pass
+
+    with open(manifest_file, 'w') as fh:
+        yaml.dump(manifests, fh, Dumper=yaml_dumper, default_flow_style=False)
+
+    logger.info('%s: %d of %d files changed, uploaded to %s' % (node.name, len(uploads),
+                                                                  len(local_files.files), remotedir))
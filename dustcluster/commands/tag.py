@@ -1,5 +1,7 @@
 import pprint
 
+from dustcluster.target import split_target
+
 commands = ['tag', 'untag']
 
 
@@ -19,14 +21,14 @@ def tag(cmdline, cluster, logger):
 
     try:
 
-        args = cmdline.split()
+        target, tags = split_target(cmdline)
+        tags = tags.split()
 
-        if len(args) < 2:
+        if not target or not tags:
             logger.error("usage: tag target tag=value")
             return
 
-        target = args[0]
-        tags   = args[1]
+        tags   = tags[0]
 
         taglist = tags.split(",")
 
@@ -82,14 +84,14 @@ def untag(cmdline, cluster, logger):
 
     try:
 
-        args = cmdline.split()
+        target, tags = split_target(cmdline)
+        tags = tags.split()
 
-        if len(args) < 2:
+        if not target or not tags:
             logger.error("usage: untag target tag")
             return
 
-        target = args[0]
-        tags   = args[1]
+        tags   = tags[0]
 
         taglist = tags.split(",")
 
@@ -0,0 +1,240 @@
+# Copyright (c) Ran Dugal 2014
+#
+# This file is part of dust.
+#
+# Licensed under the GNU Affero General Public License v3, which is available at
+# http://www.gnu.org/licenses/agpl-3.0.html
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero GPL for more details.
+#
+
+''' dust command to follow a log file on a set of nodes, optionally merged into one time ordered stream '''
+
+import re
+import sys
+import time
+import heapq
+import calendar
+import threading
+
+from dustcluster import hostlist
+from dustcluster import transfer
+from dustcluster.commands.atssh import _get_key_file
+from dustcluster.target import split_target
+
+# export commands
+commands = ['tail']
+
+# lines are held this long (seconds) so that lines from slower nodes can be merged in order
+merge_latency = 2.0
+
+# upper bound on lines held for merging
+max_held_lines = 10000
+
+months = dict((m, i+1) for i, m in enumerate(['Jan', 'Feb', 'Mar', 'Apr', 'May', 'Jun',
+                                               'Jul', 'Aug', 'Sep', 'Oct', 'Nov', 'Dec']))
+
+# 2016-04-05 23:41:47,623  or 2016-04-05T23:41:47.623Z  or 2016-04-05T23:41:47+02:00
+iso_regex = re.compile(r'(\d{4})-(\d\d)-(\d\d)[T ](\d\d):(\d\d):(\d\d)(?:[.,](\d+))?'
+                       r'(?: ?(Z|[+-]\d\d:?\d\d)\b)?')
+
+# Apr  5 23:41:47 (syslog)
+syslog_regex = re.compile(r'^(Jan|Feb|Mar|Apr|May|Jun|Jul|Aug|Sep|Oct|Nov|Dec) +(\d+) (\d\d):(\d\d):(\d\d)')
+
+# epoch seconds at the start of the line, [1459899707] or 1459899707.623 followed by a space or the end.
+# a bare 10 digit integer is as likely to be a count or an id, so it is not taken as a timestamp
+epoch_regex = re.compile(r'^(?:\[(\d{10}(?:\.\d+)?)\]|(\d{10}\.\d+)(?:[ \t]|$))')
+
+
+def tail(cmdline, cluster, logger):
+    '''
+    tail target path [--merge] [-n lines] - follow a file on a set of nodes
+
+    Notes:
+    With --merge, lines from all nodes are merged into a single stream ordered by the
+    timestamps in the lines, corrected for each node's clock skew. Lines without a
+    timestamp take the timestamp of the previous line from the same node.
+    Lines are held for up to 2 seconds to be merged. Press Ctrl-C to stop.
+
+    Examples:
+    tail worker* /var/log/syslog
+    tail worker* /opt/app/logs/app.log --merge
+    tail * /var/log/auth.log -n 50
+    '''
+
+    target, args = split_target(cmdline)
+    args = args.split()
+
+    merge = False
+    if '--merge' in args:
+        merge = True
+        args.remove('--merge')
+
+    nlines = 10
+    if '-n' in args:
+        pos = args.index('-n')
+        try:
+            nlines = int(args[pos+1])
+        except (IndexError, ValueError):
+            logger.error("usage: tail target path [--merge] [-n lines]")
+            return
+        del args[pos:pos+2]
+
+    if not target or len(args) != 1:
+        logger.error("usage: tail target path [--merge] [-n lines]")
+        return
+
+    path = args[0]
+
+    target_nodes = cluster.running_nodes_from_target(target)
+    if not target_nodes:
+        return
+
+    remote_cmd = 'tail -n %d -F %s' % (nlines, transfer.shell_path(path))
+
+    streams = []
+    for node in target_nodes:
+        keyfile = _get_key_file(node, cluster, logger)
+        if not keyfile:
+            continue
+        try:
+            offset = (0.0, 0)
+            if merge:
+                offset = cluster.lineterm.clock_offset(keyfile, node)
+            chan = cluster.lineterm.exec_command(keyfile, node, remote_cmd)
+            streams.append( (node, chan, offset) )
+        except Exception, e:
+            logger.error('%s: could not start tail: %s' % (node.name, e))
+
+    if not streams:
+        return
+
+    node_names = hostlist.compress(node.name for node, _, _ in streams)
+    logger.info('following %s on nodes: %s. Ctrl-C to stop.' % (path, node_names))
+
+    merger = LogMerger(merge)
+
+    readers = []
+    for node, chan, offset in streams:
+        reader = threading.Thread(target=merger.read_lines, args=(node.name, chan, offset))
+        reader.daemon = True
+        reader.start()
+        readers.append(reader)
+
+    try:
+        while any(reader.is_alive() for reader in readers):
+            merger.emit()
+            time.sleep(0.1)
+        merger.emit(flush=True)
+    except KeyboardInterrupt:
+        pass
+    finally:
+        for _, chan, _ in streams:
+            chan.close()
+
+    logger.info('ok')
+
+
+def parse_timestamp(line, utc_offset, year):
+    ''' return the epoch time of the first timestamp in line, or None.
+        timestamps without a timezone are taken to be in the node's local time
+    '''
+
+    match = epoch_regex.match(line)
+    if match:
+        return float(match.group(1) or match.group(2))
+
+    match = iso_regex.search(line)
+    if match:
+        fields = [int(f) for f in match.groups()[:6]]
+        frac = match.group(7)
+        ts = calendar.timegm(fields) + (float('0.' + frac) if frac else 0.0)
+        zone = match.group(8)
+        if zone:
+            return ts - zone_offset(zone)
+        return ts - utc_offset
+
+    match = syslog_regex.match(line)
+    if match:
+        mon, day, hh, mm, ss = match.groups()
+        ts = calendar.timegm((year, months[mon], int(day), int(hh), int(mm), int(ss)))
+        return ts - utc_offset
+
+    return None
+
+
+def zone_offset(zone):
+    ''' Z, +0200 or -05:30 -> offset from UTC in seconds '''
+
+    if zone == 'Z':
+        return 0
+    digits = zone[1:].replace(':', '')
+    offset = int(digits[:2]) * 3600 + int(digits[2:]) * 60
+    return -offset if zone[0] == '-' else offset
+
+
+class LogMerger(object):
+    '''
+    collects lines from per node reader threads and writes them out.
+    in merge mode this is a k-way merge on (skew corrected) timestamps with bounded latency:
+    lines are held in a heap, and the earliest line is written once it has been held for merge_latency.
+    '''
+
+    def __init__(self, merge):
+        self.merge = merge
+        self.heap = []
+        self.seq = 0
+        self.lock = threading.Lock()
+        self.year = time.gmtime().tm_year
+
+    def read_lines(self, nodename, chan, offset):
+        ''' reader thread: read lines off an exec channel '''
+
+        skew, utc_offset = offset
+        last_ts = None
+
+        try:
+            for line in chan.makefile('r'):
+                line = line.rstrip('\r\n')
+                if not self.merge:
+                    with self.lock:
+                        self.write(nodename, line)
+                    continue
+
+                ts = parse_timestamp(line, utc_offset, self.year)
+                if ts is not None:
+                    last_ts = ts - skew
+                elif last_ts is None:
+                    last_ts = time.time()
+
+                with self.lock:
+                    heapq.heappush(self.heap, (last_ts, self.seq, time.time(), nodename, line))
+                    self.seq += 1
+        except Exception:
+            # channel closed
+            pass
+
+    def emit(self, flush=False):
+        ''' write out held lines that are due '''
+
+        if not self.merge:
+            return
+
+        due = time.time() - merge_latency
+        lines = []
+        with self.lock:
+            while self.heap:
+                _, _, arrived, nodename, line = self.heap[0]
+                if not flush and arrived > due and len(self.heap) <= max_held_lines:
+                    break
+                heapq.heappop(self.heap)
+                lines.append( (nodename, line) )
+
+        for nodename, line in lines:
+            self.write(nodename, line)
+
+    def write(self, nodename, line):
+        sys.stdout.write("\r\033[1m[%s]\033[21m %s\n" % (nodename, line))
+        sys.stdout.flush()
@@ -29,6 +29,9 @@ def use(cmdline, cluster, logger):
     After the use command, commands like show and cluster wide commands like stop/start/@ for a target = * or None will
     apply to the set of nodes selected.
 
+    Set prewarm_sessions = yes in ~/.dustcluster/config to log in to the running nodes of a cluster
+    in the background on use.
+
     Examples:
     use us-east-1       # work with all nodes in this region 
     use clusterA        # work with the nodes defined in cluster config saved as ./dustcluster/clusters/clusterA.yaml
@@ -144,7 +147,7 @@ def write_new_cluster(filter_exp, target_nodes, target_cluster, cluster, logger)
                         % (ret,  nodes[0].get('nodename'), nodes[-1].get('nodename')))
 
             #cluster.switch_to_cluster(name)
-            cluster.invalidate_cache()  # we want refresh to pick up the new names
+            cluster.invalidate_cache(persisted=False)  # we want refresh to pick up the new names
 
 
 def use_cluster(args, cluster, logger):
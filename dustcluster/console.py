@@ -46,7 +46,7 @@ class Console(Cmd):
     dust_config_file = os.path.join(user_dir, '.dustcluster/config')
     aws_config_file  = os.path.join(user_dir, '.aws/config')
 
-    def __init__(self):
+    def __init__(self, offline=False):
 
         util.intro()
 
@@ -86,7 +86,7 @@ class Console(Cmd):
 
         self.commands = {}  # { cmd : (helpstr, module) }
         # startup
-        self.cluster = Cluster(config_data)
+        self.cluster = Cluster(config_data, offline=offline)
         self.cluster.load_commands()
  
         self.exit_flag = False
@@ -94,6 +94,8 @@ class Console(Cmd):
 
         self.cluster.handle_command('loglevel',  config_data.get('loglevel') or 'info')
         logger.info(self.dustintro)
+        if offline:
+            logger.info("Offline: nodes are listed from the inventory cache in %s" % self.cluster.inventory_dir)
         if self.cluster.clusters:
             print "\nAvailable clusters:"
             for cluster_name in self.cluster.clusters:
@@ -198,8 +200,11 @@ class Console(Cmd):
         ''' format and print the cmd help string '''
         if docstr and '\n' in docstr:
             helpstr = docstr.split('\n')[1]
-            if '-' in helpstr:
-                cmd, doc = helpstr.split('-')
+            if ' - ' in helpstr:
+                # options like [-j workers] can come before the separator
+                cmd, doc = helpstr.split(' - ', 1)
+            elif '-' in helpstr:
+                cmd, doc = helpstr.split('-', 1)
             else:
                 doc = ""
             print "%-40s%s" % (cmd.strip(), doc.strip())
@@ -225,6 +230,9 @@ class Console(Cmd):
             tokens = line.split()
             if len(tokens[0]) == 1:
                 line = 'atssh * ' + line[1:]
+            elif line[1] in '"\'':
+                # @"expr with spaces" cmd, atssh takes the quoted target as is
+                line = 'atssh %s ' % line[1:]
             else:
                 target  = tokens[0][1:]
                 line = 'atssh %s %s ' % (target, line[len(tokens[0]):] )
@@ -0,0 +1,172 @@
+# Copyright (c) Ran Dugal 2014
+#
+# This file is part of dust.
+#
+# Licensed under the GNU Affero General Public License v3, which is available at
+# http://www.gnu.org/licenses/agpl-3.0.html
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero GPL for more details.
+#
+
+'''
+hostlist ranges in node names: worker[1-250,300-310] is worker1 .. worker250 and worker300 .. worker310.
+A bracket with only digits, dashes and commas is a numeric range, anything else is an fnmatch character class.
+So worker[12] is worker12, not worker1 or worker2 as a character class.
+A zero padded start pads the range, node[01-10] is node01 .. node10.
+'''
+
+import re
+import fnmatch
+from collections import OrderedDict
+
+range_re = re.compile(r'\[(\d+(?:-\d+)?(?:,\d+(?:-\d+)?)*)\]')
+
+# trailing number of a node name, for compress
+number_re = re.compile(r'^(.*?)(\d+)(\D*)$')
+
+# a range bigger than this is a typo
+max_names = 100000
+
+
+def has_ranges(pattern):
+    return bool(range_re.search(pattern))
+
+
+def _has_wildcards(text):
+    return any(c in text for c in '*?[')
+
+
+def range_values(body):
+    ''' '1-3,7' -> ['1', '2', '3', '7'] '''
+
+    values = []
+    for part in body.split(','):
+        lo, _, hi = part.partition('-')
+        if not hi:
+            values.append(lo)
+            continue
+        if int(hi) < int(lo):
+            raise ValueError('bad range %s' % part)
+        if int(hi) - int(lo) + len(values) >= max_names:
+            raise ValueError('range [%s] has more than %d names' % (body, max_names))
+        values.extend('%0*d' % (len(lo), i) for i in xrange(int(lo), int(hi) + 1))
+    return values
+
+
+def _split(pattern):
+    ''' worker[1-3]x[5,7] -> ['worker', ['1','2','3'], 'x', ['5','7'], ''] '''
+
+    parts = []
+    pos = 0
+    for match in range_re.finditer(pattern):
+        parts.append(pattern[pos:match.start()])
+        parts.append(range_values(match.group(1)))
+        pos = match.end()
+    parts.append(pattern[pos:])
+    return parts
+
+
+def expand(pattern):
+    ''' all the names in a hostlist pattern, in order, raises ValueError for a bad or huge range '''
+
+    names = ['']
+    for i, part in enumerate(_split(pattern)):
+        if i % 2 == 0:
+            names = [name + part for name in names]
+        else:
+            if len(names) * len(part) > max_names:
+                raise ValueError('%s has more than %d names' % (pattern, max_names))
+            names = [name + value for name in names for value in part]
+    return names
+
+
+def exact_names(pattern):
+    ''' the expanded names if the pattern has ranges and no other wildcards, else None '''
+
+    if not has_ranges(pattern) or _has_wildcards(range_re.sub('', pattern)):
+        return None
+    return expand(pattern)
+
+
+class RangeMatcher(object):
+    '''
+    matches a hostlist pattern with the same match() as a compiled fnmatch regex.
+    Plain ranges are a set lookup, ranges mixed with wildcards become a regex with the range values as alternatives.
+    '''
+
+    def __init__(self, pattern):
+        self.pattern = pattern
+        self.names = exact_names(pattern)
+        self.regex = None
+
+        if self.names is not None:
+            self.names = frozenset(self.names)
+            return
+
+        regex = []
+        for i, part in enumerate(_split(pattern)):
+            if i % 2 == 0:
+                # fnmatch.translate anchors the end with \Z(?ms), only the full pattern is anchored
+                regex.append(fnmatch.translate(part)[:-len(r'\Z(?ms)')])
+            else:
+                regex.append('(?:%s)' % '|'.join(sorted(part, key=len, reverse=True)))
+        self.regex = re.compile(''.join(regex) + r'\Z', re.S)
+
+    def match(self, value):
+        if self.regex:
+            return self.regex.match(value)
+        return value in self.names
+
+
+def compress(names):
+    ''' ['worker1', 'worker2', 'worker3', 'worker7', 'master'] -> 'worker[1-3,7],master' '''
+
+    groups = OrderedDict()  # { (prefix, suffix, pad) : set(numbers) }
+    for name in names:
+        match = number_re.match(name)
+        if not match:
+            groups.setdefault((name, None, 0), set())
+            continue
+        prefix, number, suffix = match.groups()
+        pad = len(number) if number.startswith('0') and len(number) > 1 else 0
+        groups.setdefault((prefix, suffix, pad), set()).add(int(number))
+
+    # an unpadded number at least as wide as a padded group prints the same in it, node[01-10] not node[01-09],node10
+    for (prefix, suffix, pad), numbers in groups.items():
+        if pad or suffix is None:
+            continue
+        for number in list(numbers):
+            pads = [other[2] for other in groups if other[:2] == (prefix, suffix) and 0 < other[2] <= len(str(number))]
+            if pads:
+                groups[(prefix, suffix, max(pads))].add(number)
+                numbers.remove(number)
+        if not numbers:
+            del groups[(prefix, suffix, pad)]
+
+    ret = []
+    for (prefix, suffix, pad), numbers in groups.iteritems():
+        if suffix is None:
+            ret.append(prefix)
+            continue
+
+        numbers = sorted(numbers)
+        if len(numbers) == 1:
+            ret.append('%s%0*d%s' % (prefix, pad, numbers[0], suffix))
+            continue
+
+        runs = []
+        start = prev = numbers[0]
+        for number in numbers[1:] + [None]:
+            if number == prev + 1:
+                prev = number
+                continue
+            if start == prev:
+                runs.append('%0*d' % (pad, start))
+            else:
+                runs.append('%0*d-%0*d' % (pad, start, pad, prev))
+            start = prev = number
+        ret.append('%s[%s]%s' % (prefix, ','.join(runs), suffix))
+
+    return ','.join(ret)
@@ -0,0 +1,122 @@
+# Copyright (c) Ran Dugal 2014
+#
+# This file is part of dust.
+#
+# Licensed under the GNU Affero General Public License v3, which is available at
+# http://www.gnu.org/licenses/agpl-3.0.html
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero GPL for more details.
+#
+
+''' the node inventory of each region on disk, so one shot dust commands start without a DescribeInstances '''
+
+import os
+import glob
+import time
+import fcntl
+import hashlib
+import cPickle
+from contextlib import contextmanager
+
+from dustcluster.util import setup_logger
+logger = setup_logger( __name__ )
+
+
+# Layout under cache_dir:
+#   <region>.inv          - every node in the region
+#   <region>-<hash>.inv   - the nodes matching a set of DescribeInstances filters
+#   <name>.lock           - flock'd shared to read, exclusive to write
+#
+# A file is a pickle of { version, fields, time, filters, records } where records are the lean tuples
+# the cloud provider keeps on its nodes, so loading is a single cPickle.load with no boto objects.
+# Files are written to a temp name and renamed, and removed when dust changes the nodes (start/stop/tag/..)
+
+format_version = 1
+
+class InventoryCache(object):
+    ''' load and save node records per region, valid for ttl seconds '''
+
+    def __init__(self, cache_dir, ttl=300):
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+
+    def _name(self, region, filters):
+        if not filters:
+            return region
+        return '%s-%s' % (region, hashlib.md5(repr(sorted(filters.items()))).hexdigest()[:12])
+
+    def _path(self, name):
+        return os.path.join(self.cache_dir, '%s.inv' % name)
+
+    @contextmanager
+    def _locked(self, name, op):
+
+        with open(os.path.join(self.cache_dir, '%s.lock' % name), 'a') as fh:
+            fcntl.flock(fh, op)
+            try:
+                yield
+            finally:
+                fcntl.flock(fh, fcntl.LOCK_UN)
+
+    def load(self, region, filters, fields, any_age=False):
+        ''' (records, saved time) if the cache has fresh records for region and filters, else None '''
+
+        name = self._name(region, filters)
+        path = self._path(name)
+        if not os.path.exists(path):
+            return None
+
+        try:
+            with self._locked(name, fcntl.LOCK_SH):
+                with open(path, 'rb') as fh:
+                    data = cPickle.load(fh)
+        except Exception, e:
+            logger.debug('ignoring unreadable inventory cache %s: %s' % (path, e))
+            return None
+
+        if data.get('version') != format_version or data.get('fields') != fields:
+            logger.debug('ignoring inventory cache %s from another dust version' % path)
+            return None
+
+        age = time.time() - data['time']
+        if not any_age and not 0 <= age < self.ttl:
+            logger.debug('inventory cache %s is %ds old, ttl %ds' % (path, age, self.ttl))
+            return None
+
+        return data['records'], data['time']
+
+    def save(self, region, filters, fields, records):
+
+        if not os.path.exists(self.cache_dir):
+            try:
+                os.makedirs(self.cache_dir)
+            except OSError:
+                # another dust made it
+                pass
+
+        data = { 'version' : format_version, 'fields' : fields, 'time' : time.time(),
+                 'filters' : filters, 'records' : records }
+
+        name = self._name(region, filters)
+        path = self._path(name)
+        tmp_path = '%s.%d.tmp' % (path, os.getpid())
+
+        try:
+            with self._locked(name, fcntl.LOCK_EX):
+                with open(tmp_path, 'wb') as fh:
+                    cPickle.dump(data, fh, cPickle.HIGHEST_PROTOCOL)
+                os.rename(tmp_path, path)
+        except (IOError, OSError), e:
+            logger.warning('could not save the inventory cache %s: %s' % (path, e))
+
+    def remove(self, region):
+        ''' drop every cached inventory of region, filtered or not '''
+
+        for path in [self._path(region)] + glob.glob(self._path('%s-*' % region)):
+            try:
+                os.remove(path)
+            except OSError:
+                # not there, or another dust removed it
+                pass
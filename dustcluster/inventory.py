@@ -0,0 +1,198 @@
+# Copyright (c) Ran Dugal 2014
+#
+# This file is part of dust.
+#
+# Licensed under the GNU Affero General Public License v3, which is available at
+# http://www.gnu.org/licenses/agpl-3.0.html
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero GPL for more details.
+#
+
+''' columnar snapshot of the node inventory, for filtering nodes with set operations '''
+
+import re
+import fnmatch
+
+from dustcluster import hostlist
+from dustcluster.util import setup_logger
+logger = setup_logger( __name__ )
+
+
+# fields dust assigns to nodes after the snapshot is taken (from cluster templates), these are read live
+live_fields = set(['name', 'cluster', 'username', 'keyfile'])
+
+
+# compiled wildcard patterns, shared by all filters
+_patterns = {}
+max_patterns = 1000
+
+
+def has_wildcards(pattern):
+    return any(c in pattern for c in '*?[')
+
+
+def compile_pattern(pattern):
+    '''
+    the compiled regex for a wildcard pattern, compiled once.
+    Numeric ranges like worker[1-12] compile to a hostlist.RangeMatcher, raises ValueError for a bad range
+    '''
+
+    regex = _patterns.get(pattern)
+    if regex is None:
+        if len(_patterns) >= max_patterns:
+            _patterns.clear()
+        if hostlist.has_ranges(pattern):
+            regex = hostlist.RangeMatcher(pattern)
+        else:
+            regex = re.compile(fnmatch.translate(pattern))
+        _patterns[pattern] = regex
+    return regex
+
+
+def split_tag_filter(filterval):
+    ''' tags=key:value -> (key, value), a quoted key can contain colons '''
+
+    pos = filterval.rfind(':')
+    if pos < 0:
+        return "", ""
+
+    fkey, fval = filterval[:pos], filterval[pos+1:]
+    if fkey and fkey[0] == '"' and fkey[-1] == '"':
+        fkey = fkey[1:-1]
+
+    return fkey, fval
+
+
+class NodeTable(object):
+    '''
+    a snapshot of a list of nodes, stored by column: one list of values per attribute, built on first use,
+    an index of { value : set(rows) } per attribute, and a table of { tagkey : { tagval : set(rows) } }.
+    A filter is answered with a dict lookup for an exact value, or by matching the pattern once per
+    distinct value (a handful of states or types, not one per node), and returns a set of row numbers.
+    '''
+
+    def __init__(self, nodes):
+        self.nodes = list(nodes)
+        self.columns = {}       # { field : [value] }
+        self.indexes = {}       # { field : { value : set(rows) } }
+        self.tags = None        # { tagkey : { tagval : set(rows) } }
+
+    def __len__(self):
+        return len(self.nodes)
+
+    def column(self, field):
+        ''' the values of field for every row '''
+
+        if field in live_fields:
+            return [getattr(node, field, None) for node in self.nodes]
+
+        col = self.columns.get(field)
+        if col is None:
+            self._load_field(field)
+            col = [node.get(field) for node in self.nodes]
+            self.columns[field] = col
+        return col
+
+    def _load_field(self, field):
+        ''' have the cloud load a field its nodes don't keep for every row in one go, not a call per node '''
+
+        cloud = getattr(self.nodes[0], 'cloud', None) if self.nodes else None
+        if hasattr(cloud, 'load_field'):
+            cloud.load_field(self.nodes, field)
+
+    def index(self, field):
+        ''' { value : set(rows) } for the values of field that are set '''
+
+        if field in live_fields:
+            return self._build_index(self.column(field))
+
+        idx = self.indexes.get(field)
+        if idx is None:
+            idx = self._build_index(self.column(field))
+            self.indexes[field] = idx
+        return idx
+
+    def _build_index(self, column):
+        idx = {}
+        for row, val in enumerate(column):
+            if val is None or val == '':
+                continue
+            try:
+                idx.setdefault(val, set()).add(row)
+            except TypeError:
+                # unhashable values (lists, dicts) can only be matched by the tag table
+                pass
+        return idx
+
+    def tag_table(self):
+
+        if self.tags is None:
+            tags = {}
+            for row, node in enumerate(self.nodes):
+                for tagkey, tagval in (node.get('tags') or {}).iteritems():
+                    tags.setdefault(tagkey, {}).setdefault(tagval, set()).add(row)
+            self.tags = tags
+        return self.tags
+
+    def match(self, filterkey, filterval):
+        ''' set of rows where filterkey matches the wildcard pattern filterval '''
+
+        if filterkey == 'tags':
+            return self.match_tags(*split_tag_filter(filterval))
+
+        idx = self.index(filterkey)
+
+        if not has_wildcards(filterval):
+            return set(idx.get(filterval, ()))
+
+        names = hostlist.exact_names(filterval)
+        if names is not None:
+            # a lookup per name in the range
+            rows = set()
+            for name in names:
+                rows |= idx.get(name, set())
+            return rows
+
+        valid = compile_pattern(filterval)
+        rows = set()
+        for val, valrows in idx.iteritems():
+            if isinstance(val, basestring) and valid.match(val):
+                rows |= valrows
+        return rows
+
+    def match_tags(self, fkey, fval):
+        ''' set of rows with a tag whose key matches fkey and whose value matches fval '''
+
+        tags = self.tag_table()
+
+        if has_wildcards(fkey):
+            keymatch = compile_pattern(fkey)
+            keys = [tagkey for tagkey in tags if keymatch.match(tagkey)]
+        else:
+            keys = [fkey] if fkey in tags else []
+
+        valmatch = compile_pattern(fval) if has_wildcards(fval) else None
+
+        rows = set()
+        for tagkey in keys:
+            if valmatch:
+                for tagval, valrows in tags[tagkey].iteritems():
+                    if valmatch.match(tagval):
+                        rows |= valrows
+            else:
+                rows |= tags[tagkey].get(fval, set())
+        return rows
+
+    def select(self, rows):
+        ''' the nodes at rows, in snapshot order '''
+        return [self.nodes[row] for row in sorted(rows)]
+
+    def filter(self, filterkey, filterval):
+        ''' the nodes matching filterkey=filterval, in snapshot order '''
+
+        if not filterkey:
+            return list(self.nodes)
+
+        return self.select(self.match(filterkey, filterval))
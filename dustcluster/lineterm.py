@@ -13,18 +13,30 @@
 ''' invoke commands or a shell over ssh sessions,  demultiplex the ssh output '''  
 
 import getpass
-from threading import Thread
+import pipes
+from threading import Thread, RLock, Lock
+from collections import deque
 import select
 import socket
 import sys
+import time
 import os, struct, fcntl
 
 from paramiko.py3compat import u
 import paramiko
 
+from dustcluster import bandwidth, transfer
 from dustcluster.util import setup_logger
 logger = setup_logger( __name__ )
 
+# sftp and exec channels for bulk data get a large window and packets, so a high latency link
+# isn't limited to one default 2 MB window per round trip
+bulk_window_size = 32 * 1024 * 1024
+bulk_max_packet_size = 256 * 1024
+
+# seconds between checks on nodes being prewarmed, for a dns name and then for port 22
+prewarm_poll = 5
+
 
 # Once a session has been setup a program at the remote end can be  
 # executed with SSH_MSG_CHANNEL_REQUEST, with string 'shell', 'exec', or 
@@ -38,7 +50,9 @@ class ReceiveDemux(object):
 
     def __init__(self, session_mgr):
         self.refresh_callback = None
-        self.chans = {} # { chan : receive_buffer }
+        self.chans = {} # { chan : sshterm }, guarded by lock
+        self.lock = Lock()
+        self.stop_requests = deque() # chans other threads want stopped, handled by the receive loop
         self.session_mgr = session_mgr
         self.state = 'created'
         self.thread = Thread(target=self.receive_loop)
@@ -47,13 +61,28 @@ class ReceiveDemux(object):
 
     def start(self, sshterm):
         ''' start demuxing output on this term '''
-        self.chans[sshterm.chan] = sshterm
+        with self.lock:
+            self.chans[sshterm.chan] = sshterm
 
     def stop(self, chan):
-        ''' stop receiving on chan, remove session ''' 
-        term = self.chans[chan]
-        del self.chans[chan]
-        self.session_mgr.remove_session(term)
+        ''' stop receiving on chan, remove session. Called on the receive thread ''' 
+        with self.lock:
+            term = self.chans.pop(chan, None)
+        if term:
+            self.session_mgr.remove_session(term)
+
+    def request_stop(self, chan):
+        ''' stop receiving on chan, from any thread. The receive loop stops it on its next pass '''
+        self.stop_requests.append(chan)
+
+    def get_term(self, chan):
+        with self.lock:
+            return self.chans.get(chan)
+
+    def terms(self):
+        ''' snapshot of [(chan, sshterm)] '''
+        with self.lock:
+            return self.chans.items()
 
     def shutdown(self):
         ''' shut down receiver thread '''
@@ -62,14 +91,19 @@ class ReceiveDemux(object):
 
     def handle_read(self, achan):
         try:
+            sshterm = self.get_term(achan)
+            if not sshterm:
+                # stopped since the select
+                return
+
             readbytes = u(achan.recv(1024))
+            bandwidth.consume_interactive(len(readbytes))
             if len(readbytes) == 0:
                 sys.stdout.write('\r\SSH session disconnected.\r\n')
                 sys.stdout.flush()
                 self.stop(achan)
                 return
 
-            sshterm = self.chans[achan]
             if sshterm.raw_shell_mode:
                 sys.stdout.write(readbytes)
                 sys.stdout.flush()
@@ -81,6 +115,10 @@ class ReceiveDemux(object):
             sys.stdout.write('\r\SSH session timedout.\r\n')
             sys.stdout.flush()
             self.stop(achan)
+        except Exception, e:
+            # one bad channel must not end the receive loop for every session
+            logger.debug('Error reading from ssh channel, closing session: %s\r\n' % e)
+            self.handle_err(achan)
 
     def handle_err(self, achan):
         try:
@@ -94,7 +132,7 @@ class ReceiveDemux(object):
         try:
 
             wrote_output = False
-            for chan, sshterm in  self.chans.iteritems():
+            for chan, sshterm in self.terms():
 
                 if not sshterm.recvbuf:
                     continue
@@ -118,6 +156,11 @@ class ReceiveDemux(object):
                         continue
 
                 if sshterm.recvbuf.strip():
+                    self.capture_output(sshterm)
+
+                if not sshterm.recvbuf.strip():
+                    sshterm.recvbuf = u('')
+                else:
                     sys.stdout.write('\n')
                     prefix = "\n\033[1m[%s]\033[21m " % sshterm.node.name
                     sys.stdout.write(prefix)
@@ -136,12 +179,45 @@ class ReceiveDemux(object):
             logger.exception('Error on receive loop, ssh session in bad state.\r\n')
 
 
+    def capture_output(self, sshterm):
+        '''
+        record the buffered output of a term under its run. Once the run has printed its end marker
+        the run is over, and later output on this shell (background jobs, noise) is not captured under it.
+        The marker is removed from the buffer.
+        '''
+
+        text = sshterm.recvbuf
+        pos = text.find(SSHTerm.run_end_guid) if sshterm.run_id else -1
+        capture = self.session_mgr.capture
+
+        if pos == -1:
+            if capture:
+                capture.record(sshterm.run_id, sshterm.node.name, text)
+            return
+
+        done, rest = text[:pos], text[pos + len(SSHTerm.run_end_guid):]
+        if done.endswith('\r\n'):
+            done = done[:-2]
+        elif done.endswith('\n'):
+            done = done[:-1]
+
+        if capture and done.strip():
+            capture.record(sshterm.run_id, sshterm.node.name, done)
+
+        sshterm.run_id = None
+        rest = rest.lstrip('\r\n')
+        sshterm.recvbuf = done + '\n' + rest if done and rest else done + rest
+
     def receive_loop(self):
         ''' demux receive loop '''
 
 
         while self.state != 'shutdown':
-            r, w, e = select.select(self.chans, [], self.chans, 0.25)
+            while self.stop_requests:
+                self.handle_err(self.stop_requests.popleft())
+
+            chans = [chan for chan, _ in self.terms()]
+            r, w, e = select.select(chans, [], chans, 0.25)
             if r:
                 for achan in r:
                     self.handle_read(achan)
@@ -162,9 +238,12 @@ class SessionManager(object):
         registers/unregisters ssh sessions with the demultiplexer 
     '''
 
-    def __init__(self):
+    def __init__(self, capture=None):
+        self.capture = capture
+        self.lock = RLock()
         self.demux = ReceiveDemux(self)
         self.session_map = {}
+        self.monitor = SessionMonitor(self)
 
     def remove_session(self, term):
     
@@ -173,19 +252,47 @@ class SessionManager(object):
             term.raw_shell_mode = True
             term.revert_tty()
 
-        for nodeid, nodeterm in self.session_map.items():
-            if nodeterm == term:
-                del self.session_map[nodeid]
+        with self.lock:
+            for nodeid, nodeterm in self.session_map.items():
+                if nodeterm == term:
+                    del self.session_map[nodeid]
+
+                    # the transport went away under us (as opposed to an exit from the shell)
+                    if term.state != 'shutdown' and not (term.transport and term.transport.is_active()):
+                        self.monitor.session_dropped(nodeid, term)
+
+    def add_session(self, nodeid, term):
+        ''' register a logged in term with the demultiplexer, returns the registered term 
+            if another thread got there first, that session is kept and this one is closed '''
+        with self.lock:
+            existing = self.session_map.get(nodeid)
+            if existing and existing is not term:
+                term.shutdown()
+                return existing
+
+            self.demux.start(term)
+            self.session_map[nodeid] = term
+            self.monitor.forget(nodeid)
+            return term
 
     def shutdown(self):
-        for term in self.session_map.values():
-            term.shutdown()
+        self.monitor.shutdown()
+
+        with self.lock:
+            for term in self.session_map.values():
+                term.shutdown()
 
         self.demux.shutdown()
 
-    def term_from_node(self, node, keyfile, rawshell=False):
+    def get_term(self, nodeid):
+        with self.lock:
+            return self.session_map.get(nodeid)
+
+    def term_from_node(self, node, keyfile, rawshell=False, interactive=True):
+        ''' the logged in term for node, logging in if needed. 
+            interactive=False for background logins, which must not prompt for a key passphrase '''
 
-        term = self.session_map.get(node.get('id'))
+        term = self.get_term(node.get('id'))
 
         if not term:
             term = SSHTerm(node, keyfile)
@@ -194,17 +301,142 @@ class SessionManager(object):
             if not rawshell:
                 term.login_guid_found = False
                 cookie = True
-            term.login(cookie)
-            self.demux.start(term)
-            self.session_map[node.get('id')] = term
+            term.login(cookie, interactive)
+            term = self.add_session(node.get('id'), term)
 
         if not term.is_connected():
             logger.info('no ssh connection, logging in')
-            term.login()
+            term.login(interactive=interactive)
 
         return term
 
 
+class SessionMonitor(object):
+    '''
+    background health check of ssh sessions. 
+    Sessions whose transport drops are logged back in, in parallel, with exponential backoff, 
+    so that the next command finds a live session. Nodes that keep dropping are reported as flapping.
+    '''
+
+    interval        = 15        # seconds between health checks
+    min_backoff     = 5         # seconds before the first reconnect attempt
+    max_backoff     = 300
+    max_attempts    = 10
+    flap_window     = 600       # seconds
+    flap_count      = 3         # drops inside flap_window that make a node flapping
+
+    def __init__(self, session_mgr):
+        self.session_mgr = session_mgr
+        self.dropped = {}       # { nodeid : [term, attempts, next_attempt_time] }
+        self.drop_times = {}    # { nodeid : deque of drop times }
+        self.flapping = set()
+        self.lock = Lock()      # guards the above, sessions drop on the demux thread and reconnect on others
+        self.state = 'running'
+
+        self.thread = Thread(target=self.monitor_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def session_dropped(self, nodeid, term):
+        ''' schedule a dropped session for reconnection '''
+
+        now = time.time()
+        with self.lock:
+            times = self.drop_times.setdefault(nodeid, deque(maxlen=self.flap_count))
+            times.append(now)
+
+            if len(times) == self.flap_count and now - times[0] < self.flap_window:
+                if nodeid not in self.flapping:
+                    logger.warning('%s: ssh session is flapping, dropped %d times in the last %d minutes' % 
+                                    (term.node.name, len(times), (now - times[0]) / 60 + 1))
+                self.flapping.add(nodeid)
+            else:
+                self.flapping.discard(nodeid)
+
+            self.dropped[nodeid] = [term, 0, now + self.min_backoff]
+
+        logger.info('%s: ssh session dropped, will reconnect in the background' % term.node.name)
+
+    def forget(self, nodeid):
+        with self.lock:
+            self.dropped.pop(nodeid, None)
+
+    def shutdown(self):
+        self.state = 'shutdown'
+
+    def monitor_loop(self):
+
+        while self.state != 'shutdown':
+            time.sleep(self.interval)
+            try:
+                self.check_sessions()
+                self.reconnect_due()
+            except Exception:
+                logger.exception('Error in ssh session monitor')
+
+    def check_sessions(self):
+        ''' find sessions whose transport has died while idle '''
+
+        with self.session_mgr.lock:
+            terms = self.session_mgr.session_map.items()
+
+        for nodeid, term in terms:
+            if term.raw_shell_mode or term.state != 'connected':
+                continue
+            transport = term.transport
+            try:
+                if transport and transport.is_active():
+                    transport.send_ignore()
+                    continue
+            except Exception:
+                pass
+
+            logger.debug('%s: transport is down' % term.node.name)
+            self.session_mgr.demux.request_stop(term.chan)
+
+    def reconnect_due(self):
+        ''' reconnect all sessions whose backoff has expired, in parallel '''
+
+        now = time.time()
+        with self.lock:
+            due = [(nodeid, entry) for nodeid, entry in self.dropped.items() if entry[2] <= now]
+        if not due:
+            return
+
+        threads = []
+        for nodeid, entry in due:
+            thread = Thread(target=self.reconnect, args=(nodeid, entry))
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+
+        for thread in threads:
+            thread.join()
+
+    def reconnect(self, nodeid, entry):
+
+        term, attempts, _ = entry
+
+        try:
+            term.login_guid_found = False
+            term.login(cookie=True, interactive=False)
+            self.session_mgr.add_session(nodeid, term)
+            logger.info('%s: ssh session reconnected' % term.node.name)
+        except Exception, e:
+            attempts += 1
+            if attempts >= self.max_attempts:
+                logger.error('%s: giving up on reconnecting ssh session after %d attempts: %s' % 
+                                (term.node.name, attempts, e))
+                self.forget(nodeid)
+                return
+
+            backoff = min(self.min_backoff * 2 ** attempts, self.max_backoff)
+            logger.debug('%s: reconnect failed (%s), retrying in %ds' % (term.node.name, e, backoff))
+            with self.lock:
+                entry[1] = attempts
+                entry[2] = time.time() + backoff
+
+
 class SSHTerm(object):
     '''
     Ssh client session - starts an interactive ssh shell
@@ -215,6 +447,9 @@ class SSHTerm(object):
 
     login_complete_guid = 'B79D8677-F58A-4E09-B917-855A6619A951' # GUID
 
+    # printed by the shell when a captured command completes, see run_command
+    run_end_guid = '4C1F0E53-7A2D-4B8E-9D61-3E5A0B7C9F24' # GUID
+
     def __init__(self, node, keyfile):
         self.prompt = "dust:ssh:%s:$ " % node.name
         self.node = node
@@ -227,27 +462,34 @@ class SSHTerm(object):
 
         self.recvbuf = u('')
         self.login_guid_found = True
+        self.run_id = None # output is captured under this run
 
         self.raw_shell_mode = False
         self.oldattrs  = None
 
         self.sftp = None # sftp subservice
 
+        self.clock_offset = None # (skew, utc_offset) measured on this connection
+        self.link_speed = None   # bytes/sec measured on this connection
+
         self.echo  = True
 
     def is_connected(self):
         return self.transport and self.transport.is_authenticated() and self.transport.is_active()
 
-    def login(self, cookie=False):
+    def login(self, cookie=False, interactive=True):
         hostname = self.node.get('public_dns_name')
         username = self.node.username
 
         logger.debug('hostname=[%s], username=[%s], key=[%s]' % (hostname, username, self.keyfile))
         if not self.is_connected():
             try:
-                self.connect(hostname, username)
+                self.connect(hostname, username, interactive=interactive)
                 self.transport.set_keepalive(60*3)
                 self.state = 'connected'
+                self.clock_offset = None
+                self.link_speed = None
+                self.sftp = None
                 if cookie:
                     self.disable_echo(auxcmd= "; echo %s" % self.login_complete_guid)
                     self.echo = False
@@ -357,12 +599,91 @@ class SSHTerm(object):
             logger.info( 'ssh session not connected, authed, or active' )
             return
 
+        bandwidth.consume_interactive(len(line) + 1)
         self.chan.send(line)
         self.chan.send('\n')
 
+    def run_command(self, line, run_id):
+        '''
+        send a shell command whose output is captured under run_id. The shell prints run_end_guid
+        when the command completes, and the demux ends the run there
+        '''
+
+        self.run_id = run_id
+        if run_id:
+            # eval keeps multi line commands, trailing & and comments intact
+            line = "eval %s; printf '\\n%s\\n'" % (pipes.quote(line), self.run_end_guid)
+        self.command(line)
+
+    def get_sftp(self):
+        ''' sftp client over this session's transport, opened once and reused '''
+
+        if not self.sftp:
+            self.sftp = paramiko.SFTPClient.from_transport(self.transport, window_size=bulk_window_size,
+                                                            max_packet_size=bulk_max_packet_size)
+
+        return self.sftp
+
+    def exec_command(self, cmd):
+        ''' run cmd on a new exec channel over this session's transport, return the channel '''
+
+        if not self.is_connected():
+            raise Exception('ssh session not connected, authed, or active')
+
+        chan = self.transport.open_session(window_size=bulk_window_size, max_packet_size=bulk_max_packet_size)
+        chan.exec_command(cmd)
+        return chan
+
+    def measure_clock(self):
+        ''' return (skew, utc_offset) in seconds for the remote clock, cached per connection
+            skew is remote epoch time minus local epoch time, utc_offset is the remote timezone offset 
+        '''
+
+        if self.clock_offset:
+            return self.clock_offset
+
+        t0 = time.time()
+        chan = self.exec_command('date +%s.%N%z')
+        out = chan.makefile('r').read().strip()
+        t1 = time.time()
+        chan.close()
+
+        # e.g. 1459551231.123456789+0100
+        epoch, sign, tz = out[:-5], out[-5], out[-4:]
+        utc_offset = int(tz[:2]) * 3600 + int(tz[2:]) * 60
+        if sign == '-':
+            utc_offset = -utc_offset
+
+        skew = float(epoch) - (t0 + t1) / 2
+        logger.debug('%s: clock skew %.3fs, utc offset %ds' % (self.node.name, skew, utc_offset))
+
+        self.clock_offset = (skew, utc_offset)
+        return self.clock_offset
+
+    def measure_link_speed(self, probe_size=512*1024):
+        ''' return upload bytes/sec to this node, measured once per connection by sending incompressible data '''
+
+        if self.link_speed:
+            return self.link_speed
+
+        probe = os.urandom(probe_size)
+
+        t0 = time.time()
+        chan = self.exec_command('cat > /dev/null')
+        chan.sendall(probe)
+        chan.shutdown_write()
+        chan.recv_exit_status()
+        elapsed = time.time() - t0
+        chan.close()
+
+        self.link_speed = probe_size / max(elapsed, 0.001)
+        logger.debug('%s: link speed %.1f MB/s' % (self.node.name, self.link_speed / (1024 * 1024)))
+
+        return self.link_speed
+
     #TODO: override port from template
-    def connect(self, hostname, username, port=22):
-        ''' connect and authenticate ''' 
+    def connect(self, hostname, username, port=22, interactive=True):
+        ''' connect and authenticate. Asks for the key passphrase only if interactive ''' 
 
         private_key_path = self.keyfile 
 
@@ -379,6 +700,10 @@ class SSHTerm(object):
         try:
             key = paramiko.RSAKey.from_private_key_file(private_key_path)
         except paramiko.PasswordRequiredException:
+            if not interactive:
+                # a background thread would fight the console for the tty
+                self.transport.close()
+                raise Exception('key %s needs a passphrase, not logging in in the background' % private_key_path)
             password = getpass.getpass('RSA key password: ')
             key = paramiko.RSAKey.from_private_key_file(private_key_path, password)
 
@@ -400,8 +725,76 @@ class LineTerm(object):
     top level api - implements ssh and raw terminal functionality for a set of nodes 
     '''
 
-    def __init__(self):
-        self.session_manager = SessionManager()
+    def __init__(self, capture=None):
+        self.session_manager = SessionManager(capture)
+
+    def prewarm(self, node_keyfiles, timeout=600):
+        ''' log in to nodes in the background, so the first command finds authenticated sessions.
+            waits for port 22 to open on each node, e.g. after a start. 
+            node_keyfiles is [(node, keyfile)]
+        '''
+
+        pending = []
+        for node, keyfile in node_keyfiles:
+            if self.session_manager.get_term(node.get('id')):
+                continue
+            if key_needs_passphrase(keyfile):
+                logger.info('%s: not prewarming, key %s needs a passphrase' % (node.name, keyfile))
+                continue
+            pending.append( (node, keyfile) )
+
+        if pending:
+            thread = Thread(target=self._prewarm_nodes, args=(pending, time.time() + timeout))
+            thread.daemon = True
+            thread.start()
+
+    def _prewarm_nodes(self, node_keyfiles, deadline):
+        ''' hand each node to a login thread once it has a dns name. Starting nodes get one once they are
+            running, so they are polled for it together, with one DescribeInstances per poll for the batch
+        '''
+
+        waiting = node_keyfiles
+        while True:
+            starting = []
+            for node, keyfile in waiting:
+                if node.get('public_dns_name'):
+                    thread = Thread(target=self._prewarm_node, args=(node, keyfile, deadline))
+                    thread.daemon = True
+                    thread.start()
+                else:
+                    starting.append( (node, keyfile) )
+
+            waiting = starting
+            if not waiting:
+                return
+
+            if time.time() + prewarm_poll >= deadline:
+                break
+
+            time.sleep(prewarm_poll)
+            try:
+                update_nodes([node for node, _ in waiting])
+            except Exception, e:
+                logger.debug('prewarm: %s' % e)
+
+        for node, _ in waiting:
+            logger.debug('%s: gave up prewarming ssh session, no dns name' % node.name)
+
+    def _prewarm_node(self, node, keyfile, deadline):
+
+        hostname = node.get('public_dns_name')
+        while time.time() < deadline:
+            try:
+                if port_open(hostname, 22):
+                    self.session_manager.term_from_node(node, keyfile, interactive=False)
+                    logger.debug('%s: prewarmed ssh session' % node.name)
+                    return
+            except Exception, e:
+                logger.debug('%s: prewarm: %s' % (node.name, e))
+
+            time.sleep(prewarm_poll)
+
+        logger.debug('%s: gave up prewarming ssh session' % node.name)
 
     def set_refresh_callback(self, callback):
         '''Optional callback after a block of ssh output is written to stdout. 
@@ -409,9 +802,21 @@ class LineTerm(object):
         '''
         self.session_manager.demux.refresh_callback = callback
 
-    def command(self, keyfile, node, cmd=None):
+    def new_run(self, cmdline, nodes):
+        ''' start a new run in the capture store, returns the run id to pass to command '''
+        capture = self.session_manager.capture
+        if not capture:
+            return None
+        try:
+            return capture.new_run(cmdline, [node.name for node in nodes])
+        except Exception, e:
+            logger.error('Could not start a capture for this run: %s' % e)
+            return None
+
+    def command(self, keyfile, node, cmd=None, run_id=None):
         ''' send a command to an interactive ssh shell or enter a raw shell input loop.
             in both cases log in if not logged in. 
+            output from a command is captured under run_id
         '''
 
         term = None
@@ -422,7 +827,7 @@ class LineTerm(object):
             if cmd:
                 if term.echo:
                     term.disable_echo()
-                term.command(cmd)
+                term.run_command(cmd, run_id)
             else:
                 if not term.echo:
                     term.enable_echo()
@@ -443,59 +848,102 @@ class LineTerm(object):
 
         self.command(keyfile, node, cmd=None)
 
-    def put(self, keyfile, node, srcfile, destfile=None):
+    def exec_command(self, keyfile, node, cmd):
+        ''' run cmd on a separate exec channel (not the interactive shell), log in if not logged in.
+            returns the channel, the caller reads from it and closes it
+        '''
+        term = self.session_manager.term_from_node(node, keyfile)
+        return term.exec_command(cmd)
+
+    def clock_offset(self, keyfile, node):
+        ''' returns (skew, utc_offset) of the node's clock relative to the local clock '''
+        term = self.session_manager.term_from_node(node, keyfile)
+        return term.measure_clock()
+
+    def link_speed(self, keyfile, node):
+        ''' measured upload bytes/sec to node '''
+        term = self.session_manager.term_from_node(node, keyfile)
+        return term.measure_link_speed()
+
+    def sftp(self, keyfile, node):
+        ''' the node's sftp client, log in if not logged in '''
+        term = self.session_manager.term_from_node(node, keyfile)
+        return term.get_sftp()
+
+    def put(self, keyfile, node, srcfile, destfile=None, progress=None):
+        ''' upload srcfile to node with pipelined writes, raises on error. 
+            progress is an optional callback(bytes_so_far, total) '''
 
         if not os.path.isfile(srcfile):
-            logger.error('file does not exist locally : %s' % srcfile)
-            return
+            raise Exception('file does not exist locally : %s' % srcfile)
 
-        try:
-            term = self.session_manager.term_from_node(node, keyfile)
-            if not term.sftp:
-                term.sftp = paramiko.SFTPClient.from_transport(term.transport)
-
-            sftp = term.sftp
-            fname = os.path.basename(srcfile)
-            if not destfile:
-                destfile = fname
-            ret = sftp.put(srcfile, destfile, confirm=True)
-
-            if not getattr(ret, 'filename', None):
-                ret.filename = os.path.basename(destfile)
-            
-            logger.info('uploaded to %s : %s' % (node.name, ret))
-        except Exception, e:
-            logger.error(e)
+        term = self.session_manager.term_from_node(node, keyfile)
+        sftp = term.get_sftp()
+
+        fname = os.path.basename(srcfile)
+        if not destfile:
+            destfile = fname
+        size = transfer.sftp_put(sftp, srcfile, destfile, progress, confirm=True)
 
+        logger.info('uploaded to %s : %s (%d bytes)' % (node.name, destfile, size))
 
-    def get(self, keyfile, node, remotefile, localdir):
+    def get(self, keyfile, node, remotefile, localdir, localname=None, progress=None):
+        ''' download remotefile from node to localdir/remotefile.nodename, raises on error 
+            localname replaces the basename of remotefile in the local file name 
+            progress is an optional callback(bytes_so_far, total) '''
 
         if localdir and not os.path.isdir(localdir):
-            logger.error('dir does not exist locally : %s' % localdir)
-            return
+            raise Exception('dir does not exist locally : %s' % localdir)
 
-        try:
-            term = self.session_manager.term_from_node(node, keyfile)
-            if not term.sftp:
-                term.sftp = paramiko.SFTPClient.from_transport(term.transport)
+        term = self.session_manager.term_from_node(node, keyfile)
+        sftp = term.get_sftp()
 
-            fname = os.path.basename(remotefile)
-            if localdir:
-                localfile = os.path.join(localdir, fname)
-            else:
-                localfile = fname
+        fname = localname or os.path.basename(remotefile)
+        if localdir:
+            localfile = os.path.join(localdir, fname)
+        else:
+            localfile = fname
 
-            localfile = '%s.%s' % (localfile, node.name)
+        localfile = '%s.%s' % (localfile, node.name)
 
-            sftp = term.sftp
-            logger.info('getting %s' % (remotefile))
+        logger.info('getting %s' % (remotefile))
 
-            sftp.get(remotefile, localfile)
+        transfer.sftp_get(sftp, remotefile, localfile, progress)
 
-            logger.info('downloaded from %s : %s' % (node.name, localfile))
-        except Exception, e:
-            logger.error(e)
+        logger.info('downloaded from %s : %s' % (node.name, localfile))
 
     def shutdown(self):
         self.session_manager.shutdown()
 
+
+def update_nodes(nodes):
+    ''' refresh nodes from their clouds, one batch per cloud '''
+
+    clouds = {}
+    for node in nodes:
+        clouds.setdefault(node.cloud, []).append(node)
+
+    for cloud, cloud_nodes in clouds.items():
+        cloud.update_nodes(cloud_nodes)
+
+
+def port_open(hostname, port, timeout=3):
+    ''' probe a tcp port '''
+    try:
+        sock = socket.create_connection((hostname, port), timeout)
+        sock.close()
+        return True
+    except (socket.error, socket.timeout):
+        return False
+
+
+def key_needs_passphrase(keyfile):
+    ''' True if the private key is encrypted '''
+    try:
+        paramiko.RSAKey.from_private_key_file(keyfile)
+    except paramiko.PasswordRequiredException:
+        return True
+    except Exception:
+        # unreadable or not a key, the login reports it
+        pass
+    return False
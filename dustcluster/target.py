@@ -0,0 +1,372 @@
+# Copyright (c) Ran Dugal 2014
+#
+# This file is part of dust.
+#
+# Licensed under the GNU Affero General Public License v3, which is available at
+# http://www.gnu.org/licenses/agpl-3.0.html
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero GPL for more details.
+#
+
+'''
+target expressions: select nodes with predicates combined by & (and), | (or), ! (not) and parens
+
+    worker*                         node name, wildcards allowed
+    state=running                   attribute or friendly name, wildcards allowed
+    tags=role:master                tag key:value, wildcards allowed on both
+    state!=running                  not equal
+    worker[1-250,300-310]           numeric ranges, see dustcluster.hostlist
+    name~^worker[0-9]+$             python regex, on an attribute, or on the name if the key is left out
+    ami_launch_index>=2             numeric comparison (string comparison if either side is not a number,
+                                    so launch_time<2016-03 works)
+    cluster:etl                     nodes in cluster etl
+
+    cluster:etl & type=m5.* & !tags=role:master
+    (state=stopped | state=stopping) & worker*
+
+Parts of a value with special characters can be quoted, e.g. name~'worker(1|2)'.
+Quote the whole expression on the command line if it has spaces.
+'''
+
+import re
+
+from dustcluster import hostlist
+from dustcluster.inventory import has_wildcards, split_tag_filter, compile_pattern
+from dustcluster.util import setup_logger
+logger = setup_logger( __name__ )
+
+
+class TargetError(Exception):
+    pass
+
+
+# comparison operators, two character ones first
+operators = ['!=', '>=', '<=', '=', '~', '>', '<']
+
+special_chars = '()&|'
+
+
+def split_target(cmdline):
+    ''' split a command line into (target, rest). A target in quotes can have spaces in it '''
+
+    cmdline = cmdline.strip()
+    if not cmdline:
+        return "", ""
+
+    if cmdline[0] in '"\'':
+        end = cmdline.find(cmdline[0], 1)
+        if end > 0:
+            return cmdline[1:end], cmdline[end+1:].strip()
+        # no closing quote, parse() reports it
+
+    parts = cmdline.split(None, 1)
+    return parts[0], parts[1] if len(parts) > 1 else ""
+
+
+def tokenize(text):
+    ''' list of '(', ')', '&', '|', '!' and predicate strings '''
+
+    tokens = []
+    i = 0
+    while i < len(text):
+        c = text[i]
+        if c.isspace():
+            i += 1
+        elif c in special_chars or c == '!':
+            tokens.append(c)
+            i += 1
+        else:
+            pred = []
+            while i < len(text) and not text[i].isspace() and text[i] not in special_chars:
+                if text[i] in '"\'':
+                    end = text.find(text[i], i+1)
+                    if end < 0:
+                        raise TargetError('no closing quote in %s' % text)
+                    pred.append(text[i+1:end])
+                    i = end + 1
+                else:
+                    pred.append(text[i])
+                    i += 1
+            tokens.append(''.join(pred))
+    return tokens
+
+
+def parse(text):
+    ''' parse a target expression into a tree of And, Or, Not and predicates, raises TargetError '''
+
+    parser = Parser(tokenize(text))
+    expr = parser.parse_or()
+    if parser.pos != len(parser.tokens):
+        raise TargetError('unexpected %s' % parser.tokens[parser.pos])
+    return expr
+
+
+class Parser(object):
+    '''
+    expr  := and ('|' and)*
+    and   := unary ('&' unary)*
+    unary := '!' unary | '(' expr ')' | predicate
+    '''
+
+    def __init__(self, tokens):
+        self.tokens = tokens
+        self.pos = 0
+
+    def peek(self):
+        if self.pos < len(self.tokens):
+            return self.tokens[self.pos]
+        return None
+
+    def next(self):
+        token = self.peek()
+        if token is None:
+            raise TargetError('unexpected end of target')
+        self.pos += 1
+        return token
+
+    def parse_or(self):
+        terms = [self.parse_and()]
+        while self.peek() == '|':
+            self.next()
+            terms.append(self.parse_and())
+        return terms[0] if len(terms) == 1 else Or(terms)
+
+    def parse_and(self):
+        terms = [self.parse_unary()]
+        while self.peek() == '&':
+            self.next()
+            terms.append(self.parse_unary())
+        return terms[0] if len(terms) == 1 else And(terms)
+
+    def parse_unary(self):
+        token = self.next()
+        if token == '!':
+            return Not(self.parse_unary())
+        if token == '(':
+            expr = self.parse_or()
+            if self.next() != ')':
+                raise TargetError('expected )')
+            return expr
+        if token in special_chars:
+            raise TargetError('unexpected %s' % token)
+        return parse_predicate(token)
+
+
+def parse_predicate(text):
+
+    if text.startswith('cluster:'):
+        return Predicate('cluster', '=', text[len('cluster:'):])
+
+    for i in range(len(text)):
+        for op in operators:
+            if text.startswith(op, i):
+                key, value = text[:i], text[i+len(op):]
+                if not key and op != '~':
+                    raise TargetError('no attribute before %s in %s' % (op, text))
+                if key == 'tags' and op in ('=', '!=', '~') and not split_tag_filter(value)[0]:
+                    raise TargetError('use tags=key:value, got %s' % text)
+                return Predicate(key or 'name', op, value)
+
+    # a bare word is a node name
+    return Predicate('name', '=', text)
+
+
+class Predicate(object):
+
+    def __init__(self, key, op, value):
+        self.key = key
+        self.op = op
+        self.value = value
+        self.regex = None
+
+        if op == '~':
+            pattern = split_tag_filter(value)[1] if key == 'tags' else value
+            try:
+                self.regex = re.compile(pattern)
+            except re.error, e:
+                raise TargetError('bad regex %s: %s' % (pattern, e))
+
+        if op in ('=', '!='):
+            # check ranges up front, the table compiles them again from the cache
+            for pattern in (split_tag_filter(value) if key == 'tags' else [value]):
+                try:
+                    compile_pattern(pattern)
+                except ValueError, e:
+                    raise TargetError(str(e))
+
+    def __repr__(self):
+        return '%s%s%s' % (self.key, self.op, self.value)
+
+    def plan_cost(self, table):
+        ''' (rank, estimated rows) to order the terms of an And, cheapest and most selective first '''
+
+        if self.op == '=' and not has_wildcards(self.value):
+            if self.key == 'tags':
+                tagkey, tagval = split_tag_filter(self.value)
+                if not has_wildcards(tagkey):
+                    return 0, len(table.tag_table().get(tagkey, {}).get(tagval, ()))
+            else:
+                return 0, len(table.index(self.key).get(self.value, ()))
+
+        if self.op == '=' and self.key != 'tags':
+            names = hostlist.exact_names(self.value)
+            if names is not None:
+                index = table.index(self.key)
+                return 0, sum(len(index.get(name, ())) for name in names)
+
+        if self.op == '=':
+            return 1, len(table)
+
+        return 2, len(table)
+
+    def rows(self, table):
+
+        if self.op == '=':
+            return table.match(self.key, self.value)
+
+        if self.op == '!=':
+            return all_rows(table) - table.match(self.key, self.value)
+
+        if self.key == 'tags':
+            return self.tag_rows(table)
+
+        rows = set()
+        for val, valrows in table.index(self.key).iteritems():
+            if self.test(val):
+                rows |= valrows
+        return rows
+
+    def tag_rows(self, table):
+        ''' tags~key:regex, or a comparison on the values of a tag, e.g. tags>=priority:5 '''
+
+        tagkey, tagval = split_tag_filter(self.value)
+        rows = set()
+        for key, values in table.tag_table().iteritems():
+            if key != tagkey and not (has_wildcards(tagkey) and compile_pattern(tagkey).match(key)):
+                continue
+            for val, valrows in values.iteritems():
+                if self.op == '~':
+                    ok = self.regex.search(val)
+                else:
+                    ok = compare(val, self.op, tagval)
+                if ok:
+                    rows |= valrows
+        return rows
+
+    def test(self, val):
+        if not isinstance(val, basestring):
+            val = str(val)
+        if self.op == '~':
+            return self.regex.search(val)
+        return compare(val, self.op, self.value)
+
+    def api_filters(self, cluster):
+        if self.op != '=':
+            return None
+        if self.key == 'cluster':
+            if self.value not in cluster.clusters:
+                return None
+            return cluster.cloud.api_filters(*cluster.cluster_filter(self.value))
+        return cluster.cloud.api_filters(self.key, self.value)
+
+
+def compare(val, op, other):
+    ''' numeric comparison if both sides are numbers, else string comparison '''
+
+    try:
+        left, right = float(val), float(other)
+    except (TypeError, ValueError):
+        left, right = val, other
+
+    if op == '>':
+        return left > right
+    if op == '<':
+        return left < right
+    if op == '>=':
+        return left >= right
+    if op == '<=':
+        return left <= right
+    return False
+
+
+def all_rows(table):
+    return set(xrange(len(table)))
+
+
+class And(object):
+
+    def __init__(self, terms):
+        self.terms = terms
+
+    def __repr__(self):
+        return '(%s)' % ' & '.join(repr(term) for term in self.terms)
+
+    def plan_cost(self, table):
+        return 3, len(table)
+
+    def plan(self, table):
+        ''' the terms, cheapest and most selective first '''
+        return sorted(self.terms, key=lambda term: term.plan_cost(table))
+
+    def rows(self, table):
+        rows = None
+        for term in self.plan(table):
+            term_rows = term.rows(table)
+            rows = term_rows if rows is None else rows & term_rows
+            if not rows:
+                # nothing left, skip the more expensive terms
+                break
+        return rows
+
+    def api_filters(self, cluster):
+        ''' all terms must hold, so any term that can be pushed down is '''
+
+        filters = {}
+        for term in self.terms:
+            term_filters = term.api_filters(cluster)
+            for name, value in (term_filters or {}).items():
+                if filters.get(name, value) != value:
+                    continue
+                filters[name] = value
+        return filters or None
+
+
+class Or(object):
+
+    def __init__(self, terms):
+        self.terms = terms
+
+    def __repr__(self):
+        return '(%s)' % ' | '.join(repr(term) for term in self.terms)
+
+    def plan_cost(self, table):
+        return 3, len(table)
+
+    def rows(self, table):
+        rows = set()
+        for term in self.terms:
+            rows |= term.rows(table)
+        return rows
+
+    def api_filters(self, cluster):
+        return None
+
+
+class Not(object):
+
+    def __init__(self, term):
+        self.term = term
+
+    def __repr__(self):
+        return '!%r' % self.term
+
+    def plan_cost(self, table):
+        return 3, len(table)
+
+    def rows(self, table):
+        return all_rows(table) - self.term.rows(table)
+
+    def api_filters(self, cluster):
+        return None
@@ -0,0 +1,1149 @@
+# Copyright (c) Ran Dugal 2014
+#
+# This file is part of dust.
+#
+# Licensed under the GNU Affero General Public License v3, which is available at
+# http://www.gnu.org/licenses/agpl-3.0.html
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU Affero GPL for more details.
+#
+
+''' run file transfers on a set of nodes concurrently, and summarize the results per node '''
+
+import os
+import sys
+import time
+import mmap
+import stat
+import pipes
+import fnmatch
+import tarfile
+import heapq
+import Queue
+import random
+import hashlib
+import posixpath
+from threading import Lock, Thread
+from multiprocessing.pool import ThreadPool
+
+import yaml
+
+from dustcluster import bandwidth
+from dustcluster.util import setup_logger
+logger = setup_logger( __name__ )
+
+
+default_workers = 10
+
+# bytes handed to an sftp file per write
+chunk_size = 1024 * 1024
+
+# read requests in flight per remote file, see iter_remote_blocks
+read_window = 4 * chunk_size
+
+# directory transfers are gzipped on links slower than this (bytes/sec)
+compress_below = 20 * 1024 * 1024
+
+
+class ProgressMeter(object):
+    '''
+    bytes done, throughput and ETA of a set of concurrent transfer streams.
+    While streams are running, a display thread redraws a live per node and aggregate view on the terminal
+    every second. Streams that move no bytes for stall_secs are flagged as stalled.
+    '''
+
+    stall_secs = 15
+    max_rows = 10
+
+    def __init__(self):
+        self.lock = Lock()
+        self.streams = {}   # { (nodename, item) : [done, total, start_time, last_progress_time, finished] }
+        self.thread = None
+        self.running = False
+        self.rows_drawn = 0
+        self.stalled = set()
+
+    def callback(self, nodename, item):
+        ''' returns a callback(bytes_so_far, total) for one stream. total can be 0 if unknown '''
+
+        key = (nodename, item)
+        now = time.time()
+        with self.lock:
+            self.streams[key] = [0, 0, now, now, False]
+
+        self.start_display()
+
+        def update(bytes_so_far, total):
+            with self.lock:
+                stream = self.streams[key]
+                if bytes_so_far != stream[0]:
+                    stream[3] = time.time()
+                stream[0] = bytes_so_far
+                stream[1] = total
+                if total and bytes_so_far >= total:
+                    stream[4] = True
+
+        return update
+
+    def finish(self, nodename, item):
+        with self.lock:
+            stream = self.streams.get( (nodename, item) )
+            if stream:
+                stream[4] = True
+                stream[3] = time.time()
+
+    def start_display(self):
+        if self.running or not sys.stdout.isatty():
+            return
+        self.running = True
+        self.thread = Thread(target=self.display_loop)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop_display(self):
+        self.running = False
+        if self.thread:
+            self.thread.join()
+            self.thread = None
+
+    def display_loop(self):
+        while self.running:
+            time.sleep(1)
+            self.draw()
+        self.clear()
+
+    def check_stalls(self):
+        now = time.time()
+        for (nodename, item), (done, total, start, last, finished) in self.streams.items():
+            if finished or now - last < self.stall_secs:
+                continue
+            if (nodename, item) not in self.stalled:
+                self.stalled.add( (nodename, item) )
+                logger.warning('%s: transfer of %s stalled, no progress for %d sec' % (nodename, item, now - last))
+
+    def draw(self):
+
+        with self.lock:
+            self.check_stalls()
+            streams = self.streams.items()
+
+        now = time.time()
+        rows = []
+        active = [(key, s) for key, s in streams if not s[4]]
+        # slowest streams first
+        active.sort(key=lambda (key, s): s[0] / max(now - s[2], 0.001))
+        for (nodename, item), (done, total, start, last, finished) in active[:self.max_rows]:
+            rate = done / max(now - start, 0.001)
+            flag = ' STALLED' if now - last >= self.stall_secs else ''
+            rows.append('  %-12s %-30s %s' % (nodename, os.path.basename(str(item))[-30:],
+                                                 fmt_progress(done, total, rate) + flag))
+        if len(active) > self.max_rows:
+            rows.append('  ... %d more' % (len(active) - self.max_rows))
+
+        done, total, rate = self.totals(now)
+        rows.append('  %d/%d streams done %s' % (len(streams) - len(active), len(streams),
+                                                 fmt_progress(done, total, rate)))
+
+        self.clear()
+        sys.stdout.write('\n'.join(rows) + '\n')
+        sys.stdout.flush()
+        self.rows_drawn = len(rows)
+
+    def clear(self):
+        if self.rows_drawn:
+            sys.stdout.write('\033[%dA\033[J' % self.rows_drawn)
+            sys.stdout.flush()
+            self.rows_drawn = 0
+
+    def totals(self, now=None):
+        ''' (bytes done, bytes total, bytes/sec) over all streams '''
+
+        now = now or time.time()
+        with self.lock:
+            streams = self.streams.values()
+        if not streams:
+            return 0, 0, 0.0
+        done = sum(s[0] for s in streams)
+        total = sum(s[1] for s in streams)
+        start = min(s[2] for s in streams)
+        return done, total, done / max(now - start, 0.001)
+
+    def node_rates(self):
+        ''' { nodename : (bytes, bytes/sec) } '''
+
+        ret = {}
+        with self.lock:
+            for (nodename, item), (done, total, start, last, finished) in self.streams.items():
+                nbytes, secs = ret.get(nodename, (0, 0.0))
+                ret[nodename] = (nbytes + done, secs + max(last - start, 0.001))
+        return dict((nodename, (nbytes, nbytes / secs)) for nodename, (nbytes, secs) in ret.items())
+
+
+def fmt_bytes(nbytes):
+    for unit in ['B', 'KB', 'MB', 'GB']:
+        if nbytes < 1024:
+            return '%.1f %s' % (nbytes, unit)
+        nbytes /= 1024.0
+    return '%.1f TB' % nbytes
+
+
+def fmt_progress(done, total, rate):
+    ''' e.g. 1.2 GB/4.0 GB  31.0 MB/s  ETA 0:01:32 '''
+
+    ret = '%s' % fmt_bytes(done)
+    if total:
+        ret += '/%s' % fmt_bytes(total)
+    ret += '  %s/s' % fmt_bytes(rate)
+    if total and rate and done < total:
+        eta = int((total - done) / rate)
+        ret += '  ETA %d:%02d:%02d' % (eta / 3600, eta % 3600 / 60, eta % 60)
+    return ret
+
+
+class TransferSummary(object):
+    ''' collects per node results and progress of a set of transfers '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.done = {}      # { nodename : [item] }
+        self.failed = {}    # { nodename : [(item, error)] }
+        self.start_time = time.time()
+        self.meter = ProgressMeter()
+
+    def progress(self, nodename, item):
+        ''' a callback(bytes_so_far, total) that feeds the progress meter for one stream '''
+        return self.meter.callback(nodename, item)
+
+    def success(self, nodename, item):
+        self.meter.finish(nodename, item)
+        with self.lock:
+            self.done.setdefault(nodename, []).append(item)
+
+    def failure(self, nodename, item, error):
+        self.meter.finish(nodename, item)
+        with self.lock:
+            self.failed.setdefault(nodename, []).append( (item, error) )
+
+    def log(self, op, capture=None, cmdline=''):
+        ''' log a per node summary. if a capture store is passed, the summary is also saved as a run there '''
+
+        self.meter.stop_display()
+
+        elapsed = time.time() - self.start_time
+        nodenames = sorted(set(self.done.keys()) | set(self.failed.keys()))
+
+        for nodename in nodenames:
+            done = self.done.get(nodename, [])
+            failed = self.failed.get(nodename, [])
+            if not failed:
+                logger.debug('%s: %s ok for %d files' % (nodename, op, len(done)))
+                continue
+            logger.error('%s: %s failed for %d of %d files:' % (nodename, op, len(failed), len(done) + len(failed)))
+            for item, error in failed:
+                logger.error('    %s : %s' % (item, error))
+
+        num_failed = len(self.failed)
+        logger.info('%s: %d nodes ok, %d nodes with errors, in %.1f sec' %
+                        (op, len(nodenames) - num_failed, num_failed, elapsed))
+
+        nbytes, _, _ = self.meter.totals()
+        node_rates = self.meter.node_rates()
+        if nbytes:
+            logger.info('%s: %s in %.1f sec, %s/s' % (op, fmt_bytes(nbytes), elapsed,
+                                                      fmt_bytes(nbytes / max(elapsed, 0.001))))
+
+        if capture:
+            self.save(capture, op, cmdline, nodenames, node_rates)
+
+    def save(self, capture, op, cmdline, nodenames, node_rates):
+        ''' write the results and throughput to the capture store as a run '''
+
+        try:
+            run_id = capture.new_run('%s %s' % (op, cmdline), nodenames)
+            for nodename in nodenames:
+                nbytes, rate = node_rates.get(nodename, (0, 0.0))
+                lines = ['%s: %d ok, %d failed, %s at %s/s' % (op, len(self.done.get(nodename, [])),
+                                            len(self.failed.get(nodename, [])), fmt_bytes(nbytes), fmt_bytes(rate))]
+                for item, error in self.failed.get(nodename, []):
+                    lines.append('failed %s : %s' % (item, error))
+                capture.record(run_id, nodename, '\n'.join(lines))
+        except Exception, e:
+            logger.debug('could not save transfer summary: %s' % e)
+
+    @property
+    def ok(self):
+        return not self.failed
+
+
+def for_each_node(node_jobs, func, workers=None, summary=None):
+    '''
+    node_jobs: [(node, keyfile, [items])]
+    calls func(node, keyfile, item) for every item. Nodes run concurrently on up to workers threads,
+    the items for one node run in order on one thread, so each node's sftp session is used by one thread.
+    returns a TransferSummary
+    '''
+
+    if summary is None:
+        summary = TransferSummary()
+
+    def run_node(job):
+        node, keyfile, items = job
+        for item in items:
+            try:
+                func(node, keyfile, item)
+                summary.success(node.name, item)
+            except Exception, e:
+                logger.debug('%s: %s : %s' % (node.name, item, e))
+                summary.failure(node.name, item, e)
+
+    if not node_jobs:
+        return summary
+
+    pool = ThreadPool(min(workers or default_workers, len(node_jobs)))
+    try:
+        pool.map(run_node, node_jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    return summary
+
+
+def for_each_file(jobs, func, workers=None, summary=None):
+    '''
+    jobs: [(node, keyfile, item)]
+    calls func(node, keyfile, item) for every job, all jobs run concurrently on up to workers threads.
+    (a node's sftp client can be shared by threads)
+    returns a TransferSummary
+    '''
+
+    if summary is None:
+        summary = TransferSummary()
+
+    def run_job(job):
+        node, keyfile, item = job
+        try:
+            func(node, keyfile, item)
+            summary.success(node.name, item)
+        except Exception, e:
+            logger.debug('%s: %s : %s' % (node.name, item, e))
+            summary.failure(node.name, item, e)
+
+    if not jobs:
+        return summary
+
+    pool = ThreadPool(min(workers or default_workers, len(jobs)))
+    try:
+        pool.map(run_job, jobs)
+    finally:
+        pool.close()
+        pool.join()
+
+    return summary
+
+
+def sftp_put(sftp, srcfile, destfile, progress=None, confirm=True):
+    '''
+    upload srcfile with pipelined writes: chunks are sent without waiting for each write to be acked,
+    so many requests are in flight and a high latency link stays full. Errors surface at close.
+    The same writer as resumable_put (the put command), without the resume state.
+    With confirm, the remote size is checked with a stat, skip it when the caller verifies some other way.
+    returns the number of bytes sent
+    '''
+
+    size = os.path.getsize(srcfile)
+    _put_chunks(sftp, srcfile, None, destfile, size, 0, None, None, progress or (lambda done, total: None))
+
+    if confirm:
+        remote_size = sftp.stat(sftp_path(destfile)).st_size
+        if remote_size != size:
+            raise IOError('size mismatch in put! %d != %d' % (remote_size, size))
+
+    return size
+
+
+def iter_remote_blocks(remote, size, offset=0):
+    '''
+    the contents of an open sftp file from offset to size, in blocks. The read requests of a window are
+    sent together, one round trip per window instead of one per 32 KB read, and the window is drawn from
+    the bandwidth budget before its requests go out. So a limit holds on the wire, and at most one window
+    per file is buffered
+    '''
+
+    while offset < size:
+        window = min(bandwidth.max_request(read_window), size - offset)
+        bandwidth.consume(window)
+        end = offset + window
+        chunks = [(pos, min(chunk_size, end - pos)) for pos in xrange(offset, end, chunk_size)]
+        for block in remote.readv(chunks):
+            yield block
+        offset = end
+
+
+def sftp_get(sftp, remotefile, localfile, progress=None):
+    '''
+    download remotefile a window of read requests at a time, see iter_remote_blocks.
+    returns the number of bytes received
+    '''
+
+    remote = sftp.open(sftp_path(remotefile), 'rb')
+    try:
+        size = remote.stat().st_size
+        done = 0
+        with open(localfile, 'wb') as fh:
+            for block in iter_remote_blocks(remote, size):
+                fh.write(block)
+                done += len(block)
+                if progress:
+                    progress(done, size)
+    finally:
+        remote.close()
+
+    if done != size:
+        raise IOError('size mismatch in get! %d != %d' % (done, size))
+
+    return size
+
+
+def shell_path(path):
+    ''' quote a remote path for the shell, leaving a leading ~/ to be expanded '''
+
+    if path == '~':
+        return path
+    if path.startswith('~/'):
+        return '~/%s' % pipes.quote(path[2:])
+    return pipes.quote(path)
+
+
+def sftp_path(path):
+    ''' sftp starts in the login user's home dir and does not expand ~, so ~/logs is logs '''
+
+    if path == '~':
+        return '.'
+    if path.startswith('~/'):
+        return path[2:] or '.'
+    return path
+
+
+def has_magic(path):
+    return any(c in path for c in '*?[')
+
+
+def expand_remote_glob(sftp, pattern):
+    '''
+    expand a remote path with wildcards in any component, e.g. /var/log/*/app*.log, to the list of 
+    matching regular files, with one sftp listdir per directory visited
+    '''
+
+    if not has_magic(pattern):
+        return [pattern]
+
+    pattern = sftp_path(pattern)
+    if pattern.startswith('/'):
+        dirs = ['/']
+    else:
+        dirs = ['']
+
+    parts = [part for part in pattern.split('/') if part]
+    for i, part in enumerate(parts):
+        last = (i == len(parts) - 1)
+        matched = []
+        for parent in dirs:
+            if not has_magic(part):
+                matched.append(posixpath.join(parent, part))
+                continue
+
+            try:
+                entries = sftp.listdir_attr(parent or '.')
+            except IOError:
+                continue
+
+            for entry in entries:
+                if entry.filename.startswith('.') and not part.startswith('.'):
+                    continue
+                if not fnmatch.fnmatchcase(entry.filename, part):
+                    continue
+                is_dir = stat.S_ISDIR(entry.st_mode or 0)
+                if (last and is_dir) or (not last and not is_dir):
+                    continue
+                matched.append(posixpath.join(parent, entry.filename))
+
+        dirs = matched
+
+    return sorted(dirs)
+
+
+def broadcast_put(lineterm, node_keyfiles, srcfile, destfile=None, workers=None, summary=None, state_dir=None):
+    '''
+    upload one local file to many nodes, reading it from disk once.
+    The file is memory mapped and every node writes slices of the same mapping at its own pace, 
+    so local disk reads don't grow with the number of nodes, and a slow node doesn't hold up the others.
+    The md5 is computed behind the node that is furthest along, from pages it just read, not in a pass of its own.
+    Each node's upload is a resumable_put, so a node that drops resumes where it left off.
+    node_keyfiles: [(node, keyfile)]
+    returns a TransferSummary
+    '''
+
+    if summary is None:
+        summary = TransferSummary()
+
+    with open(srcfile, 'rb') as fh:
+        size = os.fstat(fh.fileno()).st_size
+        srcmap = mmap.mmap(fh.fileno(), 0, access=mmap.ACCESS_READ) if size else ''
+
+    digest = StreamDigest(srcmap, size)
+
+    def put_node(job):
+        node, keyfile = job
+        try:
+            resumable_put(lineterm, node, keyfile, srcfile, destfile, progress=summary.progress(node.name, srcfile),
+                            state_dir=state_dir, srcmap=srcmap, digest=digest)
+            summary.success(node.name, srcfile)
+        except Exception, e:
+            logger.debug('%s: %s : %s' % (node.name, srcfile, e))
+            summary.failure(node.name, srcfile, e)
+
+    pool = ThreadPool(min(workers or default_workers, len(node_keyfiles)))
+    try:
+        pool.map(put_node, node_keyfiles)
+    finally:
+        pool.close()
+        pool.join()
+        if size:
+            srcmap.close()
+
+    return summary
+
+
+def local_md5(path, nbytes=None):
+    ''' md5 hex digest of a local file, or of its first nbytes '''
+
+    digest = hashlib.md5()
+    remaining = nbytes
+    with open(path, 'rb') as fh:
+        while remaining is None or remaining > 0:
+            block = fh.read(chunk_size if remaining is None else min(chunk_size, remaining))
+            if not block:
+                break
+            digest.update(block)
+            if remaining is not None:
+                remaining -= len(block)
+    return digest.hexdigest()
+
+
+class StreamDigest(object):
+    ''' md5 of a memory mapped file, advanced by whichever upload has read furthest into it '''
+
+    def __init__(self, srcmap, size):
+        self.srcmap = srcmap
+        self.size = size
+        self.pos = 0
+        self.md5 = hashlib.md5()
+        self.lock = Lock()
+
+    def advance(self, offset):
+        ''' an upload has read up to offset, hash the new bytes while they are still in the page cache '''
+        with self.lock:
+            if offset > self.pos:
+                self.md5.update(self.srcmap[self.pos:offset])
+                self.pos = offset
+
+    def hexdigest(self):
+        self.advance(self.size)
+        return self.md5.hexdigest()
+
+
+def remote_md5(lineterm, node, keyfile, path):
+    ''' md5 hex digest of a file on node, computed there '''
+
+    quoted = shell_path(path)
+    chan = lineterm.exec_command(keyfile, node, 'md5sum %s 2>/dev/null || md5 -q %s' % (quoted, quoted))
+    try:
+        out = chan.makefile('rb').read().split()
+    finally:
+        chan.close()
+    return out[0] if out else None
+
+
+# resumable puts save their offset this often
+resume_every = 16 * chunk_size
+
+
+def resumable_put(lineterm, node, keyfile, srcfile, destfile=None, progress=None, state_dir=None, 
+                    srcmap=None, md5=None, digest=None, retries=5):
+    '''
+    upload srcfile to node in chunks, and verify the result against an md5 computed on the node.
+    The offset of the last completed chunk is kept in a state file under state_dir, so if the connection
+    drops the upload resumes from there after logging back in, here or in a later put, instead of from byte 0.
+    srcmap is an optional mmap of srcfile to read from, md5 its digest if already known,
+    or digest a StreamDigest of srcmap to compute it along the way.
+    raises on error
+    '''
+
+    if not os.path.isfile(srcfile):
+        raise Exception('file does not exist locally : %s' % srcfile)
+
+    if not destfile:
+        destfile = os.path.basename(srcfile)
+
+    st = os.stat(srcfile)
+    size = st.st_size
+    if not digest:
+        md5 = md5 or local_md5(srcfile)
+
+    state = { 'src' : os.path.abspath(srcfile), 'size' : size, 'mtime' : int(st.st_mtime), 'md5' : md5, 'done' : 0 }
+    state_file = None
+    if state_dir:
+        key = hashlib.md5('%s:%s' % (node.get('id'), destfile)).hexdigest()
+        state_file = os.path.join(state_dir, '%s.yaml' % key)
+        saved = _load_state(state_file)
+        # a streamed md5 isn't known yet, size and mtime have to do until the check at the end
+        if saved and all(saved.get(k) == state[k] for k in ('src', 'size', 'mtime')) and \
+                (not md5 or not saved.get('md5') or saved['md5'] == md5):
+            state['done'] = saved.get('done', 0)
+
+    if not progress:
+        progress = lambda bytes_so_far, total: None
+
+    if digest:
+        node_progress = progress
+        def progress(bytes_so_far, total):
+            digest.advance(bytes_so_far)
+            node_progress(bytes_so_far, total)
+
+    attempt = 0
+    while True:
+        try:
+            sftp = lineterm.sftp(keyfile, node)
+
+            # resume only over bytes that actually landed
+            done = state['done']
+            if done:
+                try:
+                    done = min(done, sftp.stat(sftp_path(destfile)).st_size)
+                except IOError:
+                    done = 0
+                if done:
+                    logger.info('%s: resuming %s at %s' % (node.name, destfile, fmt_bytes(done)))
+
+            _put_chunks(sftp, srcfile, srcmap, destfile, size, done, state, state_file, progress)
+            break
+        except Exception, e:
+            attempt += 1
+            if attempt > retries:
+                raise
+            logger.warning('%s: upload of %s interrupted at %s (%s), retrying' % 
+                                (node.name, destfile, fmt_bytes(state['done']), e))
+            time.sleep(min(2 ** attempt, 30))
+
+    md5 = md5 or digest.hexdigest()
+    remote = remote_md5(lineterm, node, keyfile, destfile)
+    if remote != md5:
+        # don't resume on top of a bad file
+        _remove_state(state_file)
+        raise IOError('checksum mismatch in put of %s: %s != %s' % (destfile, remote, md5))
+
+    _remove_state(state_file)
+    logger.info('uploaded to %s : %s (%d bytes, md5 verified)' % (node.name, destfile, size))
+
+
+def _put_chunks(sftp, srcfile, srcmap, destfile, size, offset, state, state_file, progress):
+    ''' 
+    write srcfile[offset:] to destfile with pipelined writes, each chunk drawn from the bandwidth budget 
+    before it is sent. With a state file, the offset is recorded in state as chunks complete
+    '''
+
+    if state is None:
+        state = {}
+
+    remote = sftp.open(sftp_path(destfile), 'r+b' if offset else 'wb')
+    fh = None if srcmap is not None else open(srcfile, 'rb')
+    try:
+        remote.set_pipelined(True)
+        if offset:
+            remote.truncate(offset)
+            remote.seek(offset)
+            if fh:
+                fh.seek(offset)
+
+        saved_at = offset
+        while offset < size:
+            nbytes = min(bandwidth.max_request(chunk_size), size - offset)
+            data = srcmap[offset:offset+nbytes] if fh is None else fh.read(nbytes)
+            bandwidth.consume(nbytes)
+            remote.write(data)
+            offset += nbytes
+            progress(offset, size)
+
+            if state_file and offset - saved_at >= resume_every:
+                # wait for the pipelined writes to be acked before recording them as done
+                remote.flush()
+                remote.stat()
+                state['done'] = offset
+                saved_at = offset
+                _save_state(state_file, state)
+    finally:
+        remote.close()
+        if fh:
+            fh.close()
+
+    state['done'] = size
+    _save_state(state_file, state)
+
+
+def _load_state(state_file):
+    if not os.path.exists(state_file):
+        return None
+    try:
+        with open(state_file, 'r') as fh:
+            return yaml.safe_load(fh)
+    except Exception, e:
+        logger.debug('ignoring transfer state %s: %s' % (state_file, e))
+        return None
+
+
+def _save_state(state_file, state):
+    if not state_file:
+        return
+    try:
+        os.makedirs(os.path.dirname(state_file))
+    except OSError:
+        pass
+    tmp = state_file + '.tmp'
+    with open(tmp, 'w') as fh:
+        yaml.safe_dump(state, fh, default_flow_style=False)
+    os.rename(tmp, state_file)
+
+
+def _remove_state(state_file):
+    if state_file and os.path.exists(state_file):
+        os.remove(state_file)
+
+
+def use_compression(lineterm, node, keyfile, compress):
+    ''' compress is True/False to force, None to decide by the node's measured link speed '''
+
+    if compress is not None:
+        return compress
+
+    speed = lineterm.link_speed(keyfile, node)
+    return speed < compress_below
+
+
+def put_tree(lineterm, node, keyfile, localdir, remotedir='.', compress=None, progress=None):
+    '''
+    upload the directory localdir to remotedir/basename(localdir) on node as a single tar stream
+    over an exec channel, instead of one sftp round trip per file
+    '''
+
+    if not os.path.isdir(localdir):
+        raise Exception('dir does not exist locally : %s' % localdir)
+
+    compress = use_compression(lineterm, node, keyfile, compress)
+
+    remote_cmd = 'mkdir -p %s && tar -C %s -x%sf -' % (shell_path(remotedir), shell_path(remotedir),
+                                                         'z' if compress else '')
+    chan = lineterm.exec_command(keyfile, node, remote_cmd)
+    try:
+        stream = chan.makefile('wb')
+        tar = tarfile.open(fileobj=bandwidth.ThrottledFile(stream, progress), mode='w|gz' if compress else 'w|')
+        tar.add(localdir, arcname=os.path.basename(os.path.normpath(localdir)))
+        tar.close()
+        stream.flush()
+        chan.shutdown_write()
+
+        status = chan.recv_exit_status()
+        if status:
+            raise Exception('remote tar exited with %d: %s' % (status, chan.makefile_stderr('rb').read().strip()))
+    finally:
+        chan.close()
+
+    logger.info('uploaded to %s : %s -> %s (%s)' % (node.name, localdir, remotedir,
+                                                    'compressed' if compress else 'uncompressed'))
+
+
+def get_tree(lineterm, node, keyfile, remotedir, localdir='.', compress=None, progress=None):
+    '''
+    download the directory remotedir from node to localdir/nodename/basename(remotedir) 
+    as a single tar stream over an exec channel
+    '''
+
+    parent, name = posixpath.split(remotedir.rstrip('/'))
+    if name == '~':
+        parent, name = '~', '.'
+    if not name:
+        raise Exception('will not download / from %s, name a directory under it' % node.name)
+
+    compress = use_compression(lineterm, node, keyfile, compress)
+
+    remote_cmd = 'tar -C %s -c%sf - %s' % (shell_path(parent or '.'), 'z' if compress else '', pipes.quote(name))
+
+    nodedir = os.path.join(localdir, node.name)
+    chan = lineterm.exec_command(keyfile, node, remote_cmd)
+    try:
+        tar = tarfile.open(fileobj=bandwidth.ThrottledFile(chan.makefile('rb'), progress), 
+                            mode='r|gz' if compress else 'r|')
+        extract_safe(tar, nodedir, node.name)
+        tar.close()
+
+        status = chan.recv_exit_status()
+        if status:
+            raise Exception('remote tar exited with %d: %s' % (status, chan.makefile_stderr('rb').read().strip()))
+    finally:
+        chan.close()
+
+    logger.info('downloaded from %s : %s -> %s' % (node.name, remotedir, os.path.join(nodedir, name)))
+
+
+def extract_safe(tar, destdir, nodename=''):
+    ''' extract a tar stream under destdir, skipping any member that could write outside it '''
+
+    if not os.path.isdir(destdir):
+        os.makedirs(destdir)
+    root = os.path.realpath(destdir)
+
+    for member in tar:
+        if not safe_member(member, root):
+            logger.warning('%s: skipping unsafe member in tar stream: %s' % (nodename, member.name))
+            continue
+        tar.extract(member, destdir)
+
+
+def safe_member(member, root):
+    '''
+    only plain files and dirs that resolve under root. Symlinks and hardlinks are refused, a later member 
+    written through one could land anywhere, and so are devices and fifos
+    '''
+
+    if not (member.isfile() or member.isdir()):
+        return False
+
+    # realpath also follows links already on disk under root
+    path = os.path.realpath(os.path.join(root, member.name))
+    return path == root or path.startswith(root + os.sep)
+
+
+class RemoteLines(object):
+    '''
+    iterate over the lines of a remote file. A reader thread reads the file over sftp a window at a time
+    (see iter_remote_blocks) into a bounded queue, so several nodes download concurrently while memory 
+    stays bounded to a window and the queue per node.
+    '''
+
+    done = object()
+
+    def __init__(self, sftp, remotefile, max_lines=10000, progress=None):
+        self.queue = Queue.Queue(maxsize=max_lines)
+        self.error = None
+        self.progress = progress
+        self.thread = Thread(target=self.read, args=(sftp, remotefile))
+        self.thread.daemon = True
+        self.thread.start()
+
+    def read(self, sftp, remotefile):
+        try:
+            fh = sftp.open(sftp_path(remotefile), 'rb')
+            try:
+                size = fh.stat().st_size
+                done = 0
+                partial = ''
+                for block in iter_remote_blocks(fh, size):
+                    done += len(block)
+                    lines = (partial + block).split('\n')
+                    partial = lines.pop()
+                    for line in lines:
+                        self.queue.put(line.rstrip('\r'))
+                    if self.progress:
+                        self.progress(done, size)
+                if partial:
+                    self.queue.put(partial.rstrip('\r'))
+            finally:
+                fh.close()
+        except Exception, e:
+            self.error = e
+        finally:
+            self.queue.put(self.done)
+
+    def __iter__(self):
+        while True:
+            line = self.queue.get()
+            if line is self.done:
+                break
+            yield line
+
+
+def gather(lineterm, node_keyfiles, remotefile, outfh, prefix=True, sort_col=None, sep=None, numeric=False):
+    '''
+    stream remotefile from every node into outfh without intermediate files.
+    Without sort_col, files are concatenated in node order. With sort_col (1 based), each node's file
+    is taken to be sorted on that column, and the files are k-way merged on it.
+    returns a TransferSummary
+    '''
+
+    summary = TransferSummary()
+
+    readers = []
+    for node, keyfile in node_keyfiles:
+        try:
+            readers.append( (node, RemoteLines(lineterm.sftp(keyfile, node), remotefile, 
+                                                progress=summary.progress(node.name, remotefile))) )
+        except Exception, e:
+            summary.failure(node.name, remotefile, e)
+
+    def out(node, line):
+        if prefix:
+            outfh.write('%s%s' % (node.name, sep or '\t'))
+        outfh.write(line)
+        outfh.write('\n')
+
+    if not sort_col:
+        for node, reader in readers:
+            for line in reader:
+                out(node, line)
+    else:
+        def keyed(i, reader):
+            for line in reader:
+                fields = line.split(sep)
+                key = fields[sort_col-1] if len(fields) >= sort_col else ''
+                if numeric:
+                    try:
+                        key = float(key)
+                    except ValueError:
+                        key = float('inf')
+                yield key, i, line
+
+        streams = [keyed(i, reader) for i, (node, reader) in enumerate(readers)]
+        for key, i, line in heapq.merge(*streams):
+            out(readers[i][0], line)
+
+    for node, reader in readers:
+        if reader.error:
+            summary.failure(node.name, remotefile, reader.error)
+        else:
+            summary.success(node.name, remotefile)
+
+    return summary
+
+
+# node to node copies for tree distribution. The receiver listens on its private address and the sender connects 
+# to it over the cluster's private network. python is used since it is on nearly every image, nc flavours differ.
+# Both read a one time token on stdin (not the command line, where ps shows it). The sender sends it first, 
+# and the receiver drops connections that don't, so nothing else on the network can write the file.
+
+tree_receiver = '''
+import socket, sys, time, hmac
+token = sys.stdin.readline().strip().encode()
+same = getattr(hmac, "compare_digest", lambda a, b: a == b)
+s = socket.socket()
+s.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+s.bind((%(host)r, %(port)d))
+s.listen(4)
+deadline = time.time() + 120
+while True:
+    s.settimeout(max(deadline - time.time(), 0.1))
+    c, _ = s.accept()
+    c.settimeout(10)
+    got = b""
+    try:
+        while len(got) < len(token):
+            d = c.recv(len(token) - len(got))
+            if not d:
+                break
+            got += d
+    except socket.error:
+        pass
+    if same(got, token):
+        break
+    c.close()
+c.settimeout(120)
+s.close()
+f = open(%(dest)r, "wb")
+while True:
+    d = c.recv(1 << 20)
+    if not d:
+        break
+    f.write(d)
+f.close()
+'''
+
+tree_sender = '''
+import socket, sys, time
+token = sys.stdin.readline().strip().encode()
+for i in range(60):
+    try:
+        c = socket.create_connection((%(host)r, %(port)d), 10)
+        break
+    except socket.error:
+        time.sleep(0.5)
+else:
+    raise SystemExit("could not connect to %(host)s:%(port)d")
+c.sendall(token)
+f = open(%(dest)r, "rb")
+while True:
+    d = f.read(1 << 20)
+    if not d:
+        break
+    c.sendall(d)
+c.close()
+'''
+
+def remote_python(script):
+    return '$(command -v python3 || command -v python) -c %s' % pipes.quote(script)
+
+
+def start_copy_script(lineterm, node, keyfile, script, token):
+    ''' run a tree copy script on node, and hand it the token on stdin '''
+
+    chan = lineterm.exec_command(keyfile, node, remote_python(script))
+    chan.sendall('%s\n' % token)
+    chan.shutdown_write()
+    return chan
+
+
+def tree_put(lineterm, node_keyfiles, srcfile, destfile=None, summary=None, port_range=(20000, 30000)):
+    '''
+    distribute one file to many nodes with O(1) uploads from here: upload it to a seed node, then
+    in each round every node that has the file copies it to one that doesn't, over the private network,
+    preferring a peer in the same availability zone. N nodes take log2(N) rounds. 
+    Every copy is verified against the local md5 at the end.
+    node_keyfiles: [(node, keyfile)]
+    returns a TransferSummary
+    '''
+
+    if summary is None:
+        summary = TransferSummary()
+
+    if not destfile:
+        destfile = os.path.basename(srcfile)
+
+    md5 = local_md5(srcfile)
+
+    seed, seed_keyfile = node_keyfiles[0]
+    try:
+        resumable_put(lineterm, seed, seed_keyfile, srcfile, destfile, progress=summary.progress(seed.name, srcfile),
+                      md5=md5)
+    except Exception, e:
+        summary.failure(seed.name, srcfile, e)
+        return summary
+
+    # by id, names can repeat or be empty
+    keyfiles = dict((node.get('id'), keyfile) for node, keyfile in node_keyfiles)
+    have = [seed]
+    need = [node for node, _ in node_keyfiles[1:]]
+    attempts = {}
+    rounds = 0
+
+    while need:
+        rounds += 1
+
+        # pair every node that has the file with a node that needs it, same zone first
+        pairs = []
+        for sender in have:
+            if not need:
+                break
+            zone = sender.get('placement')
+            same_zone = [node for node in need if node.get('placement') == zone]
+            receiver = (same_zone or need)[0]
+            need.remove(receiver)
+            pairs.append( (sender, receiver) )
+
+        logger.info('tree put round %d: %d copies' % (rounds, len(pairs)))
+
+        results = {}
+        def copy(pair):
+            sender, receiver = pair
+            rchan = schan = None
+            try:
+                port = random.randint(*port_range)
+                token = os.urandom(16).encode('hex')
+                # the copy scripts run in the home dir, and python does not expand ~
+                args = { 'port' : port, 'dest' : sftp_path(destfile), 'host' : receiver.get('private_ip_address') }
+                rchan = start_copy_script(lineterm, receiver, keyfiles[receiver.get('id')], tree_receiver % args, token)
+                schan = start_copy_script(lineterm, sender, keyfiles[sender.get('id')], tree_sender % args, token)
+                sstatus = schan.recv_exit_status()
+                rstatus = rchan.recv_exit_status()
+                if sstatus or rstatus:
+                    raise Exception('copy from %s failed: %s %s' % (sender.name, 
+                                        schan.makefile_stderr('rb').read().strip(), 
+                                        rchan.makefile_stderr('rb').read().strip()))
+                results[receiver.get('id')] = None
+            except Exception, e:
+                results[receiver.get('id')] = e
+            finally:
+                # a receiver left running holds its port until its accept times out
+                for chan in (schan, rchan):
+                    if chan:
+                        try:
+                            chan.close()
+                        except Exception, e:
+                            logger.debug('closing copy channel to %s: %s' % (receiver.name, e))
+
+        pool = ThreadPool(len(pairs))
+        try:
+            pool.map(copy, pairs)
+        finally:
+            pool.close()
+            pool.join()
+
+        for sender, receiver in pairs:
+            nodeid = receiver.get('id')
+            error = results.get(nodeid)
+            if not error:
+                have.append(receiver)
+                continue
+
+            attempts[nodeid] = attempts.get(nodeid, 0) + 1
+            logger.debug('%s: %s' % (receiver.name, error))
+            if attempts[nodeid] < 3:
+                need.append(receiver)
+            else:
+                summary.failure(receiver.name, srcfile, error)
+
+    # verify
+    def verify(node):
+        try:
+            if remote_md5(lineterm, node, keyfiles[node.get('id')], destfile) != md5:
+                raise Exception('checksum mismatch on %s' % destfile)
+            summary.success(node.name, srcfile)
+        except Exception, e:
+            summary.failure(node.name, srcfile, e)
+
+    pool = ThreadPool(min(default_workers, len(have)))
+    try:
+        pool.map(verify, have)
+    finally:
+        pool.close()
+        pool.join()
+
+    logger.info('tree put of %s to %d nodes took %d rounds' % (srcfile, len(have), rounds))
+
+    return summary
+
+
+def get_workers(args, cluster):
+    ''' pop a -j workers option from an argument list, default to transfer_workers from the dust config '''
+
+    workers = int(cluster.dust_config_data.get('transfer_workers') or default_workers)
+
+    if '-j' in args:
+        pos = args.index('-j')
+        workers = int(args[pos+1])
+        del args[pos:pos+2]
+
+    return max(workers, 1)
+
+
+def get_compress(args):
+    ''' pop -z (always compress) or -Z (never compress) from an argument list, None means decide by link speed '''
+
+    compress = None
+    if '-z' in args:
+        args.remove('-z')
+        compress = True
+    if '-Z' in args:
+        args.remove('-Z')
+        compress = False
+
+    return compress
@@ -31,6 +31,7 @@ setup(
     packages=['dustcluster','dustcluster/commands'],
     install_requires=required_packages,
     scripts = ['bin/dust'],
+    test_suite = 'tests',
     classifiers=(
         'Development Status :: 4 - Beta',
         'Environment :: Console',
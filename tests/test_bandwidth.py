@@ -0,0 +1,146 @@
+
+import unittest
+from StringIO import StringIO
+
+from dustcluster import bandwidth, transfer
+
+
+class FakeClock(object):
+    ''' time that only moves when the bucket waits '''
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def wait(self, secs):
+        self.now += secs
+
+
+clock = FakeClock()
+
+
+class FakeRemoteFile(object):
+    ''' an sftp file whose readv records when each read request is sent '''
+
+    def __init__(self, data):
+        self.data = data
+        self.requests = [] # [(time, nbytes)]
+
+    def readv(self, chunks):
+        now = clock.time()
+        for offset, length in chunks:
+            self.requests.append( (now, length) )
+        for offset, length in chunks:
+            yield self.data[offset:offset+length]
+
+
+class TokenBucketTest(unittest.TestCase):
+
+    def bucket(self, rate, burst):
+        return bandwidth.TokenBucket(rate, burst, clock=clock.time, wait=clock.wait)
+
+    def test_consume_waits_for_tokens(self):
+        bucket = self.bucket(100 * 1024, 10 * 1024)
+        start = clock.time()
+        for _ in range(5):
+            bucket.consume(10 * 1024)
+        # 10 KB burst, then 40 KB at 100 KB/s
+        self.assertAlmostEqual(clock.time() - start, 0.4)
+
+    def test_interactive_never_waits_and_puts_bulk_in_debt(self):
+        bucket = self.bucket(100 * 1024, 10 * 1024)
+        start = clock.time()
+        bucket.consume_interactive(20 * 1024)
+        self.assertEqual(clock.time(), start)
+        # 10 KB of debt to pay off, then 1 KB
+        bucket.consume(1024)
+        self.assertAlmostEqual(clock.time() - start, 0.11)
+
+    def test_refund(self):
+        bucket = self.bucket(1024, 1024)
+        bucket.consume(1024)
+        bucket.refund(512)
+        self.assertTrue(bucket.tokens >= 512)
+        bucket.refund(10 * 1024)
+        self.assertTrue(bucket.tokens <= bucket.burst)
+
+
+class ThrottledReadTest(unittest.TestCase):
+
+    rate_mb = 1.0
+
+    def setUp(self):
+        bandwidth.limiter = bandwidth.TokenBucket(self.rate_mb * 1024 * 1024, clock=clock.time, wait=clock.wait)
+
+    def tearDown(self):
+        bandwidth.limiter = None
+
+    def assert_under_limit(self, requests, start):
+        ''' at every request, the bytes requested so far fit in the burst plus the rate since start '''
+
+        rate = self.rate_mb * 1024 * 1024
+        burst = bandwidth.limiter.burst
+        requested = 0
+        for when, nbytes in requests:
+            requested += nbytes
+            allowed = burst + rate * (when - start) + 1
+            self.assertTrue(requested <= allowed,
+                            '%d bytes requested after %.2fs, limit allows %d' % (requested, when - start, allowed))
+
+    def test_remote_reads_are_requested_under_the_limit(self):
+        data = 'x' * (3 * 1024 * 1024)
+        remote = FakeRemoteFile(data)
+        start = clock.time()
+        received = ''.join(transfer.iter_remote_blocks(remote, len(data)))
+
+        self.assertEqual(received, data)
+        # 3 MB at 1 MB/s with a quarter second burst, the last window is requested after 2.5 seconds
+        self.assertTrue(clock.time() - start >= 2.5)
+        self.assert_under_limit(remote.requests, start)
+        self.assertTrue(max(nbytes for _, nbytes in remote.requests) <= bandwidth.limiter.burst)
+
+    def test_throttled_file_takes_tokens_before_reading(self):
+        reads = []
+
+        class Source(object):
+            def __init__(self):
+                self.fh = StringIO('y' * (2 * 1024 * 1024))
+            def read(self, size=-1):
+                reads.append( (clock.time(), size) )
+                return self.fh.read(size)
+
+        start = clock.time()
+        fh = bandwidth.ThrottledFile(Source())
+        total = 0
+        for block in iter(lambda: fh.read(64 * 1024), ''):
+            total += len(block)
+
+        self.assertEqual(total, 2 * 1024 * 1024)
+        self.assert_under_limit([(when, size) for when, size in reads], start)
+
+    def test_short_read_is_refunded(self):
+        fh = bandwidth.ThrottledFile(StringIO('z' * 10))
+        before = clock.time()
+        for _ in range(20):
+            fh.read(200 * 1024)
+        # only 10 bytes moved, the unused tokens came back, so 4 MB of reads took no time
+        self.assertTrue(clock.time() - before < 0.01)
+
+
+class RemoteBlocksTest(unittest.TestCase):
+
+    def test_windows_cover_the_file(self):
+        data = ''.join(chr(i % 256) for i in range(transfer.read_window * 2 + 12345))
+        remote = FakeRemoteFile(data)
+        self.assertEqual(''.join(transfer.iter_remote_blocks(remote, len(data))), data)
+        self.assertTrue(max(nbytes for _, nbytes in remote.requests) <= transfer.chunk_size)
+
+    def test_offset(self):
+        remote = FakeRemoteFile('abcdef')
+        self.assertEqual(''.join(transfer.iter_remote_blocks(remote, 6, offset=2)), 'cdef')
+
+
+if __name__ == '__main__':
+    unittest.main()
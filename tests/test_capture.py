@@ -0,0 +1,145 @@
+
+import os
+import sys
+import shutil
+import logging
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from dustcluster.capture import CaptureStore
+from dustcluster.commands import history
+
+
+logger = logging.getLogger('test')
+logger.addHandler(logging.NullHandler())
+
+
+class CaptureStoreTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.store = CaptureStore(os.path.join(self.tmp, 'captures'), max_runs=3)
+
+    def tearDown(self):
+        self.store.shutdown()
+        shutil.rmtree(self.tmp)
+
+    def run_ids(self):
+        return [run[0] for run in self.store.runs()]
+
+    def add_run(self, text='hello\nworld\n'):
+        run_id = self.store.new_run('uptime', ['node1', 'node2'])
+        # write as the writer thread would, so pruning has happened when this returns
+        self.store.write(run_id, 1000.0, 'node1', text)
+        self.store.close_files()
+        return run_id
+
+    def test_read_back(self):
+        run_id = self.add_run()
+        self.assertEqual(list(self.store.read(run_id)), [(1000.0, 'node1', 'hello'), (1000.0, 'node1', 'world')])
+        self.assertEqual(list(self.store.read(run_id, 'node2')), [])
+        self.assertEqual(self.store.runs()[0][2:], (['node1', 'node2'], 'uptime'))
+
+    def test_prune_by_count(self):
+        for _ in range(5):
+            self.add_run()
+        self.assertEqual(self.run_ids(), [3, 4, 5])
+        self.assertEqual(sorted(os.listdir(self.store.capture_dir)), ['3.gz', '4.gz', '5.gz', 'index'])
+        # ids keep counting up after a prune
+        self.assertEqual(self.add_run(), 6)
+
+    def test_prune_by_size(self):
+        self.store.max_bytes = 1
+        for _ in range(3):
+            self.add_run(os.urandom(4096).encode('hex'))
+        # older runs go to get under max_bytes, the new run is kept
+        self.assertEqual(self.run_ids(), [3])
+
+    def test_record_through_writer(self):
+        run_id = self.store.new_run('ls', ['node1'])
+        self.store.record(run_id, 'node1', 'a\nb')
+        self.store.record(None, 'node1', 'not a run')
+        self.store.shutdown()
+        self.assertEqual([line for _, _, line in self.store.read(run_id)], ['a', 'b'])
+
+    def test_runs_by_node_and_time(self):
+        os.makedirs(self.store.capture_dir)
+        with open(self.store.index_file, 'w') as fh:
+            fh.write('1\t1000.000\tweb1,web2\tuptime\n2\t2000.000\tdb1\tdf\n')
+
+        self.assertEqual([run[0] for run in self.store.runs(nodename='web2')], [1])
+        self.assertEqual([run[0] for run in self.store.runs(nodename='db*')], [2])
+        self.assertEqual(self.store.runs(nodename='app*'), [])
+        self.assertEqual([run[0] for run in self.store.runs(since=1500)], [2])
+        self.assertEqual([run[0] for run in self.store.runs(nodename='web*', since=1500)], [])
+
+    def test_read_by_node_pattern(self):
+        run_id = self.store.new_run('uptime', ['web1', 'db1'])
+        self.store.write(run_id, 1000.0, 'web1', 'a')
+        self.store.write(run_id, 1000.0, 'db1', 'b')
+        self.store.close_files()
+        self.assertEqual([line for _, _, line in self.store.read(run_id, 'web*')], ['a'])
+
+
+class RecordingStore(CaptureStore):
+
+    def __init__(self, capture_dir):
+        CaptureStore.__init__(self, capture_dir)
+        self.read_runs = []
+
+    def read(self, run_id, nodename=None):
+        self.read_runs.append(run_id)
+        return CaptureStore.read(self, run_id, nodename)
+
+
+class FakeCluster(object):
+
+    def __init__(self, capture):
+        self.capture = capture
+
+
+class GrepTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.store = RecordingStore(os.path.join(self.tmp, 'captures'))
+        self.cluster = FakeCluster(self.store)
+        for cmdline, nodenames in [('uptime', ['web1', 'web2']), ('df', ['db1']), ('ls', ['web2'])]:
+            run_id = self.store.new_run(cmdline, nodenames)
+            for nodename in nodenames:
+                self.store.write(run_id, 1000.0, nodename, 'error on %s' % nodename)
+        self.store.close_files()
+
+        self.stdout = sys.stdout
+        sys.stdout = StringIO()
+
+    def tearDown(self):
+        sys.stdout = self.stdout
+        self.store.shutdown()
+        shutil.rmtree(self.tmp)
+
+    def test_grep_reads_only_the_runs_on_the_node(self):
+        history.grep('--node web2 error', self.cluster, logger)
+        self.assertEqual(self.store.read_runs, [3, 1])
+        self.assertEqual([line.split()[-1] for line in sys.stdout.getvalue().splitlines()], ['web2', 'web2'])
+
+    def test_since(self):
+        history.grep('-i --since 1h ERROR', self.cluster, logger)
+        self.assertEqual(self.store.read_runs, [3, 2, 1])
+        self.store.read_runs = []
+        history.grep('--since 1h -i ERROR 2', self.cluster, logger)
+        self.assertEqual(self.store.read_runs, [2])
+
+        self.assertEqual(history._parse_age('90'), 90)
+        self.assertEqual(history._parse_age('2h'), 7200)
+        self.assertRaises(ValueError, history._parse_age, 'soon')
+
+    def test_history_listing(self):
+        history.history('--node web*', self.cluster, logger)
+        self.assertEqual([int(line.split()[0]) for line in sys.stdout.getvalue().splitlines()], [1, 3])
+        self.assertEqual(self.store.read_runs, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,92 @@
+
+import shutil
+import tempfile
+import unittest
+
+from dustcluster.cluster import Cluster
+from dustcluster.invcache import InventoryCache
+from tests.test_ec2 import FakeCloud, FakeVM
+
+
+class FilteringCloud(FakeCloud):
+    ''' answers DescribeInstances filters on state and tags, and records the filters of each call '''
+
+    def __init__(self, vms):
+        super(FilteringCloud, self).__init__(vms)
+        self.filters = []
+
+    def _iter_instances(self, filters=None, page_size=None):
+        self.filters.append(filters)
+        for vm in self.vms:
+            if all(self._matches(vm, name, value) for name, value in (filters or {}).items()):
+                yield vm
+
+    def _matches(self, vm, name, value):
+        if name == 'instance-state-name':
+            return vm.state == value
+        if name.startswith('tag:'):
+            return vm.tags.get(name[4:]) == value
+        raise AssertionError('unexpected filter %s' % name)
+
+
+def make_vm(i, state, env):
+    vm = FakeVM(i)
+    vm.state = state
+    vm.tags = { 'name' : 'worker%d' % i, 'cluster' : 'hpc', 'env' : env }
+    return vm
+
+
+class ResolveTargetTest(unittest.TestCase):
+    ''' targets resolved by the cluster, with the pushed down part of the target fetched from the cloud '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+
+        # worker3 is in the template but not in the cloud
+        self.cloud = FilteringCloud([make_vm(0, 'running', 'prod'), make_vm(1, 'stopped', 'prod'),
+                                     make_vm(2, 'running', 'dev')])
+
+        self.cluster = Cluster.__new__(Cluster)
+        self.cluster.cloud = self.cloud
+        self.cluster.offline = False
+        self.cluster.nodecache = {}
+        self.cluster.current_nodes = None
+        self.cluster.cur_cluster = ''
+        self.cluster.inventory_cache = InventoryCache(self.tmp, ttl=60)
+        self.cluster.clusters = { 'hpc' : { 'cloud' : { 'region' : 'us-east-1' },
+                                            'cluster' : { 'name' : 'hpc' },
+                                            'nodes' : [{ 'nodename' : 'worker%d' % i } for i in range(4)] } }
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def resolve(self, text):
+        nodes = self.cluster.resolve_target_nodes(target_node_name=text)
+        return [(node.name, node.get('state')) for node in nodes]
+
+    def test_template_nodes_outside_the_filter_are_not_absent(self):
+        self.assertEqual(self.resolve('state=running'), [('worker0', 'running'), ('worker2', 'running')])
+        self.assertEqual(self.cloud.filters, [{ 'instance-state-name' : 'running' }])
+
+        self.assertEqual(self.resolve('cluster:hpc & tags=env:prod'), [('worker0', 'running'), ('worker1', 'stopped')])
+        self.assertEqual(self.cloud.filters[-1], { 'tag:cluster' : 'hpc', 'tag:env' : 'prod' })
+
+    def test_missing_template_node_is_absent(self):
+        # nothing pushed down but the cluster, so worker3 really is missing
+        self.assertEqual(self.resolve('cluster:hpc & worker[2-3]'), [('worker2', 'running'), ('worker3', '')])
+        self.assertEqual(self.cloud.filters, [{ 'tag:cluster' : 'hpc' }])
+
+    def test_or_not_and_inequality_fetch_everything(self):
+        running = [('worker0', 'running'), ('worker2', 'running')]
+        # the absent worker3 is not stopped either
+        for text, expected in [('state=running | tags=env:dev', running),
+                               ('!state=stopped', running + [('worker3', '')]),
+                               ('state!=stopped', running + [('worker3', '')])]:
+            self.cluster.nodecache = {}
+            self.cluster.inventory_cache.remove('us-east-1')
+            self.assertEqual(self.resolve(text), expected)
+            self.assertEqual(self.cloud.filters[-1], None)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+
+import unittest
+
+from dustcluster.EC2 import EC2Cloud, OfflineError
+from dustcluster.inventory import NodeTable
+
+
+class FakeVM(object):
+
+    def __init__(self, i):
+        self.id = 'i-%04d' % i
+        self.state = 'running'
+        self.instance_type = 't2.micro'
+        self.ami_launch_index = i % 4
+        self.tags = { 'Name' : 'worker%d' % i }
+
+
+class FakeCloud(EC2Cloud):
+    ''' DescribeInstances answered from a list of FakeVMs, counting the calls '''
+
+    def __init__(self, vms, offline=False):
+        super(FakeCloud, self).__init__(region='us-east-1', offline=offline)
+        self.vms = vms
+        self.calls = 0
+
+    def _get_instances(self, iids=None, filters=None):
+        self.calls += 1
+        return [vm for vm in self.vms if iids is None or vm.id in iids]
+
+    def _iter_instances(self, filters=None, page_size=None):
+        return iter(self._get_instances(filters=filters))
+
+
+class LoadFieldTest(unittest.TestCase):
+
+    def setUp(self):
+        self.vms = [FakeVM(i) for i in range(50)]
+
+    def table(self, offline=False):
+        cloud = FakeCloud(self.vms, offline)
+        nodes = cloud.nodes_from_records(cloud.node_records(cloud.refresh()))
+        cloud.calls = 0
+        return cloud, NodeTable(nodes)
+
+    def test_one_call_for_a_column(self):
+        cloud, table = self.table()
+        self.assertEqual(table.column('ami_launch_index'), [i % 4 for i in range(50)])
+        self.assertEqual(cloud.calls, 1)
+        table.column('ami_launch_index')
+        self.assertEqual(cloud.calls, 1)
+
+    def test_lean_fields_need_no_call(self):
+        cloud, table = self.table()
+        table.column('state')
+        table.column('type')
+        table.column('no_such_field')
+        self.assertEqual(cloud.calls, 0)
+
+    def test_offline_raises(self):
+        cloud, table = self.table(offline=True)
+        self.assertRaises(OfflineError, table.column, 'ami_launch_index')
+        self.assertRaises(OfflineError, table.nodes[0].get, 'ami_launch_index')
+        self.assertEqual(table.column('state'), ['running'] * 50)
+        self.assertEqual(cloud.calls, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,67 @@
+
+import unittest
+
+from dustcluster import hostlist
+
+
+class ExpandTest(unittest.TestCase):
+
+    def test_ranges_and_lists(self):
+        self.assertEqual(hostlist.expand('worker[1-3,7]'), ['worker1', 'worker2', 'worker3', 'worker7'])
+
+    def test_padding(self):
+        self.assertEqual(hostlist.expand('node[08-11]'), ['node08', 'node09', 'node10', 'node11'])
+
+    def test_several_ranges(self):
+        self.assertEqual(hostlist.expand('r[1-2]n[5,7]'), ['r1n5', 'r1n7', 'r2n5', 'r2n7'])
+
+    def test_digits_only_bracket_is_a_number(self):
+        self.assertEqual(hostlist.expand('worker[12]'), ['worker12'])
+        self.assertTrue(hostlist.RangeMatcher('worker[12]').match('worker12'))
+        self.assertFalse(hostlist.RangeMatcher('worker[12]').match('worker1'))
+
+    def test_bad_ranges(self):
+        self.assertRaises(ValueError, hostlist.expand, 'worker[5-1]')
+        self.assertRaises(ValueError, hostlist.expand, 'worker[1-%d]' % (hostlist.max_names + 1))
+        self.assertRaises(ValueError, hostlist.expand, 'r[1-1000]n[1-1000]')
+
+    def test_exact_names(self):
+        self.assertEqual(hostlist.exact_names('w[1-2]'), ['w1', 'w2'])
+        self.assertEqual(hostlist.exact_names('w[1-2]*'), None)
+        self.assertEqual(hostlist.exact_names('worker*'), None)
+
+
+class RangeMatcherTest(unittest.TestCase):
+
+    def test_ranges_with_wildcards(self):
+        matcher = hostlist.RangeMatcher('web[1-3]-*')
+        self.assertTrue(matcher.match('web2-east'))
+        self.assertFalse(matcher.match('web4-east'))
+        self.assertFalse(matcher.match('web2'))
+
+    def test_character_class_kept(self):
+        matcher = hostlist.RangeMatcher('w[a-b][1-2]')
+        self.assertTrue(matcher.match('wb2'))
+        self.assertFalse(matcher.match('wc1'))
+
+
+class CompressTest(unittest.TestCase):
+
+    def test_runs(self):
+        names = ['worker1', 'worker2', 'worker3', 'worker7', 'master']
+        self.assertEqual(hostlist.compress(names), 'worker[1-3,7],master')
+
+    def test_single_name(self):
+        self.assertEqual(hostlist.compress(['node05']), 'node05')
+
+    def test_round_trip(self):
+        for pattern in ['node[01-10]', 'node[01-100]', 'node[001-120]', 'worker[1-250,300-310]', 'r[7-12]x']:
+            self.assertEqual(hostlist.compress(hostlist.expand(pattern)), pattern)
+
+    def test_mixed_padding(self):
+        names = hostlist.expand('n[1-3]') + hostlist.expand('n[01-02]')
+        self.assertEqual(hostlist.compress(names), 'n[1-3],n[01-02]')
+
+
+if __name__ == '__main__':
+    unittest.main()
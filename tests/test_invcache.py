@@ -0,0 +1,88 @@
+
+import os
+import time
+import shutil
+import cPickle
+import tempfile
+import unittest
+
+from dustcluster import invcache
+from dustcluster.invcache import InventoryCache
+
+
+fields = ['id', 'state']
+records = [('i-1', 'running'), ('i-2', 'stopped')]
+
+
+class InventoryCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.tmp, 'cache')
+        self.cache = InventoryCache(self.cache_dir, ttl=60)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def age(self, region, filters, seconds):
+        ''' pretend the saved inventory is seconds old '''
+
+        path = self.cache._path(self.cache._name(region, filters))
+        with open(path, 'rb') as fh:
+            data = cPickle.load(fh)
+        data['time'] -= seconds
+        with open(path, 'wb') as fh:
+            cPickle.dump(data, fh)
+
+    def test_round_trip(self):
+        self.cache.save('us-east-1', None, fields, records)
+        loaded, saved_time = self.cache.load('us-east-1', None, fields)
+        self.assertEqual(loaded, records)
+        self.assertTrue(time.time() - saved_time < 5)
+
+    def test_ttl(self):
+        self.cache.save('us-east-1', None, fields, records)
+        self.age('us-east-1', None, 120)
+        self.assertEqual(self.cache.load('us-east-1', None, fields), None)
+        # offline takes it at any age
+        self.assertEqual(self.cache.load('us-east-1', None, fields, any_age=True)[0], records)
+
+    def test_saved_in_the_future(self):
+        self.cache.save('us-east-1', None, fields, records)
+        self.age('us-east-1', None, -120)
+        self.assertEqual(self.cache.load('us-east-1', None, fields), None)
+
+    def test_version_mismatch(self):
+        self.cache.save('us-east-1', None, fields, records)
+        version = invcache.format_version
+        invcache.format_version = version + 1
+        try:
+            self.assertEqual(self.cache.load('us-east-1', None, fields, any_age=True), None)
+        finally:
+            invcache.format_version = version
+
+    def test_fields_mismatch(self):
+        self.cache.save('us-east-1', None, fields, records)
+        self.assertEqual(self.cache.load('us-east-1', None, fields + ['tags'], any_age=True), None)
+
+    def test_unreadable_file(self):
+        self.cache.save('us-east-1', None, fields, records)
+        with open(self.cache._path('us-east-1'), 'wb') as fh:
+            fh.write('not a pickle')
+        self.assertEqual(self.cache.load('us-east-1', None, fields), None)
+
+    def test_filters_and_remove(self):
+        filters = { 'instance-state-name' : 'running' }
+        self.cache.save('us-east-1', None, fields, records)
+        self.cache.save('us-east-1', filters, fields, records[:1])
+        self.cache.save('eu-west-1', None, fields, records)
+        self.assertEqual(self.cache.load('us-east-1', dict(filters), fields)[0], records[:1])
+
+        self.cache.remove('us-east-1')
+        self.assertEqual(self.cache.load('us-east-1', None, fields), None)
+        self.assertEqual(self.cache.load('us-east-1', filters, fields), None)
+        self.assertEqual(self.cache.load('eu-west-1', None, fields)[0], records)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,112 @@
+
+import unittest
+
+from dustcluster import inventory
+from dustcluster.cluster import Cluster
+from dustcluster.hostlist import RangeMatcher
+from dustcluster.inventory import NodeTable
+
+
+class FakeNode(object):
+
+    def __init__(self, name, **fields):
+        self.name = name
+        self.cluster = None
+        self.fields = fields
+        self.gets = 0
+
+    def get(self, field):
+        self.gets += 1
+        return self.fields.get(field)
+
+
+def make_nodes():
+    return [FakeNode('web1', state='running', instance_type='t2.micro', tags={ 'env' : 'prod', 'Name' : 'web1' }),
+            FakeNode('web2', state='stopped', instance_type='t2.micro', tags={ 'env' : 'dev' }),
+            FakeNode('db1', state='running', instance_type='r4.large', tags={ 'env' : 'prod', 'a:b' : 'c' }),
+            FakeNode('new', state='', instance_type=None, groups=['unhashable'])]
+
+
+class NodeTableTest(unittest.TestCase):
+
+    def setUp(self):
+        self.nodes = make_nodes()
+        self.table = NodeTable(self.nodes)
+
+    def names(self, rows):
+        return [node.name for node in self.table.select(rows)]
+
+    def test_column_is_built_once(self):
+        self.assertEqual(self.table.column('state'), ['running', 'stopped', 'running', ''])
+        self.table.column('state')
+        self.assertEqual([node.gets for node in self.nodes], [1, 1, 1, 1])
+
+    def test_index_skips_unset_values(self):
+        self.assertEqual(self.table.index('state'), { 'running' : set([0, 2]), 'stopped' : set([1]) })
+        self.assertEqual(self.table.index('instance_type'), { 't2.micro' : set([0, 1]), 'r4.large' : set([2]) })
+        self.assertEqual(self.table.index('groups'), {})
+
+    def test_exact_and_wildcard_match(self):
+        self.assertEqual(self.names(self.table.match('state', 'running')), ['web1', 'db1'])
+        self.assertEqual(self.names(self.table.match('instance_type', 't2.*')), ['web1', 'web2'])
+        self.assertEqual(self.table.match('state', 'terminated'), set())
+
+    def test_live_fields_are_not_cached(self):
+        self.assertEqual(self.names(self.table.match('name', 'web*')), ['web1', 'web2'])
+        self.nodes[2].name = 'web3'
+        self.assertEqual(self.names(self.table.match('name', 'web*')), ['web1', 'web2', 'web3'])
+
+    def test_range_match(self):
+        self.assertEqual(self.names(self.table.match('name', 'web[2-5]')), ['web2'])
+
+    def test_tags(self):
+        self.assertEqual(self.names(self.table.match('tags', 'env:prod')), ['web1', 'db1'])
+        self.assertEqual(self.names(self.table.match('tags', 'e*:d*')), ['web2'])
+        self.assertEqual(self.names(self.table.match('tags', '"a:b":c')), ['db1'])
+
+    def test_filter(self):
+        self.assertEqual([node.name for node in self.table.filter('state', 'stopped')], ['web2'])
+        self.assertEqual(len(self.table.filter(None, None)), 4)
+
+
+class CompilePatternTest(unittest.TestCase):
+
+    def test_compiled_once(self):
+        self.assertTrue(inventory.compile_pattern('web*') is inventory.compile_pattern('web*'))
+        self.assertTrue(isinstance(inventory.compile_pattern('web[1-3]'), RangeMatcher))
+
+    def test_cache_is_bounded(self):
+        for i in range(inventory.max_patterns + 10):
+            inventory.compile_pattern('pattern%d*' % i)
+        self.assertTrue(len(inventory._patterns) <= inventory.max_patterns)
+
+
+class TemplateMatchTest(unittest.TestCase):
+    ''' cluster template nodes are found through the inventory indexes, within the cluster's rows '''
+
+    def setUp(self):
+        self.nodes = [FakeNode('', id='i-%d' % i, tags={ 'name' : 'worker%d' % i }) for i in range(10)]
+        self.table = NodeTable(self.nodes)
+        self.cluster = Cluster.__new__(Cluster)
+
+    def find(self, node_props, rows):
+        return self.cluster._find_matching_node(node_props, self.table, set(rows))
+
+    def test_default_selector_is_the_name_tag(self):
+        self.assertEqual(self.find({ 'nodename' : 'worker3' }, range(10)), [self.nodes[3]])
+
+    def test_selector(self):
+        self.assertEqual(self.find({ 'nodename' : 'x', 'selector' : 'id=i-7' }, range(10)), [self.nodes[7]])
+
+    def test_outside_the_cluster(self):
+        self.assertEqual(self.find({ 'nodename' : 'worker3' }, [1, 2]), [])
+
+    def test_cluster_rows(self):
+        self.cluster.clusters = { 'hpc' : { 'cluster' : { 'filter' : 'id=i-[1-2]' } },
+                                  'web' : { 'cluster' : { 'filter' : 'tags=name:worker?' } } }
+        self.assertEqual(self.cluster.get_cluster_rows(self.table, 'hpc'), set([1, 2]))
+        self.assertEqual(self.cluster.get_cluster_rows(self.table, 'web'), set(range(10)))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,70 @@
+
+import time
+import unittest
+from threading import Lock
+
+from dustcluster import lineterm
+from dustcluster.lineterm import LineTerm
+from tests.test_ec2 import FakeCloud, FakeVM
+
+
+class StartingCloud(FakeCloud):
+    ''' instances get a dns name on the second DescribeInstances '''
+
+    def _get_instances(self, iids=None, filters=None):
+        vms = super(StartingCloud, self)._get_instances(iids, filters)
+        if self.calls >= 2:
+            for vm in vms:
+                vm.public_dns_name = '%s.compute.amazonaws.com' % vm.id
+        return vms
+
+
+class FakeSessionManager(object):
+
+    def __init__(self):
+        self.lock = Lock()
+        self.logins = []
+
+    def term_from_node(self, node, keyfile, interactive=True):
+        with self.lock:
+            self.logins.append(node.get('public_dns_name'))
+
+
+class PrewarmTest(unittest.TestCase):
+
+    def setUp(self):
+        self.poll, self.port_open = lineterm.prewarm_poll, lineterm.port_open
+        lineterm.prewarm_poll = 0
+        lineterm.port_open = lambda hostname, port: True
+
+        self.cloud = StartingCloud([FakeVM(i) for i in range(5)])
+        self.nodes = self.cloud.nodes_from_records(self.cloud.node_records(self.cloud.refresh()))
+        self.cloud.calls = 0
+
+        self.term = LineTerm.__new__(LineTerm)
+        self.term.session_manager = FakeSessionManager()
+
+    def tearDown(self):
+        lineterm.prewarm_poll, lineterm.port_open = self.poll, self.port_open
+
+    def logins(self, count):
+        for _ in range(100):
+            if len(self.term.session_manager.logins) >= count:
+                break
+            time.sleep(0.01)
+        return sorted(self.term.session_manager.logins)
+
+    def test_starting_nodes_are_polled_together(self):
+        self.term._prewarm_nodes([(node, 'key') for node in self.nodes], time.time() + 60)
+        # two polls for all five nodes, not one per node per poll
+        self.assertEqual(self.cloud.calls, 2)
+        self.assertEqual(self.logins(5), ['i-%04d.compute.amazonaws.com' % i for i in range(5)])
+
+    def test_gives_up_at_the_deadline(self):
+        self.term._prewarm_nodes([(node, 'key') for node in self.nodes], time.time())
+        self.assertEqual(self.cloud.calls, 0)
+        self.assertEqual(self.logins(0), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
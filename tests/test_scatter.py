@@ -0,0 +1,217 @@
+
+import os
+import zlib
+import shutil
+import logging
+import tempfile
+import unittest
+
+import yaml
+
+from dustcluster.commands import scatter
+
+
+logger = logging.getLogger('test')
+logger.addHandler(logging.NullHandler())
+
+
+class RouterTest(unittest.TestCase):
+
+    def test_round_robin(self):
+        route = scatter._round_robin_router(3)
+        self.assertEqual([route('x\n', 0) for _ in range(7)], [0, 1, 2, 0, 1, 2, 0])
+
+    def test_size(self):
+        # 4 nodes, 100 bytes: each node takes the lines starting before its share ends
+        route = scatter._size_router(4, 100)
+        self.assertEqual([route('', offset) for offset in [0, 20, 25, 49, 50, 74, 75, 99]], [0, 0, 1, 1, 2, 2, 3, 3])
+
+    def test_hash(self):
+        route = scatter._hash_router(5, 2, ',')
+        self.assertEqual(route('1,alice,x\n', 0), route('2,alice,y\r\n', 10))
+        self.assertEqual(route('1,bob\n', 0), (zlib.crc32('bob') & 0xffffffff) % 5)
+        # a short line has an empty key
+        self.assertEqual(route('1\n', 0), zlib.crc32('') % 5)
+
+
+class AssignFilesTest(unittest.TestCase):
+
+    def setUp(self):
+        self.source = tempfile.mkdtemp()
+        for name, size in [('a', 10), ('b', 40), ('c', 30), ('d', 20), ('e', 5)]:
+            with open(os.path.join(self.source, name), 'wb') as fh:
+                fh.write('x' * size)
+
+    def tearDown(self):
+        shutil.rmtree(self.source)
+
+    def test_round_robin(self):
+        files = scatter.assign_files(self.source, ['a', 'b', 'c', 'd', 'e'], ['n1', 'n2'], 'lines')
+        self.assertEqual(files, { 'a' : 'n1', 'b' : 'n2', 'c' : 'n1', 'd' : 'n2', 'e' : 'n1' })
+
+    def test_size(self):
+        files = scatter.assign_files(self.source, ['a', 'b', 'c', 'd', 'e'], ['n1', 'n2'], 'size')
+        # biggest first to the lightest node: b n1, c n2, d n2, a n1, then e breaks the 50/50 tie in node order
+        self.assertEqual(files, { 'b' : 'n1', 'c' : 'n2', 'd' : 'n2', 'a' : 'n1', 'e' : 'n1' })
+
+    def test_old_files_keep_their_node(self):
+        old = { 'a' : 'n2', 'b' : 'n2', 'gone' : 'n1', 'c' : 'removed-node' }
+        files = scatter.assign_files(self.source, ['a', 'b', 'c', 'd'], ['n1', 'n2'], 'size', old)
+        self.assertEqual(files, { 'a' : 'n2', 'b' : 'n2', 'c' : 'n1', 'd' : 'n1' })
+
+        files = scatter.assign_files(self.source, ['a', 'b', 'c', 'd'], ['n1', 'n2'], 'lines', old)
+        self.assertEqual(files, { 'a' : 'n2', 'b' : 'n2', 'c' : 'n1', 'd' : 'n2' })
+
+
+class FakeNode(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.keyfile = 'key'
+
+    def get(self, prop):
+        return { 'id' : 'i-%s' % self.name }.get(prop)
+
+
+class FakeRemoteFile(object):
+
+    def __init__(self, files, path):
+        self.files = files
+        self.path = path
+        self.files[path] = ''
+
+    def set_pipelined(self, pipelined):
+        pass
+
+    def write(self, data):
+        self.files[self.path] += data
+
+    def close(self):
+        pass
+
+
+class FakeSFTP(object):
+
+    def __init__(self, files):
+        self.files = files
+
+    def open(self, path, mode):
+        return FakeRemoteFile(self.files, path)
+
+
+class FakeChan(object):
+
+    def recv_exit_status(self):
+        return 0
+
+    def close(self):
+        pass
+
+
+class FakeLineTerm(object):
+
+    def __init__(self):
+        self.cmds = []
+        self.files = {}     # { (nodename, path) : data } written through sftp
+        self.puts = []      # [(nodename, destfile)]
+
+    def exec_command(self, keyfile, node, cmd):
+        self.cmds.append( (node.name, cmd) )
+        return FakeChan()
+
+    def sftp(self, keyfile, node):
+        return FakeSFTP(NodeFiles(self.files, node.name))
+
+    def put(self, keyfile, node, srcfile, destfile=None, progress=None):
+        self.puts.append( (node.name, destfile) )
+
+
+class NodeFiles(object):
+    ''' the files of one node, as a view on the lineterm's { (nodename, path) : data } '''
+
+    def __init__(self, files, nodename):
+        self.files = files
+        self.nodename = nodename
+
+    def __getitem__(self, path):
+        return self.files[(self.nodename, path)]
+
+    def __setitem__(self, path, data):
+        self.files[(self.nodename, path)] = data
+
+
+class FakeCluster(object):
+
+    def __init__(self, dust_dir, nodes):
+        self.dust_dir = dust_dir
+        self.nodes = nodes
+        self.cur_cluster = ''
+        self.dust_config_data = {}
+        self.capture = None
+        self.lineterm = FakeLineTerm()
+        self.targets = []
+
+    def running_nodes_from_target(self, target):
+        self.targets.append(target)
+        return list(self.nodes)
+
+
+class ScatterTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.nodes = [FakeNode('web1'), FakeNode('web2')]
+        self.cluster = FakeCluster(os.path.join(self.tmp, '.dustcluster'), self.nodes)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, relpath, data):
+        path = os.path.join(self.tmp, relpath)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        return path
+
+    def test_lines_to_a_target_expression(self):
+        src = self.write('events.log', ''.join('line %d\n' % i for i in range(5)))
+        scatter.scatter('"state=running & web*" %s "~/in dir"' % src, self.cluster, logger)
+
+        self.assertEqual(self.cluster.targets, ['state=running & web*'])
+        self.assertEqual(self.cluster.lineterm.cmds, [('web1', "mkdir -p ~/'in dir'"), ('web2', "mkdir -p ~/'in dir'")])
+        files = self.cluster.lineterm.files
+        self.assertEqual(files[('web1', 'in dir/events.log')], 'line 0\nline 2\nline 4\n')
+        self.assertEqual(files[('web2', 'in dir/events.log')], 'line 1\nline 3\n')
+
+    def test_reuse(self):
+        source = os.path.join(self.tmp, 'shards')
+        for name in ['a', 'b', 'c']:
+            self.write(os.path.join('shards', name), name)
+        scatter.scatter('web* %s /data' % source, self.cluster, logger)
+
+        assign_file = os.path.join(self.cluster.dust_dir, 'scatter', 'default', 'shards.yaml')
+        with open(assign_file) as fh:
+            saved = yaml.safe_load(fh)
+        self.assertEqual(saved['files'], { 'a' : 'web1', 'b' : 'web2', 'c' : 'web1' })
+        self.assertEqual(saved['nodes'], [['i-web1', 'web1'], ['i-web2', 'web2']])
+
+        # a new shard, and the target now lists the nodes the other way round
+        self.write(os.path.join('shards', 'd'), 'd')
+        self.cluster.nodes.reverse()
+        self.cluster.lineterm = FakeLineTerm()
+        scatter.scatter('web* %s /data --reuse' % source, self.cluster, logger)
+
+        self.assertEqual(sorted(self.cluster.lineterm.puts),
+                         [('web1', '/data/a'), ('web1', '/data/c'), ('web2', '/data/b'), ('web2', '/data/d')])
+        with open(assign_file) as fh:
+            self.assertEqual(yaml.safe_load(fh)['files'], { 'a' : 'web1', 'b' : 'web2', 'c' : 'web1', 'd' : 'web2' })
+
+    def test_reuse_without_saved_assignment(self):
+        src = self.write('events.log', 'x\n')
+        scatter.scatter('web* %s /data --reuse' % src, self.cluster, logger)
+        self.assertEqual(self.cluster.lineterm.cmds, [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+
+import os
+import shutil
+import hashlib
+import logging
+import tempfile
+import unittest
+
+from dustcluster.commands import script
+
+
+logger = logging.getLogger('test')
+logger.addHandler(logging.NullHandler())
+
+
+class FakeStat(object):
+
+    def __init__(self, size):
+        self.st_size = size
+
+
+class FakeRemoteFile(object):
+
+    def __init__(self, files, path):
+        self.files = files
+        self.path = path
+        self.files[path] = ''
+
+    def set_pipelined(self, pipelined):
+        pass
+
+    def write(self, data):
+        self.files[self.path] += data
+
+    def close(self):
+        pass
+
+
+class FakeSFTP(object):
+    ''' one node's files and dirs, with every call logged in ops '''
+
+    def __init__(self, fail=False):
+        self.files = {}
+        self.dirs = set(['.'])
+        self.ops = []
+        self.fail = fail
+
+    def stat(self, path):
+        self.ops.append( ('stat', path) )
+        if path in self.files:
+            return FakeStat(len(self.files[path]))
+        if path in self.dirs:
+            return FakeStat(0)
+        raise IOError('no such file %s' % path)
+
+    def mkdir(self, path):
+        self.ops.append( ('mkdir', path) )
+        self.dirs.add(path)
+
+    def open(self, path, mode):
+        self.ops.append( ('open', path) )
+        if self.fail:
+            raise IOError('disk full')
+        return FakeRemoteFile(self.files, path)
+
+    def chmod(self, path, mode):
+        self.ops.append( ('chmod', path) )
+
+    def posix_rename(self, src, dest):
+        self.ops.append( ('rename', src, dest) )
+        self.files[dest] = self.files.pop(src)
+
+
+class FakeNode(object):
+
+    def __init__(self, name):
+        self.name = name
+        self.keyfile = 'key'
+
+
+class FakeLineTerm(object):
+
+    def __init__(self, nodes):
+        self.sftps = dict((node.name, FakeSFTP()) for node in nodes)
+        self.cmds = []
+
+    def sftp(self, keyfile, node):
+        return self.sftps[node.name]
+
+    def new_run(self, cmdline, nodes):
+        return 1
+
+    def command(self, keyfile, node, cmd, run_id=None):
+        self.cmds.append( (node.name, cmd) )
+
+
+class FakeCluster(object):
+
+    def __init__(self, nodes):
+        self.nodes = nodes
+        self.dust_config_data = {}
+        self.capture = None
+        self.lineterm = FakeLineTerm(nodes)
+
+    def running_nodes_from_target(self, target):
+        return list(self.nodes)
+
+
+class ScriptTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.nodes = [FakeNode('web1'), FakeNode('web2')]
+        self.cluster = FakeCluster(self.nodes)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, name, data):
+        path = os.path.join(self.tmp, name)
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        return path, hashlib.sha1(data).hexdigest()
+
+    def test_upload_then_rename(self):
+        path, digest = self.write('setup.sh', '#!/bin/bash\necho hi\n')
+        script.script('web* %s -v 2' % path, self.cluster, logger)
+
+        sftp = self.cluster.lineterm.sftps['web1']
+        cached = '.dust/scripts/%s' % digest
+        tmp_path = '%s.%s.tmp' % (cached, os.getpid())
+        self.assertEqual(sftp.ops, [('stat', cached), ('stat', '.dust'), ('mkdir', '.dust'),
+                                    ('stat', '.dust/scripts'), ('mkdir', '.dust/scripts'),
+                                    ('open', tmp_path), ('stat', tmp_path), ('chmod', tmp_path),
+                                    ('rename', tmp_path, cached)])
+        self.assertEqual(sftp.files, { cached : '#!/bin/bash\necho hi\n' })
+        self.assertEqual(self.cluster.lineterm.cmds, [('web1', '~/%s -v 2' % cached), ('web2', '~/%s -v 2' % cached)])
+
+    def test_cache_hit(self):
+        path, digest = self.write('setup.sh', 'echo hi\n')
+        for sftp in self.cluster.lineterm.sftps.values():
+            sftp.files['.dust/scripts/%s' % digest] = 'echo hi\n'
+
+        script.script('web* %s' % path, self.cluster, logger)
+
+        for sftp in self.cluster.lineterm.sftps.values():
+            self.assertEqual(sftp.ops, [('stat', '.dust/scripts/%s' % digest)])
+        # no #! line, so it runs with sh
+        self.assertEqual(self.cluster.lineterm.cmds[0], ('web1', 'sh ~/.dust/scripts/%s' % digest))
+
+    def test_changed_script_is_a_miss(self):
+        path, old_digest = self.write('setup.sh', 'echo one\n')
+        sftp = self.cluster.lineterm.sftps['web1']
+        sftp.files['.dust/scripts/%s' % old_digest] = 'echo one\n'
+
+        _, digest = self.write('setup.sh', 'echo two\n')
+        script.script('web* %s' % path, self.cluster, logger)
+        self.assertEqual(sftp.files['.dust/scripts/%s' % digest], 'echo two\n')
+
+    def test_cache_dir(self):
+        path, digest = self.write('setup.sh', 'echo hi\n')
+
+        self.cluster.dust_config_data['script_cache_dir'] = '~/my scripts'
+        script.script('web* %s' % path, self.cluster, logger)
+        self.assertTrue('my scripts/%s' % digest in self.cluster.lineterm.sftps['web1'].files)
+        self.assertEqual(self.cluster.lineterm.cmds[0], ('web1', "sh ~/'my scripts/%s'" % digest))
+
+        self.cluster.lineterm = FakeLineTerm(self.nodes)
+        self.cluster.dust_config_data['script_cache_dir'] = '/opt/dust'
+        script.script('web* %s' % path, self.cluster, logger)
+        self.assertTrue('/opt/dust/%s' % digest in self.cluster.lineterm.sftps['web1'].files)
+        self.assertEqual(self.cluster.lineterm.cmds[0], ('web1', 'sh /opt/dust/%s' % digest))
+
+    def test_failed_upload_is_not_run(self):
+        path, _ = self.write('setup.sh', 'echo hi\n')
+        self.cluster.lineterm.sftps['web2'].fail = True
+        script.script('web* %s' % path, self.cluster, logger)
+        self.assertEqual([nodename for nodename, _ in self.cluster.lineterm.cmds], ['web1'])
+
+
+if __name__ == '__main__':
+    unittest.main()
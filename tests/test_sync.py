@@ -0,0 +1,216 @@
+
+import os
+import shutil
+import hashlib
+import logging
+import tempfile
+import unittest
+import subprocess
+
+import yaml
+
+from dustcluster import transfer
+from dustcluster.commands import sync
+
+
+logger = logging.getLogger('test')
+logger.addHandler(logging.NullHandler())
+
+
+class FakeFile(object):
+
+    def __init__(self, data):
+        self.data = data
+
+    def read(self):
+        return self.data
+
+
+class FakeChan(object):
+
+    def __init__(self, out=''):
+        self.out = out
+
+    def makefile(self, mode):
+        return FakeFile(self.out)
+
+    def recv_exit_status(self):
+        return 0
+
+    def close(self):
+        pass
+
+
+class FakeRemoteFile(object):
+
+    def __init__(self, files, path):
+        self.files = files
+        self.path = path
+        self.files[path] = ''
+
+    def set_pipelined(self, pipelined):
+        pass
+
+    def write(self, data):
+        self.files[self.path] += data
+
+    def close(self):
+        pass
+
+
+class FakeSFTP(object):
+
+    def __init__(self):
+        self.files = {}
+        self.utimes = {}
+
+    def open(self, path, mode):
+        return FakeRemoteFile(self.files, path)
+
+    def utime(self, path, times):
+        self.utimes[path] = times
+
+
+class FakeLineTerm(object):
+    ''' answers the file listing with stat_out, and records everything else '''
+
+    def __init__(self, stat_out=''):
+        self.stat_out = stat_out
+        self.cmds = []
+        self.sftp_client = FakeSFTP()
+
+    def exec_command(self, keyfile, node, cmd):
+        self.cmds.append(cmd)
+        if sync.list_files_cmd in cmd:
+            return FakeChan(self.stat_out)
+        return FakeChan()
+
+    def sftp(self, keyfile, node):
+        return self.sftp_client
+
+
+class FakeNode(object):
+
+    name = 'web1'
+
+    def get(self, prop):
+        return { 'id' : 'i-1' }.get(prop)
+
+
+class RemoteStatTest(unittest.TestCase):
+
+    def stat(self, out, remotedir='/opt/app'):
+        lineterm = FakeLineTerm(out)
+        files = sync.remote_stat(lineterm, FakeNode(), 'key', remotedir)
+        return files, lineterm.cmds[0]
+
+    def test_gnu_find(self):
+        files, cmd = self.stat('10 1700000000.1234567890 a.txt\n20 1700000001.0000000000 sub/with space.txt\n')
+        self.assertEqual(files, { 'a.txt' : (10, 1700000000), 'sub/with space.txt' : (20, 1700000001) })
+        self.assertTrue(cmd.startswith('cd /opt/app 2>/dev/null && {'))
+
+    def test_gnu_stat(self):
+        files, _ = self.stat('10 1700000000 ./a.txt\n20 1700000001 ./sub/with space.txt\n')
+        self.assertEqual(files, { 'a.txt' : (10, 1700000000), 'sub/with space.txt' : (20, 1700000001) })
+
+    def test_bsd_stat(self):
+        # BSD stat -f '%z %m %N' prints the same columns, blank lines are skipped
+        files, _ = self.stat('10 1700000000 ./a.txt\n\n0 1700000002 ./empty\n')
+        self.assertEqual(files, { 'a.txt' : (10, 1700000000), 'empty' : (0, 1700000002) })
+
+    def test_home_dir(self):
+        _, cmd = self.stat('', '~/my app')
+        self.assertTrue(cmd.startswith("cd ~/'my app' 2>/dev/null"))
+
+    def test_listing_runs_here(self):
+        # whichever branch this machine's find and stat take, the output parses the same
+        tmp = tempfile.mkdtemp()
+        try:
+            os.makedirs(os.path.join(tmp, 'sub'))
+            for relpath, data in [('a.txt', 'hello'), ('sub/b c.txt', 'x' * 100)]:
+                with open(os.path.join(tmp, relpath), 'wb') as fh:
+                    fh.write(data)
+                os.utime(os.path.join(tmp, relpath), (1700000000, 1700000000))
+            out = subprocess.Popen(['sh', '-c', sync.list_files_cmd], cwd=tmp, stdout=subprocess.PIPE).communicate()[0]
+            files, _ = self.stat(out)
+            self.assertEqual(files, { 'a.txt' : (5, 1700000000), 'sub/b c.txt' : (100, 1700000000) })
+        finally:
+            shutil.rmtree(tmp)
+
+
+class SyncToNodeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.localdir = os.path.join(self.tmp, 'app')
+        self.manifest_dir = os.path.join(self.tmp, 'sync')
+        os.makedirs(self.localdir)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def write(self, relpath, data, mtime):
+        path = os.path.join(self.localdir, relpath)
+        with open(path, 'wb') as fh:
+            fh.write(data)
+        os.utime(path, (mtime, mtime))
+
+    def save_manifest(self, manifest, remotedir='/opt/app'):
+        os.makedirs(self.manifest_dir)
+        with open(os.path.join(self.manifest_dir, 'i-1.yaml'), 'w') as fh:
+            yaml.safe_dump({ remotedir : manifest }, fh)
+
+    def load_manifest(self, remotedir='/opt/app'):
+        with open(os.path.join(self.manifest_dir, 'i-1.yaml')) as fh:
+            return yaml.safe_load(fh)[remotedir]
+
+    def sync(self, stat_out, remotedir='/opt/app'):
+        lineterm = FakeLineTerm(stat_out)
+        sync.sync_to_node(lineterm, FakeNode(), 'key', sync.LocalTree(self.localdir), remotedir,
+                          self.manifest_dir, logger, transfer.TransferSummary())
+        return lineterm
+
+    def test_manifest_diff(self):
+        md5 = lambda data: hashlib.md5(data).hexdigest()
+        self.write('new', 'new', 1000)
+        self.write('same', 'same', 1000)
+        self.write('changed_remotely', 'mine', 1000)
+        self.write('touched', 'touched', 2000)
+        self.write('edited', 'edited!', 2000)
+        self.write('unknown', 'unknown', 1000)
+        self.save_manifest({ 'same' : [4, 1000, md5('same')],
+                             'changed_remotely' : [4, 1000, md5('mine')],
+                             'touched' : [7, 1000, md5('touched')],
+                             'edited' : [7, 1000, md5('before!')] })
+
+        lineterm = self.sync('4 1000 same\n5 1500 changed_remotely\n7 1000 touched\n7 1000 edited\n7 1000 unknown\n')
+
+        sftp = lineterm.sftp_client
+        self.assertEqual(sorted(sftp.files), ['/opt/app/changed_remotely', '/opt/app/edited', '/opt/app/new'])
+        self.assertEqual(sftp.files['/opt/app/edited'], 'edited!')
+        # a local touch is fixed up with a utime, not an upload
+        self.assertEqual(sftp.utimes['/opt/app/touched'], (2000, 2000))
+
+        manifest = self.load_manifest()
+        self.assertEqual(manifest['touched'], [7, 2000, md5('touched')])
+        self.assertEqual(manifest['edited'], [7, 2000, md5('edited!')])
+        # a remote file that matches a file we never pushed is taken into the manifest
+        self.assertEqual(manifest['unknown'], [7, 1000, md5('unknown')])
+        self.assertEqual(manifest['new'], [3, 1000, md5('new')])
+
+    def test_nothing_changed(self):
+        self.write('same', 'same', 1000)
+        lineterm = self.sync('4 1000 same\n')
+        self.assertEqual(lineterm.sftp_client.files, {})
+        self.assertEqual(len(lineterm.cmds), 1)
+
+    def test_home_dir(self):
+        self.write('a', 'a', 1000)
+        lineterm = self.sync('', '~/app')
+        self.assertEqual(lineterm.cmds[1], 'mkdir -p ~/app')
+        self.assertEqual(lineterm.sftp_client.files, { 'app/a' : 'a' })
+        self.assertEqual(lineterm.sftp_client.utimes, { 'app/a' : (1000, 1000) })
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,102 @@
+
+import calendar
+import unittest
+
+from dustcluster.commands import tail
+from dustcluster.commands.tail import LogMerger, parse_timestamp, zone_offset
+
+
+# 2016-04-05 23:41:47 UTC
+ts = calendar.timegm((2016, 4, 5, 23, 41, 47))
+
+
+class ParseTimestampTest(unittest.TestCase):
+
+    def test_iso(self):
+        self.assertEqual(parse_timestamp('2016-04-05 23:41:47,623 INFO started', 0, 2016), ts + 0.623)
+        self.assertEqual(parse_timestamp('2016-04-05T23:41:47.5Z started', 3600, 2016), ts + 0.5)
+        self.assertEqual(parse_timestamp('[app] 2016-04-06T01:41:47+02:00 started', 0, 2016), ts)
+        # no zone, so in the node's local time
+        self.assertEqual(parse_timestamp('2016-04-06 00:41:47 started', 3600, 2016), ts)
+
+    def test_syslog(self):
+        self.assertEqual(parse_timestamp('Apr  5 23:41:47 web1 sshd[1]: accepted', 0, 2016), ts)
+        self.assertEqual(parse_timestamp('Apr  5 18:41:47 web1 cron', -5 * 3600, 2016), ts)
+
+    def test_epoch(self):
+        self.assertEqual(parse_timestamp('%d.250 GET /index.html' % ts, 0, 2016), ts + 0.25)
+        self.assertEqual(parse_timestamp('[%d] job done' % ts, 0, 2016), ts)
+        self.assertEqual(parse_timestamp('%d.5' % ts, 0, 2016), ts + 0.5)
+
+    def test_numbers_that_are_not_timestamps(self):
+        for line in ['1459899707 rows copied', '1459899707-abc', '14598997071 bytes', '[1459899707 open', 'no time']:
+            self.assertEqual(parse_timestamp(line, 0, 2016), None, line)
+
+    def test_zone_offset(self):
+        self.assertEqual(zone_offset('Z'), 0)
+        self.assertEqual(zone_offset('+0200'), 7200)
+        self.assertEqual(zone_offset('-05:30'), -(5 * 3600 + 1800))
+
+
+class FakeChan(object):
+
+    def __init__(self, lines):
+        self.lines = lines
+
+    def makefile(self, mode):
+        return iter(line + '\n' for line in self.lines)
+
+
+class Merger(LogMerger):
+
+    def __init__(self, merge=True):
+        LogMerger.__init__(self, merge)
+        self.out = []
+
+    def write(self, nodename, line):
+        self.out.append( (nodename, line) )
+
+
+class LogMergerTest(unittest.TestCase):
+
+    def setUp(self):
+        self.max_held_lines = tail.max_held_lines
+
+    def tearDown(self):
+        tail.max_held_lines = self.max_held_lines
+
+    def test_lines_are_held_then_flushed(self):
+        merger = Merger()
+        merger.read_lines('web1', FakeChan(['[%d] a' % ts, '[%d] b' % (ts + 1)]), (0.0, 0))
+        # arrived just now, held for merge_latency
+        merger.emit()
+        self.assertEqual(merger.out, [])
+        merger.emit(flush=True)
+        self.assertEqual(merger.out, [('web1', '[%d] a' % ts), ('web1', '[%d] b' % (ts + 1))])
+
+    def test_held_lines_are_bounded(self):
+        tail.max_held_lines = 3
+        merger = Merger()
+        merger.read_lines('web1', FakeChan(['[%d] %d' % (ts + i, i) for i in range(5)]), (0.0, 0))
+        merger.emit()
+        self.assertEqual([line[-1] for _, line in merger.out], ['0', '1'])
+
+    def test_merge_across_skewed_nodes(self):
+        merger = Merger()
+        # web1's clock is 10 seconds fast, web2 logs in local time at UTC+1
+        merger.read_lines('web1', FakeChan(['[%d] web1 first' % (ts + 10), 'continued', '[%d] web1 third' % (ts + 12)]),
+                          (10.0, 0))
+        merger.read_lines('web2', FakeChan(['2016-04-06 00:41:48 web2 second', '2016-04-06 00:41:50 web2 fourth']),
+                          (0.0, 3600))
+        merger.emit(flush=True)
+        self.assertEqual([line.split()[-1] for _, line in merger.out],
+                         ['first', 'continued', 'second', 'third', 'fourth'])
+
+    def test_no_merge_writes_through(self):
+        merger = Merger(merge=False)
+        merger.read_lines('web1', FakeChan(['b', 'a']), (0.0, 0))
+        self.assertEqual(merger.out, [('web1', 'b'), ('web1', 'a')])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,126 @@
+
+import unittest
+
+from dustcluster import target
+from dustcluster.EC2 import EC2Cloud
+from dustcluster.inventory import NodeTable
+from dustcluster.target import TargetError, parse, split_target
+from tests.test_inventory import FakeNode
+
+
+def make_table():
+    nodes = []
+    for i in range(12):
+        nodes.append(FakeNode('web%d' % i if i < 8 else 'db%d' % i,
+                              state='running' if i % 3 else 'stopped',
+                              ami_launch_index=i % 4,
+                              tags={ 'env' : 'prod' if i < 6 else 'dev' }))
+    return NodeTable(nodes)
+
+
+class ParseTest(unittest.TestCase):
+
+    def test_precedence(self):
+        self.assertEqual(repr(parse('a=1 | b=2 & c=3')), '(a=1 | (b=2 & c=3))')
+        self.assertEqual(repr(parse('(a=1 | b=2) & c=3')), '((a=1 | b=2) & c=3)')
+        self.assertEqual(repr(parse('!a=1 & b=2')), '(!a=1 & b=2)')
+        self.assertEqual(repr(parse('!(a=1 | b=2)')), '!(a=1 | b=2)')
+
+    def test_predicates(self):
+        self.assertEqual(repr(parse('worker*')), 'name=worker*')
+        self.assertEqual(repr(parse('~^web')), 'name~^web')
+        self.assertEqual(repr(parse('cluster:hpc')), 'cluster=hpc')
+        self.assertEqual(repr(parse('"ami_launch_index>=2"')), 'ami_launch_index>=2')
+        self.assertEqual(repr(parse('tags="my app:x y"')), 'tags=my app:x y')
+
+    def test_errors(self):
+        for text in ['(a=1', 'a=1 &', 'a=1 )', '& a=1', '=x', 'tags=nokey', 'name~[', 'name=w[5-1]', 'name="abc']:
+            self.assertRaises(TargetError, parse, text)
+
+    def test_split_target(self):
+        self.assertEqual(split_target('"state=running & web*" uptime -p'), ('state=running & web*', 'uptime -p'))
+        self.assertEqual(split_target('web* uptime'), ('web*', 'uptime'))
+        self.assertEqual(split_target('"web* uptime'), ('"web*', 'uptime'))
+
+
+class RowsTest(unittest.TestCase):
+
+    def setUp(self):
+        self.table = make_table()
+
+    def names(self, text):
+        return [node.name for node in self.table.select(parse(text).rows(self.table))]
+
+    def test_boolean(self):
+        self.assertEqual(self.names('web* & state=stopped'), ['web0', 'web3', 'web6'])
+        self.assertEqual(self.names('db* | tags=env:prod & state=stopped'),
+                         ['web0', 'web3', 'db8', 'db9', 'db10', 'db11'])
+        self.assertEqual(self.names('!web* & !state=stopped'), ['db8', 'db10', 'db11'])
+
+    def test_comparisons(self):
+        self.assertEqual(self.names('ami_launch_index>=3'), ['web3', 'web7', 'db11'])
+        self.assertEqual(self.names('name~^db1'), ['db10', 'db11'])
+        self.assertEqual(self.names('state!=running & web[1-4]'), ['web3'])
+
+
+class NeverTerm(object):
+    ''' a term that is planned last and must not be evaluated '''
+
+    def plan_cost(self, table):
+        return 9, 0
+
+    def rows(self, table):
+        raise AssertionError('evaluated after the And was already empty')
+
+
+class PlanTest(unittest.TestCase):
+
+    def test_order(self):
+        table = make_table()
+        expr = parse('(db* | web1) & ami_launch_index>=1 & web* & state=stopped & tags=env:prod')
+        self.assertEqual([repr(term) for term in expr.plan(table)],
+                         ['state=stopped', 'tags=env:prod', 'name=web*', 'ami_launch_index>=1',
+                          '(name=db* | name=web1)'])
+
+    def test_range_is_planned_as_exact(self):
+        table = make_table()
+        expr = parse('web* & name=web[1-2]')
+        self.assertEqual([repr(term) for term in expr.plan(table)], ['name=web[1-2]', 'name=web*'])
+
+    def test_short_circuit(self):
+        table = make_table()
+        expr = target.And([parse('state=terminated'), NeverTerm()])
+        self.assertEqual(expr.rows(table), set())
+
+
+class FakeCluster(object):
+
+    def __init__(self):
+        self.cloud = EC2Cloud(region='us-east-1')
+        self.clusters = { 'hpc' : {} }
+
+    def cluster_filter(self, cluster_name):
+        return 'tags', 'cluster:%s' % cluster_name
+
+
+class PushdownTest(unittest.TestCase):
+
+    def filters(self, text):
+        return parse(text).api_filters(FakeCluster())
+
+    def test_and_pushes_down_each_term(self):
+        self.assertEqual(self.filters('state=running & type=t2.micro & web*'),
+                         { 'instance-state-name' : 'running', 'instance-type' : 't2.micro' })
+        self.assertEqual(self.filters('cluster:hpc & tags=env:prod'), { 'tag:cluster' : 'hpc', 'tag:env' : 'prod' })
+
+    def test_conflicting_values_keep_the_first(self):
+        self.assertEqual(self.filters('state=running & state=stopped'), { 'instance-state-name' : 'running' })
+
+    def test_not_pushed_down(self):
+        for text in ['state=running | type=t2.micro', '!state=running', 'state!=running', 'ami_launch_index>=2',
+                     'cluster:unknown', 'web*', 'id=i-[1-2]']:
+            self.assertEqual(self.filters(text), None)
+
+
+if __name__ == '__main__':
+    unittest.main()
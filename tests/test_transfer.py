@@ -0,0 +1,773 @@
+
+import os
+import stat
+import hashlib
+import time
+import shutil
+import tarfile
+import socket
+import sys
+import tempfile
+import unittest
+import subprocess
+import threading
+from StringIO import StringIO
+
+import yaml
+
+from dustcluster import transfer
+from dustcluster.capture import CaptureStore
+
+
+def make_tar(members):
+    ''' tar stream of [(tarinfo, data)] '''
+
+    buf = StringIO()
+    tar = tarfile.open(fileobj=buf, mode='w')
+    for info, data in members:
+        if data is not None:
+            info.size = len(data)
+            tar.addfile(info, StringIO(data))
+        else:
+            tar.addfile(info)
+    tar.close()
+    buf.seek(0)
+    return buf
+
+
+def file_info(name):
+    return tarfile.TarInfo(name)
+
+
+def link_info(name, target, linktype=tarfile.SYMTYPE):
+    info = tarfile.TarInfo(name)
+    info.type = linktype
+    info.linkname = target
+    return info
+
+
+class ExtractSafeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.destdir = os.path.join(self.tmp, 'node1')
+        self.outside = os.path.join(self.tmp, 'outside')
+        os.makedirs(self.outside)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def extract(self, members):
+        tar = tarfile.open(fileobj=make_tar(members), mode='r|')
+        transfer.extract_safe(tar, self.destdir, 'node1')
+        tar.close()
+
+    def test_plain_tree(self):
+        dirinfo = tarfile.TarInfo('app/conf')
+        dirinfo.type = tarfile.DIRTYPE
+        self.extract([(dirinfo, None), (file_info('app/conf/a.yaml'), 'a: 1\n')])
+        with open(os.path.join(self.destdir, 'app', 'conf', 'a.yaml')) as fh:
+            self.assertEqual(fh.read(), 'a: 1\n')
+
+    def test_symlink_then_write_through_it(self):
+        self.extract([(link_info('app/logs', self.outside), None),
+                      (file_info('app/logs/pwned'), 'x'),
+                      (file_info('app/ok'), 'ok')])
+        self.assertEqual(os.listdir(self.outside), [])
+        self.assertFalse(os.path.islink(os.path.join(self.destdir, 'app', 'logs')))
+        self.assertTrue(os.path.exists(os.path.join(self.destdir, 'app', 'ok')))
+
+    def test_relative_symlink_out(self):
+        self.extract([(link_info('up', '../outside'), None), (file_info('up/pwned'), 'x')])
+        self.assertEqual(os.listdir(self.outside), [])
+
+    def test_hardlink(self):
+        target = os.path.join(self.outside, 'secret')
+        with open(target, 'w') as fh:
+            fh.write('secret')
+        self.extract([(link_info('secret', target, tarfile.LNKTYPE), None)])
+        self.assertFalse(os.path.lexists(os.path.join(self.destdir, 'secret')))
+
+    def test_absolute_and_parent_paths(self):
+        self.extract([(file_info(os.path.join(self.outside, 'abs')), 'x'),
+                      (file_info('../outside/rel'), 'x'),
+                      (file_info('a/../../outside/rel2'), 'x')])
+        self.assertEqual(os.listdir(self.outside), [])
+
+    def test_existing_symlink_on_disk(self):
+        os.makedirs(self.destdir)
+        os.symlink(self.outside, os.path.join(self.destdir, 'logs'))
+        self.extract([(file_info('logs/pwned'), 'x')])
+        self.assertEqual(os.listdir(self.outside), [])
+
+    def test_device_member(self):
+        info = tarfile.TarInfo('dev')
+        info.type = tarfile.CHRTYPE
+        self.extract([(info, None)])
+        self.assertFalse(os.path.lexists(os.path.join(self.destdir, 'dev')))
+
+
+class FakeStat(object):
+    def __init__(self, size):
+        self.st_size = size
+
+
+class FakeSFTPFile(object):
+
+    def __init__(self, data):
+        self.data = data
+        self.requested = 0
+
+    def stat(self):
+        return FakeStat(len(self.data))
+
+    def readv(self, chunks):
+        self.requested += sum(length for _, length in chunks)
+        for offset, length in chunks:
+            yield self.data[offset:offset+length]
+
+    def close(self):
+        pass
+
+
+class FakeSFTP(object):
+
+    def __init__(self, data):
+        self.file = FakeSFTPFile(data)
+        self.opened = []
+
+    def open(self, path, mode):
+        self.opened.append(path)
+        return self.file
+
+
+class SFTPGetTest(unittest.TestCase):
+
+    def test_get_reads_in_windows(self):
+        data = os.urandom(transfer.read_window + 1000)
+        sftp = FakeSFTP(data)
+        tmp = tempfile.mkdtemp()
+        try:
+            localfile = os.path.join(tmp, 'out')
+            progress = []
+            self.assertEqual(transfer.sftp_get(sftp, 'blob', localfile, lambda done, total: progress.append(done)),
+                             len(data))
+            with open(localfile, 'rb') as fh:
+                self.assertEqual(fh.read(), data)
+            self.assertEqual(progress[-1], len(data))
+        finally:
+            shutil.rmtree(tmp)
+
+
+class RemoteLinesTest(unittest.TestCase):
+
+    def test_lines_across_blocks(self):
+        lines = ['line %d %s' % (i, 'x' * (i % 300)) for i in range(50000)]
+        sftp = FakeSFTP('\r\n'.join(lines))
+        self.assertEqual(list(transfer.RemoteLines(sftp, 'app.log')), lines)
+
+    def test_memory_is_bounded_per_node(self):
+        data = ('y' * 99 + '\n') * (200 * 1024)     # 20 MB
+        sftp = FakeSFTP(data)
+        reader = transfer.RemoteLines(sftp, 'app.log', max_lines=100)
+        time.sleep(0.5)
+        # the reader is blocked on the full queue with at most a window requested
+        self.assertTrue(sftp.file.requested <= transfer.read_window)
+        self.assertEqual(sum(1 for _ in reader), 200 * 1024)
+        self.assertEqual(sftp.file.requested, len(data))
+
+
+class FakeNode(object):
+
+    def __init__(self, name, nodeid=None):
+        self.name = name
+        self.data = { 'placement' : 'us-east-1a', 'private_ip_address' : '10.0.0.%s' % name[-1], 'id' : nodeid }
+
+    def get(self, prop):
+        return self.data.get(prop)
+
+
+class FakeChan(object):
+
+    def __init__(self, out='', fail=False):
+        self.out = out
+        self.fail = fail
+        self.closed = False
+        self.sent = ''
+
+    def recv_exit_status(self):
+        if self.fail:
+            raise socket.error('connection reset')
+        return 0
+
+    def makefile(self, mode):
+        return StringIO(self.out)
+
+    def sendall(self, data):
+        self.sent += data
+
+    def shutdown_write(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class FakeTreeTerm(object):
+    ''' the sender's channel fails, the receiver's would wait for it '''
+
+    def __init__(self):
+        self.chans = []
+
+    def exec_command(self, keyfile, node, cmd):
+        if cmd.startswith('md5sum'):
+            return FakeChan(out=transfer.local_md5(__file__))
+        chan = FakeChan(fail='create_connection' in cmd)
+        self.chans.append(chan)
+        return chan
+
+
+class TreePutTest(unittest.TestCase):
+
+    def setUp(self):
+        self.resumable_put = transfer.resumable_put
+        transfer.resumable_put = lambda *args, **kwargs: None
+
+    def tearDown(self):
+        transfer.resumable_put = self.resumable_put
+
+    def test_failed_copy_closes_channels(self):
+        lineterm = FakeTreeTerm()
+        nodes = [(FakeNode('node1', 'i-1'), 'key'), (FakeNode('node2', 'i-2'), 'key')]
+        summary = transfer.tree_put(lineterm, nodes, __file__, 'dest')
+        self.assertEqual(len(lineterm.chans), 6)        # 3 attempts, a receiver and a sender each
+        self.assertTrue(all(chan.closed for chan in lineterm.chans))
+        self.assertEqual(summary.failed.keys(), ['node2'])
+
+    def test_token_and_keyfiles(self):
+        lineterm = FakeCopyTerm()
+        # unnamed nodes, told apart by id
+        nodes = [(FakeNode('1', 'i-1'), 'key1'), (FakeNode('2', 'i-2'), 'key2'), (FakeNode('3', 'i-3'), 'key3')]
+        for node, _ in nodes:
+            node.name = ''
+        summary = transfer.tree_put(lineterm, nodes, __file__, '~/dest')
+
+        self.assertEqual(summary.failed, {})
+        receivers = [call for call in lineterm.calls if 'accept' in call[2]]
+        senders = [call for call in lineterm.calls if 'create_connection' in call[2]]
+        self.assertEqual(sorted((nodeid, keyfile) for nodeid, keyfile, _, _ in receivers),
+                         [('i-2', 'key2'), ('i-3', 'key3')])
+        for (nodeid, _, cmd, rchan), (_, _, _, schan) in zip(receivers, senders):
+            # bound to the receiver's private address, the token goes on stdin, not the command line
+            self.assertTrue("'\"'\"'10.0.0.%s'\"'\"', " % nodeid[-1] in cmd)
+            self.assertEqual(len(rchan.sent), 33)
+            self.assertEqual(rchan.sent, schan.sent)
+            self.assertFalse(rchan.sent.strip() in cmd)
+            self.assertTrue("'\"'\"'dest'\"'\"'" in cmd)
+        # a new token for every copy
+        self.assertEqual(len(set(chan.sent for _, _, _, chan in receivers)), 2)
+
+
+class FakeCopyTerm(object):
+    ''' every copy succeeds, md5sum reads back this file's md5 '''
+
+    def __init__(self):
+        self.calls = []     # [(node id, keyfile, cmd, chan)]
+
+    def exec_command(self, keyfile, node, cmd):
+        if cmd.startswith('md5sum'):
+            return FakeChan(out=transfer.local_md5(__file__))
+        chan = FakeChan()
+        self.calls.append( (node.get('id'), keyfile, cmd, chan) )
+        return chan
+
+
+class CopyScriptTest(unittest.TestCase):
+    ''' the receiver and sender scripts run here over loopback '''
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        for name in ['sender', 'receiver']:
+            os.makedirs(os.path.join(self.tmp, name))
+        self.data = os.urandom(3 * 1024 * 1024)
+        with open(os.path.join(self.tmp, 'sender', 'blob'), 'wb') as fh:
+            fh.write(self.data)
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def start(self, script, cwd, token):
+        proc = subprocess.Popen([sys.executable, '-c', script], cwd=os.path.join(self.tmp, cwd),
+                                stdin=subprocess.PIPE, stderr=subprocess.PIPE)
+        proc.stdin.write('%s\n' % token)
+        proc.stdin.close()
+        return proc
+
+    def connect(self, port):
+        for _ in range(100):
+            try:
+                return socket.create_connection(('127.0.0.1', port), 1)
+            except socket.error:
+                time.sleep(0.05)
+        raise AssertionError('receiver did not start')
+
+    def test_copy_needs_the_token(self):
+        sock = socket.socket()
+        sock.bind(('127.0.0.1', 0))
+        port = sock.getsockname()[1]
+        sock.close()
+
+        args = { 'port' : port, 'dest' : 'blob', 'host' : '127.0.0.1' }
+        token = os.urandom(16).encode('hex')
+        receiver = self.start(transfer.tree_receiver % args, 'receiver', token)
+
+        # someone else on the network gets there first
+        intruder = self.connect(port)
+        intruder.sendall('x' * 32 + 'not the file')
+        intruder.close()
+
+        sender = self.start(transfer.tree_sender % args, 'sender', token)
+        self.assertEqual(sender.wait(), 0, sender.stderr.read())
+        self.assertEqual(receiver.wait(), 0, receiver.stderr.read())
+        with open(os.path.join(self.tmp, 'receiver', 'blob'), 'rb') as fh:
+            self.assertTrue(fh.read() == self.data)
+
+
+class FakeExecTerm(object):
+    ''' records the remote commands, every channel reads back out '''
+
+    def __init__(self, out=''):
+        self.out = out
+        self.cmds = []
+
+    def exec_command(self, keyfile, node, cmd):
+        self.cmds.append(cmd)
+        return FakeChan(out=self.out)
+
+
+class TreeTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp()
+        self.node = FakeNode('node1')
+
+    def tearDown(self):
+        shutil.rmtree(self.tmp)
+
+    def test_put_expands_home(self):
+        lineterm = FakeExecTerm()
+        transfer.put_tree(lineterm, self.node, 'key', self.tmp, '~/my app', compress=False)
+        self.assertEqual(lineterm.cmds, ["mkdir -p ~/'my app' && tar -C ~/'my app' -xf -"])
+
+    def test_get_paths(self):
+        lineterm = FakeExecTerm(make_tar([(file_info('logs/a.log'), 'a')]).getvalue())
+        transfer.get_tree(lineterm, self.node, 'key', '~/logs/', self.tmp, compress=False)
+        transfer.get_tree(lineterm, self.node, 'key', '~', self.tmp, compress=False)
+        transfer.get_tree(lineterm, self.node, 'key', '/var/log', self.tmp, compress=False)
+        self.assertEqual(lineterm.cmds, ['tar -C ~ -cf - logs', 'tar -C ~ -cf - .', 'tar -C /var -cf - log'])
+        self.assertTrue(os.path.exists(os.path.join(self.tmp, 'node1', 'logs', 'a.log')))
+
+    def test_get_root_refused(self):
+        lineterm = FakeExecTerm()
+        for remotedir in ['/', '//', '']:
+            self.assertRaises(Exception, transfer.get_tree, lineterm, self.node, 'key', remotedir, self.tmp)
+        self.assertEqual(lineterm.cmds, [])
+
+
+class FakeAttr(object):
+
+    def __init__(self, filename, st_mode):
+        self.filename = filename
+        self.st_mode = st_mode
+
+
+class FakeListSFTP(object):
+
+    def __init__(self, dirs):
+        self.dirs = dirs
+        self.listed = []
+
+    def listdir_attr(self, path):
+        self.listed.append(path)
+        return [FakeAttr(name, stat.S_IFREG) for name in self.dirs[path]]
+
+
+class HomePathTest(unittest.TestCase):
+
+    def test_paths(self):
+        self.assertEqual([transfer.shell_path(p) for p in ['~', '~/a b', '/x y', 'rel']],
+                         ['~', "~/'a b'", "'/x y'", 'rel'])
+        self.assertEqual([transfer.sftp_path(p) for p in ['~', '~/', '~/a b', '/x', '~user/x']],
+                         ['.', '.', 'a b', '/x', '~user/x'])
+
+    def test_sftp_helpers(self):
+        sftp = FakeSFTP('a\nb\n')
+        tmp = tempfile.mkdtemp()
+        try:
+            transfer.sftp_get(sftp, '~/blob', os.path.join(tmp, 'out'))
+        finally:
+            shutil.rmtree(tmp)
+        self.assertEqual(list(transfer.RemoteLines(sftp, '~/logs/app.log')), ['a', 'b'])
+        self.assertEqual(sftp.opened, ['blob', 'logs/app.log'])
+
+    def test_glob(self):
+        sftp = FakeListSFTP({ 'logs' : ['a.log', 'b.txt'] })
+        self.assertEqual(transfer.expand_remote_glob(sftp, '~/logs/*.log'), ['logs/a.log'])
+        self.assertEqual(sftp.listed, ['logs'])
+
+    def test_remote_md5(self):
+        lineterm = FakeExecTerm('d41d8cd98f00b204e9800998ecf8427e  x\n')
+        self.assertEqual(transfer.remote_md5(lineterm, FakeNode('node1'), 'key', '~/a b'),
+                         'd41d8cd98f00b204e9800998ecf8427e')
+        self.assertEqual(lineterm.cmds, ["md5sum ~/'a b' 2>/dev/null || md5 -q ~/'a b'"])
+
+
+class FakeRemote(object):
+    ''' an open remote file. A write fails once the sftp session's byte budget runs out, as on a dropped link '''
+
+    def __init__(self, sftp, path, mode):
+        self.sftp = sftp
+        self.path = path
+        self.pos = 0
+        if mode == 'wb':
+            sftp.files[path] = ''
+
+    def set_pipelined(self, pipelined):
+        pass
+
+    def truncate(self, size):
+        self.sftp.ops.append( ('truncate', size) )
+        self.sftp.files[self.path] = self.sftp.files[self.path][:size]
+
+    def seek(self, offset):
+        self.sftp.ops.append( ('seek', offset) )
+        self.pos = offset
+
+    def write(self, data):
+        if self.sftp.fail_after is not None:
+            if self.sftp.fail_after < len(data):
+                self.sftp.fail_after = None
+                raise socket.error('connection reset')
+            self.sftp.fail_after -= len(data)
+        content = self.sftp.files[self.path]
+        self.sftp.files[self.path] = content[:self.pos] + data + content[self.pos+len(data):]
+        self.pos += len(data)
+
+    def flush(self):
+        pass
+
+    def stat(self):
+        return FakeStat(len(self.sftp.files[self.path]))
+
+    def close(self):
+        pass
+
+
+class FakeResumeSFTP(object):
+
+    def __init__(self):
+        self.files = {}
+        self.ops = []
+        self.fail_after = None
+
+    def open(self, path, mode):
+        self.ops.append( ('open', path, mode) )
+        return FakeRemote(self, path, mode)
+
+    def stat(self, path):
+        if path not in self.files:
+            raise IOError('no such file')
+        return FakeStat(len(self.files[path]))
+
+
+class FakeResumeTerm(object):
+    ''' one sftp session per node, md5sum is answered from its files '''
+
+    def __init__(self):
+        self.sftp_client = FakeResumeSFTP()
+        self.corrupt = False
+
+    def sftp(self, keyfile, node):
+        return self.sftp_client
+
+    def exec_command(self, keyfile, node, cmd):
+        data = self.sftp_client.files['blob']
+        if self.corrupt:
+            data = data[::-1]
+        return FakeChan(out='%s  blob\n' % hashlib.md5(data).hexdigest())
+
+
+class FakeClock(object):
+    ''' stands in for the time module in transfer, so retries don't wait '''
+
+    def __init__(self):
+        self.slept = []
+
+    def time(self):
+        return time.time()
+
+    def sleep(self, secs):
+        self.slept.append(secs)
+
+
+class ResumeTestCase(unittest.TestCase):
+    ''' a local file to upload, with small chunks and no waits between retries '''
+
+    def setUp(self):
+        # scaled down: 1 KB chunks, the offset is committed every 16 of them as with the real 1 MB chunks
+        self.saved = transfer.chunk_size, transfer.resume_every, transfer.time
+        transfer.chunk_size = 1024
+        transfer.resume_every = 16 * transfer.chunk_size
+        transfer.time = FakeClock()
+
+        self.tmp = tempfile.mkdtemp()
+        self.state_dir = os.path.join(self.tmp, 'transfers')
+        self.srcfile = os.path.join(self.tmp, 'blob')
+        self.data = os.urandom(100 * 1024)
+        with open(self.srcfile, 'wb') as fh:
+            fh.write(self.data)
+
+        self.lineterm = FakeResumeTerm()
+        self.sftp = self.lineterm.sftp_client
+        self.node = FakeNode('node1')
+        self.node.data['id'] = 'i-1'
+
+    def tearDown(self):
+        transfer.chunk_size, transfer.resume_every, transfer.time = self.saved
+        shutil.rmtree(self.tmp)
+
+
+class ResumablePutTest(ResumeTestCase):
+
+    def put(self, **kwargs):
+        transfer.resumable_put(self.lineterm, self.node, 'key', self.srcfile, 'blob', state_dir=self.state_dir,
+                               **kwargs)
+
+    def state(self):
+        names = os.listdir(self.state_dir) if os.path.isdir(self.state_dir) else []
+        self.assertTrue(len(names) <= 1)
+        if not names:
+            return None
+        with open(os.path.join(self.state_dir, names[0])) as fh:
+            return yaml.safe_load(fh)
+
+    def test_retry_resumes_at_the_last_committed_offset(self):
+        # the link drops 40 KB in, the last offset committed was 32 KB
+        self.sftp.fail_after = 40 * 1024
+        self.put()
+
+        self.assertEqual(self.sftp.ops, [('open', 'blob', 'wb'), ('open', 'blob', 'r+b'),
+                                         ('truncate', 32 * 1024), ('seek', 32 * 1024)])
+        self.assertEqual(transfer.time.slept, [2])
+        self.assertEqual(self.sftp.files['blob'], self.data)
+        self.assertEqual(self.state(), None)
+
+    def test_state_resumes_a_later_put(self):
+        self.sftp.fail_after = 40 * 1024
+        self.assertRaises(socket.error, self.put, retries=0)
+
+        st = os.stat(self.srcfile)
+        self.assertEqual(self.state(), { 'src' : os.path.abspath(self.srcfile), 'size' : len(self.data),
+                                         'mtime' : int(st.st_mtime), 'md5' : hashlib.md5(self.data).hexdigest(),
+                                         'done' : 32 * 1024 })
+
+        self.sftp.ops = []
+        self.sftp.fail_after = None
+        self.put()
+        self.assertEqual(self.sftp.ops[0], ('open', 'blob', 'r+b'))
+        self.assertEqual(self.sftp.files['blob'], self.data)
+        self.assertEqual(self.state(), None)
+
+    def test_only_landed_bytes_are_resumed(self):
+        self.sftp.fail_after = 40 * 1024
+        self.assertRaises(socket.error, self.put, retries=0)
+        self.sftp.files['blob'] = self.sftp.files['blob'][:20 * 1024]
+
+        self.sftp.ops = []
+        self.sftp.fail_after = None
+        self.put()
+        self.assertEqual(self.sftp.ops[1:3], [('truncate', 20 * 1024), ('seek', 20 * 1024)])
+        self.assertEqual(self.sftp.files['blob'], self.data)
+
+    def test_changed_source_starts_over(self):
+        self.sftp.fail_after = 40 * 1024
+        self.assertRaises(socket.error, self.put, retries=0)
+        os.utime(self.srcfile, (0, 0))
+
+        self.sftp.ops = []
+        self.sftp.fail_after = None
+        self.put()
+        self.assertEqual(self.sftp.ops, [('open', 'blob', 'wb')])
+
+    def test_md5_mismatch(self):
+        self.lineterm.corrupt = True
+        self.assertRaises(IOError, self.put)
+        # a bad file is not resumed on top of
+        self.assertEqual(self.state(), None)
+
+
+class FakeBroadcastTerm(object):
+    ''' an sftp session per node, md5sum is answered from that node's files '''
+
+    def __init__(self, nodes):
+        self.sftps = dict((node.name, FakeResumeSFTP()) for node in nodes)
+        self.corrupt = set()
+
+    def sftp(self, keyfile, node):
+        return self.sftps[node.name]
+
+    def exec_command(self, keyfile, node, cmd):
+        data = self.sftps[node.name].files['blob']
+        if node.name in self.corrupt:
+            data = data[::-1]
+        return FakeChan(out='%s  blob\n' % hashlib.md5(data).hexdigest())
+
+
+class BroadcastTest(ResumeTestCase):
+
+    def setUp(self):
+        ResumeTestCase.setUp(self)
+        self.nodes = [FakeNode('node%d' % i) for i in range(1, 4)]
+        for node in self.nodes:
+            node.data['id'] = 'i-%s' % node.name
+        self.lineterm = FakeBroadcastTerm(self.nodes)
+
+        # the source is read once, by the uploads, not again for its md5
+        self.local_md5 = transfer.local_md5
+        transfer.local_md5 = None
+
+    def tearDown(self):
+        transfer.local_md5 = self.local_md5
+        ResumeTestCase.tearDown(self)
+
+    def broadcast(self):
+        return transfer.broadcast_put(self.lineterm, [(node, 'key') for node in self.nodes], self.srcfile, 'blob',
+                                      state_dir=self.state_dir)
+
+    def test_every_node_gets_the_file(self):
+        self.lineterm.sftps['node2'].fail_after = 40 * 1024
+        summary = self.broadcast()
+        self.assertEqual(sorted(summary.done), ['node1', 'node2', 'node3'])
+        self.assertEqual(summary.failed, {})
+        for sftp in self.lineterm.sftps.values():
+            self.assertEqual(sftp.files['blob'], self.data)
+        # node2 dropped, and resumed at the last committed offset
+        self.assertEqual(self.lineterm.sftps['node2'].ops[1:4], [('open', 'blob', 'r+b'),
+                                                                 ('truncate', 32 * 1024), ('seek', 32 * 1024)])
+
+    def test_md5_mismatch_fails_the_node(self):
+        self.lineterm.corrupt.add('node3')
+        summary = self.broadcast()
+        self.assertEqual(sorted(summary.done), ['node1', 'node2'])
+        self.assertEqual(summary.failed.keys(), ['node3'])
+
+
+class StreamDigestTest(unittest.TestCase):
+
+    def test_uploads_at_different_offsets(self):
+        data = os.urandom(10000)
+        digest = transfer.StreamDigest(data, len(data))
+        for offset in [1000, 500, 4000, 4000, 2000]:
+            digest.advance(offset)
+        self.assertEqual(digest.pos, 4000)
+        self.assertEqual(digest.hexdigest(), hashlib.md5(data).hexdigest())
+        self.assertEqual(transfer.StreamDigest('', 0).hexdigest(), hashlib.md5('').hexdigest())
+
+
+class ForEachTest(unittest.TestCase):
+
+    def setUp(self):
+        self.lock = threading.Lock()
+        self.running = 0
+        self.peak = 0
+        self.calls = []     # [(nodename, item, thread name)]
+
+    def work(self, node, keyfile, item):
+        with self.lock:
+            self.running += 1
+            self.peak = max(self.peak, self.running)
+            self.calls.append( (node.name, item, threading.current_thread().name) )
+        time.sleep(0.05)
+        with self.lock:
+            self.running -= 1
+        if item == 'bad':
+            raise IOError('disk full')
+
+    def test_nodes_fan_out_items_stay_in_order(self):
+        nodes = [FakeNode('node%d' % i) for i in range(6)]
+        node_jobs = [(node, 'key', ['a', 'bad', 'c']) for node in nodes]
+        summary = transfer.for_each_node(node_jobs, self.work, workers=3)
+
+        self.assertEqual(self.peak, 3)
+        for node in nodes:
+            calls = [(item, thread) for nodename, item, thread in self.calls if nodename == node.name]
+            self.assertEqual([item for item, _ in calls], ['a', 'bad', 'c'])
+            # one thread per node, so a node's sftp session isn't shared
+            self.assertEqual(len(set(thread for _, thread in calls)), 1)
+            self.assertEqual(summary.done[node.name], ['a', 'c'])
+            self.assertEqual([item for item, _ in summary.failed[node.name]], ['bad'])
+
+    def test_files_fan_out(self):
+        node = FakeNode('node1')
+        summary = transfer.for_each_file([(node, 'key', str(i)) for i in range(8)], self.work, workers=4)
+        self.assertEqual(self.peak, 4)
+        self.assertEqual(sorted(summary.done['node1']), [str(i) for i in range(8)])
+
+    def test_no_jobs(self):
+        self.assertEqual(transfer.for_each_node([], self.work).done, {})
+
+
+class ProgressTest(unittest.TestCase):
+
+    def test_fmt_progress(self):
+        self.assertEqual(transfer.fmt_bytes(1536), '1.5 KB')
+        self.assertEqual(transfer.fmt_progress(1024, 4096, 1024), '1.0 KB/4.0 KB  1.0 KB/s  ETA 0:00:03')
+        self.assertEqual(transfer.fmt_progress(10, 0, 0), '10.0 B  0.0 B/s')
+
+    def test_totals_and_rates(self):
+        meter = transfer.ProgressMeter()
+        meter.callback('node1', 'a')(100, 200)
+        meter.callback('node1', 'b')(50, 50)
+        meter.callback('node2', 'a')(25, 0)
+        done, total, rate = meter.totals()
+        self.assertEqual((done, total), (175, 250))
+        self.assertTrue(rate > 0)
+        rates = meter.node_rates()
+        self.assertEqual((rates['node1'][0], rates['node2'][0]), (150, 25))
+
+    def test_stalled_stream(self):
+        meter = transfer.ProgressMeter()
+        meter.stall_secs = 0
+        meter.callback('node1', 'a')(10, 100)
+        meter.callback('node2', 'a')(100, 100)
+        meter.check_stalls()
+        self.assertEqual(meter.stalled, set([('node1', 'a')]))
+
+
+class SummaryTest(unittest.TestCase):
+
+    def test_saved_as_a_run(self):
+        tmp = tempfile.mkdtemp()
+        capture = CaptureStore(os.path.join(tmp, 'captures'))
+        try:
+            summary = transfer.TransferSummary()
+            summary.progress('node1', 'f')(2048, 2048)
+            summary.success('node1', 'f')
+            summary.failure('node2', 'f', Exception('disk full'))
+            self.assertFalse(summary.ok)
+            summary.log('put', capture, 'web* f')
+            capture.shutdown()
+
+            run_id, _, nodenames, cmdline = capture.runs()[-1]
+            self.assertEqual((nodenames, cmdline), (['node1', 'node2'], 'put web* f'))
+            lines = [(node, line) for _, node, line in capture.read(run_id)]
+            self.assertEqual(lines[0][0], 'node1')
+            self.assertTrue(lines[0][1].startswith('put: 1 ok, 0 failed, 2.0 KB at '))
+            self.assertEqual(lines[1:], [('node2', 'put: 0 ok, 1 failed, 0.0 B at 0.0 B/s'),
+                                         ('node2', 'failed f : disk full')])
+        finally:
+            shutil.rmtree(tmp)
+
+
+if __name__ == '__main__':
+    unittest.main()